@@ -0,0 +1,321 @@
+# coding=utf-8
+"""End-to-end load test of the API, redis and the filter on a single machine.
+
+Starts a redis server (or uses a running one), the API and the filter server with FILTER_MODE NONE, whose synthetic
+cost per read and base stands in for the alignment, and lets a number of concurrent uploaders submit random reads the
+way swgts-submit does (one chunk in flight, Retry-After is honored, the context is closed until it succeeds). Every
+combination of WORKER_THREADS and MAXIMUM_PENDING_BYTES given is run against fresh servers and reported with the
+end-to-end throughput, the time to close, the share of rejected (422) chunks, the redis memory high-water mark and the
+request latency percentiles.
+
+Requires redis-server (unless --redis is given) and the python packages of the API, the filter (mappy is imported
+even in NONE mode) and httpx. Run it from the repository root:
+
+    python benchmarking/loadtest.py --uploaders 16 --worker-threads 2,4,8 --maximum-pending-bytes 300000,1000000
+"""
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from threading import Barrier, Event, Thread
+from time import monotonic, sleep
+from typing import Any, Callable, Optional
+
+import httpx
+from redis import Redis, RedisError
+
+REPOSITORY: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCES: list[str] = [os.path.join(REPOSITORY, 'swgts-backend', 'swgts_api', 'src'),
+                      os.path.join(REPOSITORY, 'swgts-backend', 'swgts_filter', 'src')]
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def wait_for(check: Callable[[], bool], timeout: float, what: str, processes: list[subprocess.Popen]) -> None:
+    """Polls check until it returns True.
+    :raises RuntimeError: After timeout seconds or if one of the processes exits in the meantime."""
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        for process in processes:
+            if process.poll() is not None:
+                raise RuntimeError(f'{" ".join(process.args)} exited with {process.returncode} while waiting for '
+                                   f'{what}.')
+        try:
+            if check():
+                return
+        except (httpx.HTTPError, RedisError, OSError):
+            pass
+        sleep(0.2)
+    raise RuntimeError(f'Timed out waiting for {what}.')
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of ascending values, 0 if there are none."""
+    if len(sorted_values) == 0:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(fraction * len(sorted_values) + 0.5) - 1))]
+
+
+def write_configs(directory: str, redis_host: str, redis_port: int, worker_threads: int, maximum_pending_bytes: int,
+                  arguments: Namespace) -> None:
+    input_directory = os.path.join(directory, 'input')
+    os.makedirs(input_directory, exist_ok=True)
+    os.makedirs(os.path.join(directory, 'output', 'uploads'), exist_ok=True)
+    with open(os.path.join(input_directory, 'config_api.py'), 'w') as config:
+        config.write(f'REDIS_SERVER = {redis_host!r}\n'
+                     f'REDIS_PORT = {redis_port}\n'
+                     f'MAXIMUM_PENDING_BYTES = {maximum_pending_bytes}\n'
+                     f'HANDS_OFF = {arguments.hands_off}\n'
+                     f'CONTEXT_TIMEOUT = {arguments.context_timeout}\n')
+    with open(os.path.join(input_directory, 'config_filter.py'), 'w') as config:
+        config.write(f'REDIS_SERVER = {redis_host!r}\n'
+                     f'REDIS_PORT = {redis_port}\n'
+                     f"FILTER_MODE = 'NONE'\n"
+                     f'WORKER_THREADS = {worker_threads}\n'
+                     f'WORKER_ENGINE = {arguments.worker_engine!r}\n'
+                     f'DUMMY_SECONDS_PER_READ = {arguments.seconds_per_read}\n'
+                     f'DUMMY_SECONDS_PER_BASE = {arguments.seconds_per_base}\n'
+                     f'DUMMY_KEEP_FRACTION = {arguments.keep_fraction}\n'
+                     f'HEARTBEAT_INTERVAL = 1\n')
+
+
+def start_services(directory: str, api_port: int) -> list[subprocess.Popen]:
+    """Starts the API (the flask development server, threaded) and the filter server in directory, their output goes
+    to log files there."""
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(SOURCES + [os.environ.get('PYTHONPATH', '')]))
+    processes = []
+    for name, command in (('api', [sys.executable, '-m', 'flask', '--app', 'swgts_api.app', 'run',
+                                   '--host', '127.0.0.1', '--port', str(api_port), '--with-threads']),
+                          ('filter', [sys.executable, '-m', 'swgts_filter.server'])):
+        with open(os.path.join(directory, f'{name}.log'), 'w') as log:
+            processes.append(subprocess.Popen(command, cwd=directory, env=environment, stdout=log,
+                                              stderr=subprocess.STDOUT))
+    return processes
+
+
+def stop(processes: list[subprocess.Popen]) -> None:
+    for process in processes:
+        if process.poll() is None:
+            process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def generate_chunks(reads: int, read_length: int, chunk_bases: int, seed: int) -> list[list[list[list[str]]]]:
+    """Random single-end reads in the format of the reads endpoint, split into chunks of about chunk_bases bases."""
+    rng = random.Random(seed)
+    chunks: list[list[list[list[str]]]] = [[]]
+    bases = 0
+    for index in range(reads):
+        length = max(1, int(read_length * rng.uniform(0.5, 1.5)))
+        if bases + length > chunk_bases and len(chunks[-1]) > 0:
+            chunks.append([])
+            bases = 0
+        chunks[-1].append([[f'@loadtest_{seed}_{index}', ''.join(rng.choices('ACGT', k=length)), '+', 'I' * length]])
+        bases += length
+    return chunks
+
+
+def upload(base_url: str, chunks: list[list[list[list[str]]]], start: Barrier) -> dict[str, Any]:
+    """Submits the chunks to a new context and closes it, like swgts-submit with a window of one chunk.
+    :return: The timings and counts of the upload."""
+    result: dict[str, Any] = {'latencies': [], 'chunks': 0, 'rejections': 0, 'error': None}
+    with httpx.Client(base_url=base_url, timeout=120) as client:
+        start.wait()
+        started = monotonic()
+        try:
+            response = client.post('/context/create', json={'filenames': ['loadtest.fastq'], 'ordinals': True})
+            response.raise_for_status()
+            context = response.json()['context']
+            ordinal = 0
+            for chunk in chunks:
+                while True:
+                    sent = monotonic()
+                    response = client.post(f'/context/{context}/reads', json=chunk,
+                                           headers={'First-Ordinal': str(ordinal)})
+                    result['latencies'].append(monotonic() - sent)
+                    result['chunks'] += 1
+                    if response.status_code != httpx.codes.UNPROCESSABLE_ENTITY:
+                        break
+                    result['rejections'] += 1
+                    sleep(float(response.headers['Retry-After']))
+                response.raise_for_status()
+                ordinal += len(chunk)
+
+            closing = monotonic()
+            while True:
+                response = client.post(f'/context/{context}/close')
+                if response.status_code != httpx.codes.SERVICE_UNAVAILABLE:
+                    break
+                sleep(float(response.json()['Retry-After']))
+            response.raise_for_status()
+            finished = monotonic()
+            saved = response.json()
+            result.update(upload_seconds=closing - started, close_seconds=finished - closing, started=started,
+                          finished=finished, saved=saved.get('saved count', len(saved.get('saved', []))))
+        except (httpx.HTTPError, KeyError, ValueError) as e:
+            result['error'] = repr(e)
+    return result
+
+
+def sample_memory(redis_server: Redis, stop_sampling: Event, peak: list[int]) -> None:
+    while not stop_sampling.is_set():
+        peak[0] = max(peak[0], int(redis_server.info('memory')['used_memory']))
+        stop_sampling.wait(0.1)
+
+
+def run(redis_host: str, redis_port: int, worker_threads: int, maximum_pending_bytes: int,
+        arguments: Namespace) -> dict[str, Any]:
+    """Runs all uploaders once against fresh API and filter servers.
+    :return: The results of the run, see the README."""
+    redis_server = Redis(host=redis_host, port=redis_port)
+    redis_server.flushdb()
+    directory = tempfile.mkdtemp(prefix='swgts-loadtest-')
+    api_port = free_port()
+    base_url = f'http://127.0.0.1:{api_port}'
+    write_configs(directory, redis_host, redis_port, worker_threads, maximum_pending_bytes, arguments)
+    processes = start_services(directory, api_port)
+    try:
+        wait_for(lambda: httpx.get(f'{base_url}/server-status').json()['live workers'] >= worker_threads, 120,
+                 f'{worker_threads} filter workers', processes)
+        baseline_memory = int(redis_server.info('memory')['used_memory'])
+
+        chunk_bases = arguments.chunk_bases or maximum_pending_bytes // 10
+        uploads = [generate_chunks(arguments.reads, arguments.read_length, chunk_bases, arguments.seed + uploader)
+                   for uploader in range(arguments.uploaders)]
+        start = Barrier(arguments.uploaders)
+        stop_sampling, peak_memory = Event(), [baseline_memory]
+        sampler = Thread(target=sample_memory, args=(redis_server, stop_sampling, peak_memory), daemon=True)
+        sampler.start()
+        with ThreadPoolExecutor(max_workers=arguments.uploaders) as executor:
+            results = list(executor.map(lambda chunks: upload(base_url, chunks, start), uploads))
+        stop_sampling.set()
+        sampler.join()
+    finally:
+        stop(processes)
+        if arguments.keep_logs:
+            print(f'Logs of the run are in {directory}', file=sys.stderr)
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    completed = [result for result in results if result['error'] is None]
+    latencies = sorted(latency for result in results for latency in result['latencies'])
+    close_seconds = sorted(result['close_seconds'] for result in completed)
+    reads = arguments.reads * len(completed)
+    bases = sum(len(read[0][1]) for upload_chunks, result in zip(uploads, results) if result['error'] is None
+                for chunk in upload_chunks for read in chunk)
+    wall_seconds = (max(result['finished'] for result in completed) - min(result['started'] for result in completed)
+                    if len(completed) > 0 else 0)
+    chunks = sum(result['chunks'] for result in results)
+    rejections = sum(result['rejections'] for result in results)
+    return {
+        'worker threads': worker_threads,
+        'maximum pending bytes': maximum_pending_bytes,
+        'chunk bases': chunk_bases,
+        'uploaders': arguments.uploaders,
+        'failed uploaders': len(results) - len(completed),
+        'errors': sorted({result['error'] for result in results if result['error'] is not None}),
+        'reads': reads,
+        'bases': bases,
+        'saved reads': sum(result['saved'] for result in completed),
+        'wall seconds': wall_seconds,
+        'reads per second': reads / wall_seconds if wall_seconds > 0 else 0,
+        'bases per second': bases / wall_seconds if wall_seconds > 0 else 0,
+        'upload seconds p50': percentile(sorted(result['upload_seconds'] for result in completed), 0.5),
+        'close seconds p50': percentile(close_seconds, 0.5),
+        'close seconds p99': percentile(close_seconds, 0.99),
+        'close seconds max': close_seconds[-1] if len(close_seconds) > 0 else 0,
+        'chunk requests': chunks,
+        'rejected chunk requests': rejections,
+        'rejection rate': rejections / chunks if chunks > 0 else 0,
+        'request latency p50 seconds': percentile(latencies, 0.5),
+        'request latency p90 seconds': percentile(latencies, 0.9),
+        'request latency p99 seconds': percentile(latencies, 0.99),
+        'redis baseline memory bytes': baseline_memory,
+        'redis peak memory bytes': peak_memory[0],
+    }
+
+
+def get_argument_parser() -> ArgumentParser:
+    parser = ArgumentParser(description='Load test the API, redis and the filter with concurrent simulated uploaders.')
+    parser.add_argument('--uploaders', type=int, default=8, help='Concurrent uploads (default 8).')
+    parser.add_argument('--reads', type=int, default=2000, help='Reads per upload (default 2000).')
+    parser.add_argument('--read-length', type=int, default=1000,
+                        help='Mean read length, lengths vary by up to half of it (default 1000).')
+    parser.add_argument('--chunk-bases', type=int, default=None,
+                        help='Bases per chunk (default a tenth of MAXIMUM_PENDING_BYTES, like swgts-submit).')
+    parser.add_argument('--worker-threads', default='8',
+                        help='WORKER_THREADS of the filter, comma-separated values are run one after another.')
+    parser.add_argument('--maximum-pending-bytes', default='300000',
+                        help='MAXIMUM_PENDING_BYTES of the API, comma-separated values are run one after another.')
+    parser.add_argument('--worker-engine', default='PROCESS', choices=['PROCESS', 'THREAD'])
+    parser.add_argument('--seconds-per-read', type=float, default=0.005,
+                        help='Synthetic filter cost per read (DUMMY_SECONDS_PER_READ, default 0.005).')
+    parser.add_argument('--seconds-per-base', type=float, default=0,
+                        help='Synthetic filter cost per base (DUMMY_SECONDS_PER_BASE, default 0).')
+    parser.add_argument('--keep-fraction', type=float, default=1,
+                        help='Share of the reads the filter keeps (DUMMY_KEEP_FRACTION, default 1).')
+    parser.add_argument('--hands-off', action='store_true', help='Run the API in hands-off mode (no reads are saved).')
+    parser.add_argument('--context-timeout', type=int, default=600)
+    parser.add_argument('--redis', default=None,
+                        help='host:port of a redis server to use, its database is flushed before every run. By default '
+                             'redis-server is started on a free port.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this file instead of stdout.')
+    parser.add_argument('--keep-logs', action='store_true', help='Keep the working directories with the server logs.')
+    return parser
+
+
+def main() -> None:
+    arguments = get_argument_parser().parse_args()
+    redis_process: Optional[subprocess.Popen] = None
+    if arguments.redis is None:
+        redis_host, redis_port = '127.0.0.1', free_port()
+        redis_process = subprocess.Popen(['redis-server', '--port', str(redis_port), '--save', '',
+                                          '--appendonly', 'no'], stdout=subprocess.DEVNULL)
+        wait_for(lambda: Redis(host=redis_host, port=redis_port).ping(), 30, 'redis', [redis_process])
+    else:
+        redis_host, port = arguments.redis.rsplit(':', 1)
+        redis_port = int(port)
+
+    results = []
+    try:
+        for worker_threads, maximum_pending_bytes in product(map(int, arguments.worker_threads.split(',')),
+                                                             map(int, arguments.maximum_pending_bytes.split(','))):
+            print(f'Running {arguments.uploaders} uploaders against {worker_threads} workers and '
+                  f'{maximum_pending_bytes} pending bytes', file=sys.stderr)
+            result = run(redis_host, redis_port, worker_threads, maximum_pending_bytes, arguments)
+            print(f'{result["bases per second"]:.0f} bases/s, close p99 {result["close seconds p99"]:.2f} s, '
+                  f'{result["rejection rate"]:.1%} rejected, redis peak {result["redis peak memory bytes"]} bytes, '
+                  f'latency p99 {result["request latency p99 seconds"]:.3f} s', file=sys.stderr)
+            results.append(result)
+    finally:
+        if redis_process is not None:
+            redis_process.terminate()
+            redis_process.wait()
+
+    if arguments.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(arguments.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,4 +3,9 @@
 #Give non-root write access to the output folder (create uploads folder, write fastq)
 chown www-data:www-data ./output
 chmod u+rwX ./output
+
+#SWGTS_API_SERVER=asgi serves the asyncio variant of the api with hypercorn instead of apache/mod_wsgi
+if [ "$SWGTS_API_SERVER" = "asgi" ]; then
+    exec hypercorn --bind 0.0.0.0:80 --root-path /api --workers "${SWGTS_API_WORKERS:-1}" swgts_api.async_app:app
+fi
 exec /usr/sbin/apache2ctl -D FOREGROUND
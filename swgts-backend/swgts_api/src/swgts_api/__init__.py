@@ -1,2 +1,10 @@
 # coding=utf-8
-from .app import app
+
+
+def __getattr__(name: str):
+    # The WSGI application connects to redis on import, so it is only loaded when actually requested. This allows
+    # importing swgts_api.async_app without also setting up the WSGI application.
+    if name == 'app':
+        from .app import app
+        return app
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,10 +1,19 @@
 # coding=utf-8
 import sys
-from typing import Union
+from time import perf_counter
+from typing import Optional, Union
 
-from flask import Flask, request, make_response
+from flask import Flask, request, make_response, g
 
 from .context_manager import *
+from .chunks import validate_json_chunk, chunk_from_fastq, split_too_long_reads, parse_first_ordinal, \
+    FIRST_ORDINAL_HEADER
+from .estimator import estimate_wait
+from .fastq import PayloadTooLarge
+from .finalization import encode_saved_bitmap
+from .job import pack_job
+from .metrics import HISTOGRAMS
+from .profiling import SamplingProfiler
 from .version import VERSION_INFORMATION
 
 app = Flask(__name__)
@@ -17,9 +26,42 @@ def server_status() -> dict[str, Union[str, float]]:
     answer: dict[str, Union[str, float]] = VERSION_INFORMATION.copy()
     answer['uptime'] = time() - SERVER_LAUNCH_TIME
     answer['maximum pending bytes'] = app.config['MAXIMUM_PENDING_BYTES']
+    throughput = get_throughput()
+    answer['throughput'] = throughput.bases_per_second
+    answer['live workers'] = throughput.live_workers
+    answer['backlog'] = throughput.backlog
+    answer['queued contexts'] = get_queued_context_count()
+    answer['estimated wait'] = estimate_wait(throughput, throughput.backlog, app.config['RETRY_AFTER_FALLBACK'],
+                                              app.config['MAXIMUM_RETRY_AFTER'])
     return make_response(answer, 200)
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Latency histograms of the api and the filter and the state of the queue, in the Prometheus text format."""
+    return make_response(get_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+@app.before_request
+def start_request_timer() -> None:
+    g.request_start = perf_counter()
+    g.profile = PROFILER.start()
+
+
+@app.teardown_request
+def stop_request_profile(exception: Optional[BaseException]) -> None:
+    PROFILER.stop(g.pop('profile', None))
+
+
+@app.after_request
+def observe_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    HISTOGRAMS.observe('api_request_seconds', perf_counter() - g.request_start,
+                       f'route="{route}",method="{request.method}",status="{response.status_code}"')
+    flush_metrics()
+    return response
+
+
 @app.route('/context/create', methods=['POST'])
 def context_create() -> dict[str, UUID]:
     json_body: dict[str, Any]
@@ -29,10 +71,12 @@ def context_create() -> dict[str, UUID]:
             return make_response({'message': 'filenames missing in request.'}, 400)
         if not isinstance(json_body['filenames'], list):
             return make_response({'message': 'filenames is not a list.'}, 400)
+        if not isinstance(json_body.get('ordinals', False), bool):
+            return make_response({'message': 'ordinals is not a boolean.'}, 400)
     except TypeError:
         return make_response({'message': 'expected json body.'}, 400)
 
-    context = create_context(filenames=json_body['filenames'])
+    context = create_context(filenames=json_body['filenames'], ordinals=json_body.get('ordinals', False))
     if context is None:
         app.logger.error('Could not create context.')
 
@@ -41,32 +85,85 @@ def context_create() -> dict[str, UUID]:
 
 @app.route('/context/<uuid:context_id>/close', methods=['POST']) #TODO: Avoid race condition (close before last reads)
 def post_close_context(context_id: UUID) -> dict[str, Union[int, str, list[str]]]:
+    """Closes the context once everything is filtered and finalizes it in the background. Clients repeat this request
+    until it succeeds, it answers 503 while reads are pending or the context is being finalized."""
 
-    if not context_exists(context_id):
-        app.logger.warn(f'Tried to close non-existent context {context_id}.')
+    # We test if the context still has pending bytes and only close it if no more bytes are pending (everything is filtered)
+    status, pending_bytes, claim = claim_finalization(context_id)
+    if status == 404:
+        app.logger.warning(f'Tried to close non-existent context {context_id}.')
         return make_response({'message': 'No such context.'}, 404)
-
-    # We test if the context still has pending bytes and only delete it if no more bytes are pending (everything is filtered)
-    pending_bytes : int = get_pending_bytes_count(context_id)
-    if pending_bytes != 0:
+    elif status == 503:
         return make_response({
-            'Retry-After': pending_bytes*get_queue_speed(context_id),
+            'Retry-After': get_retry_after(pending_bytes, pending_bytes),
             'message' : 'There are still reads pending, try again later!'
         }, 503)
+    elif status == 201:
+        start_finalization(context_id, claim)
+
+    return finalization_response(context_id, get_finalization(context_id))
+
+
+@app.route('/context/<uuid:context_id>/finalization', methods=['GET'])
+def get_context_finalization(context_id: UUID) -> dict[str, Union[int, str]]:
+    """Reports the progress of the finalization of a closed context."""
+    finalization: Optional[dict[str, str]] = get_finalization(context_id)
+    if finalization is None:
+        return make_response({'message': 'No such context or the context is not closed.'}, 404)
+    answer: dict[str, Union[int, str]] = {'state': finalization['state'],
+                                          'written reads': int(finalization['written reads'])}
+    if 'total' in finalization:
+        answer['total'] = int(finalization['total'])
+    return make_response(answer, 200)
+
+
+@app.route('/context/<uuid:context_id>/queue', methods=['GET'])
+def get_context_queue(context_id: UUID) -> dict[str, int]:
+    """Reports the jobs of an open context that wait for a filter worker. Contexts take turns, so this shows how much
+    of the context is still waiting regardless of the uploads of others."""
+    if not context_exists(context_id):
+        return make_response({'message': 'No such context.'}, 404)
+    jobs, bases = get_queue_depth(context_id)
+    return make_response({'queued jobs': jobs, 'queued bases': bases, 'queued contexts': get_queued_context_count()},
+                         200)
+
 
-    result = close_context(context_id,app.config['HANDS_OFF'])
-    if result is None:
+def finalization_response(context_id: UUID, finalization: Optional[dict[str, str]]):
+    """The answer to a close request once the finalization of the context is claimed."""
+    if finalization is None:
+        # The finalization timed out in the meantime
+        return make_response({'message': 'No such context.'}, 404)
+    elif finalization['state'] == 'running':
+        resp = make_response({
+            'Retry-After': app.config['FINALIZATION_RETRY_AFTER'],
+            'written reads': int(finalization['written reads']),
+            'message': 'The context is being finalized, try again later!'
+        }, 503)
+        resp.headers['Retry-After'] = str(app.config['FINALIZATION_RETRY_AFTER'])
+        return resp
+    elif finalization['state'] == 'failed':
         return make_response({'message': 'Could not close context.'}, 500)
-    else:
-        app.logger.info(f'Closed context {context_id}, saved {len(result[1])} of {result[0]}.')
-        return make_response({'saved': result[1], 'total': result[0]}, 200)
+
+    saved_bitmap: Optional[bytes] = get_saved_bitmap(context_id)
+    if saved_bitmap is not None:
+        # The client sent ordinals, a bitmap of them is much smaller than the list of read ids
+        app.logger.info(f'Closed context {context_id}, saved {finalization["written reads"]} of {finalization["total"]}.')
+        return make_response({'saved bitmap': encode_saved_bitmap(saved_bitmap),
+                              'saved count': int(finalization['written reads']),
+                              'total': int(finalization['total'])}, 200)
+
+    saved_read_ids: list[str] = get_saved_read_ids(context_id)
+    app.logger.info(f'Closed context {context_id}, saved {len(saved_read_ids)} of {finalization["total"]}.')
+    return make_response({'saved': saved_read_ids, 'total': int(finalization['total'])}, 200)
 
 @app.route('/context/<uuid:context_id>/reads', methods=['POST'])
 def post_context_reads(context_id: UUID) -> dict[str, Union[int, str]]:
 
     request_reception_time = time()
 
-    if not context_exists(context_id):
+    # We expect as much reads to be paired as we have open file streams. (Support for strobe reads in theory)
+    pair_count: Optional[int] = get_cached_pair_count(context_id)
+    if pair_count is None:
         return make_response({'message': 'No such context.'}, 404)
 
     chunk: list[list[list[str]]]
@@ -77,72 +174,89 @@ def post_context_reads(context_id: UUID) -> dict[str, Union[int, str]]:
     except OSError:
         return make_response({'message': 'The connection was interrupted.'}, 400)
 
-    if not isinstance(chunk, list):
-        return make_response({'message': '"chunks" is not a list.'}, 400)
-
-    effective_cumulated_chunk_size: int = 0
-    pair_count: int = get_pair_count(context_id)  # We expect as much reads to be paired as we have open file streams. (Support for strobe reads in theory)
-
-    pairs_short_enough = []
-    for pair in chunk:
-        if not isinstance(pair, list):
-            return make_response({'message': 'There is a pair which is not a list.'}, 400)
-        if len(pair) != pair_count:
-            return make_response({'message': f'I thought you wanted to submit {pair_count}-paired reads, '
-                                             f'but here I got a pair that had {len(pair)} reads.'}, 400)
-        filtered_pair = []
-        for read in pair:
-            if not isinstance(read, list):
-                return make_response({'message': 'There is a read which is not a list.'}, 400)
-            if len(read) != 4:
-                return make_response({'message': 'There is a read with a length != 4.'}, 400)
-            # Here would be the place to perform additional sanity checks
-
-            if len(read[1]) <= app.config['MAXIMUM_PENDING_BYTES']:
-                # Only count the length of the actual sequence
-                effective_cumulated_chunk_size += len(read[1])
-                filtered_pair.append(read)
-            else:
-                increment_processed_bases(len(read[1]))
-                #The read will be discarded anyways and doesn't matter for buffer calculation
-                break
+    error = validate_json_chunk(chunk, pair_count)
+    if error is not None:
+        return make_response({'message': error}, 400)
+
+    return admit_chunk(context_id, chunk, request_reception_time)
+
+
+@app.route('/context/<uuid:context_id>/fastq', methods=['POST'])
+def post_context_fastq(context_id: UUID) -> dict[str, Union[int, str]]:
+    """Same as post_context_reads, but takes plain (optionally gzip compressed) FASTQ. Paired reads are either sent
+    interleaved in the body or as one multipart/form-data part per file (in file order)."""
+
+    request_reception_time = time()
+
+    pair_count: Optional[int] = get_cached_pair_count(context_id)
+    if pair_count is None:
+        return make_response({'message': 'No such context.'}, 404)
+
+    parts: list[bytes]
+    try:
+        if len(request.files) > 0:
+            parts = [part.read() for _, part in request.files.items(multi=True)]
         else:
-            #All reads fit the size and can be enqueued for filtering
-            pairs_short_enough.append(filtered_pair)
-    current_pending : int  = get_pending_bytes_count(context_id)
+            parts = [request.get_data()]
+    except OSError:
+        return make_response({'message': 'The connection was interrupted.'}, 400)
+
+    chunk: list[list[list[bytes]]]
+    try:
+        chunk = chunk_from_fastq(parts, pair_count, app.config['MAXIMUM_FASTQ_REQUEST_BYTES'])
+    except PayloadTooLarge as e:
+        return make_response({'message': str(e)}, 413)
+    except ValueError as e:
+        return make_response({'message': str(e)}, 400)
+
+    return admit_chunk(context_id, chunk, request_reception_time)
+
+
+def admit_chunk(context_id: UUID, chunk: list[list[list[Union[str, bytes]]]], request_reception_time: float):
+    """Checks a validated chunk against the buffer of the context and enqueues it for filtering, all in a single
+    round trip to redis."""
+
+    first_ordinal: Optional[int]
+    try:
+        first_ordinal = parse_first_ordinal(request.headers.get(FIRST_ORDINAL_HEADER))
+    except ValueError as e:
+        return make_response({'message': str(e)}, 400)
+
+    pairs_short_enough, ordinals, effective_cumulated_chunk_size, discarded_bases = \
+        split_too_long_reads(chunk, app.config['MAXIMUM_PENDING_BYTES'], first_ordinal)
+    job: Optional[bytes] = None
+    if len(pairs_short_enough) > 0:
+        job = pack_job(pairs_short_enough, context_id, effective_cumulated_chunk_size, request_reception_time,
+                       ordinals)
+
+    status, current_pending, processed_reads = admit_job(context_id, job, effective_cumulated_chunk_size,
+                                                         len(chunk) - len(pairs_short_enough), discarded_bases,
+                                                         first_ordinal)
     excess : int  = current_pending + effective_cumulated_chunk_size - app.config['MAXIMUM_PENDING_BYTES']
 
-    if effective_cumulated_chunk_size > app.config['MAXIMUM_PENDING_BYTES']:
+    if status == 404:
+        return make_response({'message': 'No such context.'}, 404)
+
+    elif status == 413:
         resp =  make_response(
             {'message': f'You sent a chunk that is larger than the configured buffer size',
-             'processed reads': get_processed_read_count(context_id)
+             'processed reads': processed_reads
              }, 413)
-        #Fetch current average processing
-        resp.headers['Retry-After'] = excess*get_queue_speed(context_id)
+        resp.headers['Retry-After'] = str(get_retry_after(excess, current_pending))
         return resp
 
-    elif excess > 0:
+    elif status == 422:
         resp =  make_response(
             {'message': f'You sent too much data.',
              'pending bytes': current_pending,
-             'processed reads': get_processed_read_count(context_id)
+             'processed reads': processed_reads
              }, 422)
-        #Fetch current average processing
-        resp.headers['Retry-After'] = excess*get_queue_speed(context_id)
+        resp.headers['Retry-After'] = str(get_retry_after(excess, current_pending))
         return resp
 
-    #Execution from here on means accepting the chunk and processing the reads
-    #Adjust pending bytes stat in redis
-    current_pending = change_pending_bytes_count(context_id, effective_cumulated_chunk_size)
-
-    increase_processed_read_count(context_id, len(chunk)-len(pairs_short_enough))
-
-    #Queue job and reads that are too long
-    if len(pairs_short_enough) > 0:
-        enqueue_chunks(pairs_short_enough, context_id, effective_cumulated_chunk_size, request_reception_time)
-
+    #The chunk was accepted and its reads are queued for filtering
     return make_response({
-        'processed reads': get_processed_read_count(context_id),
+        'processed reads': processed_reads,
         'pending bytes': current_pending},
                          200)
 
@@ -158,6 +272,8 @@ logging.getLogger().addHandler(logging.StreamHandler())
 for k in app.config:
     app.logger.info(f'Configuration {k} -> {app.config[k]}')
 
+PROFILER = SamplingProfiler(app.config['PROFILE_EVERY_NTH_REQUEST'], app.config['PROFILE_DIRECTORY'], 'api')
+
 
 app.logger.info('Connecting to stateful backend.')
 setup_state_server(app.config)
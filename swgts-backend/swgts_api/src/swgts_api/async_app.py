@@ -0,0 +1,304 @@
+# coding=utf-8
+import asyncio
+import json
+import logging
+import os
+import sys
+from time import time, perf_counter
+from typing import Any, Optional, Union
+from uuid import UUID
+
+from quart import Quart, request, make_response, g
+
+from . import async_context_manager as contexts
+from .chunks import validate_json_chunk, chunk_from_fastq, split_too_long_reads, parse_first_ordinal, \
+    FIRST_ORDINAL_HEADER
+from .estimator import estimate_wait
+from .fastq import PayloadTooLarge
+from .finalization import encode_saved_bitmap
+from .job import pack_job
+from .metrics import HISTOGRAMS
+from .profiling import SamplingProfiler
+from .version import VERSION_INFORMATION
+
+# ASGI variant of the api (see app.py for the WSGI one) with the same routes and responses. Every request awaits redis
+# instead of blocking a thread, and all requests of a process share a bounded pool of redis connections. Serve it with
+# an ASGI server, e.g. hypercorn swgts_api.async_app:app. Decoding, validating, splitting and packing a chunk take long
+# for large chunks, they run in a thread so the event loop keeps serving the other requests meanwhile.
+
+app = Quart(__name__)
+
+@app.route('/server-status', methods=['GET'])
+async def server_status() -> dict[str, Union[str, float]]:
+    """Returns information about the server. See app.server_status"""
+    answer: dict[str, Union[str, float]] = VERSION_INFORMATION.copy()
+    answer['uptime'] = time() - SERVER_LAUNCH_TIME
+    answer['maximum pending bytes'] = app.config['MAXIMUM_PENDING_BYTES']
+    throughput = await contexts.get_throughput()
+    answer['throughput'] = throughput.bases_per_second
+    answer['live workers'] = throughput.live_workers
+    answer['backlog'] = throughput.backlog
+    answer['queued contexts'] = await contexts.get_queued_context_count()
+    answer['estimated wait'] = estimate_wait(throughput, throughput.backlog, app.config['RETRY_AFTER_FALLBACK'],
+                                              app.config['MAXIMUM_RETRY_AFTER'])
+    return await make_response(answer, 200)
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    """See app.metrics"""
+    return await make_response(await contexts.get_metrics(), 200,
+                               {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+@app.before_request
+async def start_request_timer() -> None:
+    g.request_start = perf_counter()
+    g.profile = PROFILER.start()
+
+
+@app.teardown_request
+async def stop_request_profile(exception: Optional[BaseException]) -> None:
+    PROFILER.stop(g.pop('profile', None))
+
+
+@app.after_request
+async def observe_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    HISTOGRAMS.observe('api_request_seconds', perf_counter() - g.request_start,
+                       f'route="{route}",method="{request.method}",status="{response.status_code}"')
+    await contexts.flush_metrics()
+    return response
+
+
+@app.errorhandler(413)
+async def request_too_large(error) -> dict[str, str]:
+    return await make_response({'message': f'The request exceeds {app.config["MAX_CONTENT_LENGTH"]} bytes.'}, 413)
+
+
+@app.route('/context/create', methods=['POST'])
+async def context_create() -> dict[str, str]:
+    json_body: dict[str, Any] = await request.get_json(silent=True)
+    if not isinstance(json_body, dict):
+        return await make_response({'message': 'expected json body.'}, 400)
+    if 'filenames' not in json_body:
+        return await make_response({'message': 'filenames missing in request.'}, 400)
+    if not isinstance(json_body['filenames'], list):
+        return await make_response({'message': 'filenames is not a list.'}, 400)
+    if not isinstance(json_body.get('ordinals', False), bool):
+        return await make_response({'message': 'ordinals is not a boolean.'}, 400)
+
+    context = await contexts.create_context(filenames=json_body['filenames'], ordinals=json_body.get('ordinals', False))
+    if context is None:
+        app.logger.error('Could not create context.')
+
+    return {'context': str(context)}
+
+
+@app.route('/context/<uuid:context_id>/close', methods=['POST']) #TODO: Avoid race condition (close before last reads)
+async def post_close_context(context_id: UUID) -> dict[str, Union[int, str, list[str]]]:
+    """See app.post_close_context"""
+
+    # We test if the context still has pending bytes and only close it if no more bytes are pending (everything is filtered)
+    status, pending_bytes, claim = await contexts.claim_finalization(context_id)
+    if status == 404:
+        app.logger.warning(f'Tried to close non-existent context {context_id}.')
+        return await make_response({'message': 'No such context.'}, 404)
+    elif status == 503:
+        return await make_response({
+            'Retry-After': await contexts.get_retry_after(pending_bytes, pending_bytes),
+            'message' : 'There are still reads pending, try again later!'
+        }, 503)
+    elif status == 201:
+        contexts.start_finalization(context_id, claim)
+
+    return await finalization_response(context_id, await contexts.get_finalization(context_id))
+
+
+@app.route('/context/<uuid:context_id>/finalization', methods=['GET'])
+async def get_context_finalization(context_id: UUID) -> dict[str, Union[int, str]]:
+    """See app.get_context_finalization"""
+    finalization: Optional[dict[str, str]] = await contexts.get_finalization(context_id)
+    if finalization is None:
+        return await make_response({'message': 'No such context or the context is not closed.'}, 404)
+    answer: dict[str, Union[int, str]] = {'state': finalization['state'],
+                                          'written reads': int(finalization['written reads'])}
+    if 'total' in finalization:
+        answer['total'] = int(finalization['total'])
+    return await make_response(answer, 200)
+
+
+@app.route('/context/<uuid:context_id>/queue', methods=['GET'])
+async def get_context_queue(context_id: UUID) -> dict[str, int]:
+    """See app.get_context_queue"""
+    if not await contexts.context_exists(context_id):
+        return await make_response({'message': 'No such context.'}, 404)
+    jobs, bases = await contexts.get_queue_depth(context_id)
+    return await make_response({'queued jobs': jobs, 'queued bases': bases,
+                                'queued contexts': await contexts.get_queued_context_count()}, 200)
+
+
+async def finalization_response(context_id: UUID, finalization: Optional[dict[str, str]]):
+    """See app.finalization_response"""
+    if finalization is None:
+        # The finalization timed out in the meantime
+        return await make_response({'message': 'No such context.'}, 404)
+    elif finalization['state'] == 'running':
+        resp = await make_response({
+            'Retry-After': app.config['FINALIZATION_RETRY_AFTER'],
+            'written reads': int(finalization['written reads']),
+            'message': 'The context is being finalized, try again later!'
+        }, 503)
+        resp.headers['Retry-After'] = str(app.config['FINALIZATION_RETRY_AFTER'])
+        return resp
+    elif finalization['state'] == 'failed':
+        return await make_response({'message': 'Could not close context.'}, 500)
+
+    saved_bitmap: Optional[bytes] = await contexts.get_saved_bitmap(context_id)
+    if saved_bitmap is not None:
+        # The client sent ordinals, a bitmap of them is much smaller than the list of read ids
+        app.logger.info(f'Closed context {context_id}, saved {finalization["written reads"]} of {finalization["total"]}.')
+        return await make_response({'saved bitmap': encode_saved_bitmap(saved_bitmap),
+                              'saved count': int(finalization['written reads']),
+                              'total': int(finalization['total'])}, 200)
+
+    saved_read_ids: list[str] = await contexts.get_saved_read_ids(context_id)
+    app.logger.info(f'Closed context {context_id}, saved {len(saved_read_ids)} of {finalization["total"]}.')
+    return await make_response({'saved': saved_read_ids, 'total': int(finalization['total'])}, 200)
+
+
+@app.route('/context/<uuid:context_id>/reads', methods=['POST'])
+async def post_context_reads(context_id: UUID) -> dict[str, Union[int, str]]:
+
+    request_reception_time = time()
+
+    # We expect as much reads to be paired as we have open file streams. (Support for strobe reads in theory)
+    pair_count: Optional[int] = await contexts.get_cached_pair_count(context_id)
+    if pair_count is None:
+        return await make_response({'message': 'No such context.'}, 404)
+
+    if not request.is_json:
+        return await make_response({'message': 'Expected json body.'}, 400)
+    chunk: list[list[list[str]]]
+    try:
+        chunk = await asyncio.to_thread(json.loads, await request.get_data(as_text=False))
+    except ValueError:
+        return await make_response({'message': 'Expected json body.'}, 400)
+
+    error = await asyncio.to_thread(validate_json_chunk, chunk, pair_count)
+    if error is not None:
+        return await make_response({'message': error}, 400)
+
+    return await admit_chunk(context_id, chunk, request_reception_time)
+
+
+@app.route('/context/<uuid:context_id>/fastq', methods=['POST'])
+async def post_context_fastq(context_id: UUID) -> dict[str, Union[int, str]]:
+    """See app.post_context_fastq"""
+
+    request_reception_time = time()
+
+    pair_count: Optional[int] = await contexts.get_cached_pair_count(context_id)
+    if pair_count is None:
+        return await make_response({'message': 'No such context.'}, 404)
+
+    files = await request.files
+    parts: list[bytes]
+    if len(files) > 0:
+        parts = [part.read() for _, part in files.items(multi=True)]
+    else:
+        parts = [await request.get_data(as_text=False)]
+
+    chunk: list[list[list[bytes]]]
+    try:
+        chunk = await asyncio.to_thread(chunk_from_fastq, parts, pair_count, app.config['MAXIMUM_FASTQ_REQUEST_BYTES'])
+    except PayloadTooLarge as e:
+        return await make_response({'message': str(e)}, 413)
+    except ValueError as e:
+        return await make_response({'message': str(e)}, 400)
+
+    return await admit_chunk(context_id, chunk, request_reception_time)
+
+
+async def admit_chunk(context_id: UUID, chunk: list[list[list[Union[str, bytes]]]], request_reception_time: float):
+    """See app.admit_chunk"""
+
+    first_ordinal: Optional[int]
+    try:
+        first_ordinal = parse_first_ordinal(request.headers.get(FIRST_ORDINAL_HEADER))
+    except ValueError as e:
+        return await make_response({'message': str(e)}, 400)
+
+    pairs_short_enough, ordinals, effective_cumulated_chunk_size, discarded_bases = await asyncio.to_thread(
+        split_too_long_reads, chunk, app.config['MAXIMUM_PENDING_BYTES'], first_ordinal)
+    job: Optional[bytes] = None
+    if len(pairs_short_enough) > 0:
+        job = await asyncio.to_thread(pack_job, pairs_short_enough, context_id, effective_cumulated_chunk_size,
+                                      request_reception_time, ordinals)
+
+    status, current_pending, processed_reads = await contexts.admit_job(
+        context_id, job, effective_cumulated_chunk_size, len(chunk) - len(pairs_short_enough), discarded_bases,
+        first_ordinal)
+    excess : int  = current_pending + effective_cumulated_chunk_size - app.config['MAXIMUM_PENDING_BYTES']
+
+    if status == 404:
+        return await make_response({'message': 'No such context.'}, 404)
+
+    elif status == 413:
+        resp = await make_response(
+            {'message': f'You sent a chunk that is larger than the configured buffer size',
+             'processed reads': processed_reads
+             }, 413)
+        resp.headers['Retry-After'] = str(await contexts.get_retry_after(excess, current_pending))
+        return resp
+
+    elif status == 422:
+        resp = await make_response(
+            {'message': f'You sent too much data.',
+             'pending bytes': current_pending,
+             'processed reads': processed_reads
+             }, 422)
+        resp.headers['Retry-After'] = str(await contexts.get_retry_after(excess, current_pending))
+        return resp
+
+    #The chunk was accepted and its reads are queued for filtering
+    return await make_response({
+        'processed reads': processed_reads,
+        'pending bytes': current_pending},
+                         200)
+
+
+@app.before_serving
+async def connect_state_server() -> None:
+    app.logger.info('Connecting to stateful backend.')
+    contexts.setup_state_server(app.config)
+    if not await contexts.redis_ping():
+        app.logger.fatal('Could not connect to stateful backend. Goodbye.')
+        sys.exit(1)
+
+    #Share Context Timeout
+    await contexts.share_timeout(app.config['CONTEXT_TIMEOUT'])
+    app.logger.info('Server launched.')
+
+
+@app.after_serving
+async def disconnect_state_server() -> None:
+    await contexts.teardown_state_server()
+
+
+app.config.from_pyfile('config.py')
+if os.path.exists(app.config['CONFIG_FILE']):
+    print('found additional config file, overwriting defaults ...')
+    app.config.from_pyfile(app.config['CONFIG_FILE'])
+# Quart rejects bodies above 16 MiB by default, a (compressed) FASTQ request may be as large as its decompressed limit
+app.config['MAX_CONTENT_LENGTH'] = app.config['MAXIMUM_FASTQ_REQUEST_BYTES']
+logging.basicConfig(filename=app.config['LOG_FILE'], level='INFO',
+                    format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
+logging.getLogger().addHandler(logging.StreamHandler())
+
+for k in app.config:
+    app.logger.info(f'Configuration {k} -> {app.config[k]}')
+
+PROFILER = SamplingProfiler(app.config['PROFILE_EVERY_NTH_REQUEST'], app.config['PROFILE_DIRECTORY'], 'api')
+
+SERVER_LAUNCH_TIME = time()
@@ -0,0 +1,169 @@
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, Optional, Any
+from uuid import UUID, uuid4
+
+from redis import Redis as SyncRedis
+from redis.asyncio import Redis, BlockingConnectionPool
+from redis.commands.core import AsyncScript
+
+from . import commands
+from .finalization import finalize_context, saved_reads_key, kept_ordinals_key, finalization_key
+from .estimator import Throughput, bases_ahead, estimate_wait
+from .metrics import HISTOGRAMS, HISTOGRAMS_KEY, BUSY_RATIO_KEY, timed
+from .scripts import ADMISSION_SCRIPT, CLAIM_FINALIZATION_SCRIPT, WORK_ACTIVE_KEY
+
+# asyncio counterpart of context_manager, used by the ASGI application. Both send the same commands (see commands), so
+# both applications can serve the same contexts.
+
+lo = logging.getLogger('Async Context Manager')
+lo.setLevel('INFO')
+
+redis_server: Optional[Redis] = None
+admission_script: Optional[AsyncScript] = None
+claim_finalization_script: Optional[AsyncScript] = None
+finalization_server: Optional[SyncRedis] = None
+finalizer: Optional[ThreadPoolExecutor] = None
+CONFIG: Optional[dict[str, Any]] = None
+_PAIR_COUNT_CACHE_SIZE: int = 4096
+_pair_counts: dict[UUID, Optional[int]] = {}
+
+
+def setup_state_server(config: dict[str, Any]):
+    global CONFIG, redis_server, admission_script, claim_finalization_script, finalization_server, finalizer
+    CONFIG = config
+    # Requests wait for a free connection instead of opening one per concurrent request
+    redis_server = Redis(connection_pool=BlockingConnectionPool(host=config.get('REDIS_SERVER'),
+                                                                port=config['REDIS_PORT'],
+                                                                max_connections=config['REDIS_MAX_CONNECTIONS']))
+    admission_script = redis_server.register_script(ADMISSION_SCRIPT)
+    claim_finalization_script = redis_server.register_script(CLAIM_FINALIZATION_SCRIPT)
+    finalization_server = SyncRedis(host=config.get('REDIS_SERVER'), port=config['REDIS_PORT'])
+    finalizer = ThreadPoolExecutor(max_workers=config['FINALIZATION_THREADS'], thread_name_prefix='finalizer')
+
+async def teardown_state_server():
+    await redis_server.close()
+    await redis_server.connection_pool.disconnect()
+    finalizer.shutdown(wait=True)
+    finalization_server.close()
+
+async def redis_ping() -> bool:
+    return await redis_server.ping()
+
+
+async def context_exists(context: UUID) -> bool:
+    return await redis_server.exists(f'context:{context}:pair_count') == 1
+
+
+async def get_cached_pair_count(context: UUID) -> Optional[int]:
+    """See context_manager.get_cached_pair_count"""
+    if context not in _pair_counts:
+        pair_count = await redis_server.get(f'context:{context}:pair_count')
+        if len(_pair_counts) >= _PAIR_COUNT_CACHE_SIZE:
+            # Dicts keep their insertion order, so this evicts the oldest entry
+            del _pair_counts[next(iter(_pair_counts))]
+        _pair_counts[context] = None if pair_count is None else int(pair_count)
+    return _pair_counts[context]
+
+
+@timed('api_redis_seconds', 'operation="create"')
+async def create_context(filenames: list[str], ordinals: bool = False) -> UUID:
+    """:param ordinals: The client sends ordinals with its chunks, the saved reads are reported as a bitmap of them."""
+    new_context_id = uuid4()
+    pipeline = redis_server.pipeline()
+    commands.queue_create_context(pipeline, new_context_id, filenames, ordinals, CONFIG)
+    await pipeline.execute()
+    return new_context_id
+
+@timed('api_redis_seconds', 'operation="admission"')
+async def admit_job(context: UUID, job: Optional[bytes], effective_cumulated_chunk_size: int, dropped_reads: int,
+                    discarded_bases: int, first_ordinal: Optional[int] = None) -> Tuple[int, int, int]:
+    """See context_manager.admit_job"""
+    status, pending_bytes, processed_reads = await admission_script(**commands.admission_arguments(
+        context, job, effective_cumulated_chunk_size, dropped_reads, discarded_bases, first_ordinal, CONFIG))
+    if status == 200 and job is not None:
+        lo.info(f'Enqueued a job of {effective_cumulated_chunk_size} bases for context {context}.')
+    return int(status), int(pending_bytes), int(processed_reads)
+
+async def get_queue_depth(context: UUID) -> Tuple[int, int]:
+    """See context_manager.get_queue_depth"""
+    pipeline = redis_server.pipeline()
+    commands.queue_queue_depth(pipeline, context)
+    return commands.parse_queue_depth(await pipeline.execute())
+
+async def get_queued_context_count() -> int:
+    """See context_manager.get_queued_context_count"""
+    return int(await redis_server.llen(WORK_ACTIVE_KEY))
+
+@timed('api_redis_seconds', 'operation="throughput"')
+async def get_throughput() -> Throughput:
+    """See context_manager.get_throughput"""
+    pipeline = redis_server.pipeline()
+    commands.queue_throughput(pipeline)
+    throughput, stale = commands.parse_throughput(await pipeline.execute(), CONFIG)
+    if len(stale) > 0:
+        pipeline = redis_server.pipeline()
+        commands.queue_forget_workers(pipeline, stale)
+        await pipeline.execute()
+    return throughput
+
+async def get_retry_after(bases: int, pending_bytes: int) -> float:
+    """See context_manager.get_retry_after"""
+    throughput = await get_throughput()
+    return estimate_wait(throughput,
+                         bases_ahead(bases, pending_bytes, throughput.backlog, await get_queued_context_count()),
+                         CONFIG['RETRY_AFTER_FALLBACK'], CONFIG['MAXIMUM_RETRY_AFTER'])
+
+@timed('api_redis_seconds', 'operation="claim_finalization"')
+async def claim_finalization(context: UUID) -> Tuple[int, int, str]:
+    """See context_manager.claim_finalization"""
+    claim = uuid4().hex
+    status, pending_bytes = await claim_finalization_script(
+        **commands.claim_finalization_arguments(context, claim, CONFIG))
+    return int(status), int(pending_bytes), claim
+
+def start_finalization(context: UUID, claim: str) -> None:
+    """See context_manager.start_finalization. The finalization blocks, so it uses its own synchronous client in the
+    threads of the finalizer instead of the event loop."""
+    lo.info(f'Closing Context {context} ...')
+    finalizer.submit(finalize_context, finalization_server, context, claim, CONFIG)
+
+@timed('api_redis_seconds', 'operation="finalization"')
+async def get_finalization(context: UUID) -> Optional[dict[str, str]]:
+    """See context_manager.get_finalization"""
+    return commands.parse_finalization(await redis_server.hgetall(finalization_key(context)))
+
+async def get_saved_read_ids(context: UUID) -> list[str]:
+    return commands.parse_saved_read_ids(await redis_server.lrange(saved_reads_key(context), 0, -1))
+
+async def get_saved_bitmap(context: UUID) -> Optional[bytes]:
+    """The bitmap of the ordinals of the saved reads (bit i is the (i % 8)-th most significant bit of byte i // 8),
+    None if the client of the context does not send ordinals."""
+    return await redis_server.get(kept_ordinals_key(context))
+
+
+async def flush_metrics() -> None:
+    """See context_manager.flush_metrics"""
+    if HISTOGRAMS.due(CONFIG['METRICS_FLUSH_INTERVAL']):
+        pipeline = redis_server.pipeline(transaction=False)
+        HISTOGRAMS.flush(pipeline)
+        await pipeline.execute()
+
+async def get_metrics() -> str:
+    """See context_manager.get_metrics"""
+    throughput = await get_throughput()
+    names = [name.decode('utf-8') for name in await redis_server.smembers(HISTOGRAMS_KEY)]
+    pipeline = redis_server.pipeline()
+    commands.queue_metrics(pipeline, names)
+    metrics, gone = commands.parse_metrics(names, await pipeline.execute(), throughput)
+    if len(gone) > 0:
+        await redis_server.hdel(BUSY_RATIO_KEY, *gone)
+    return metrics
+
+async def share_timeout(timeout: int) -> None:
+    if not await redis_server.set('config:expiry', timeout):
+        lo.error('Expiry config value cannot be set ...')
+        sys.exit(-2)
+    else:
+        lo.info('Wrote timeout config value into redis')
@@ -0,0 +1,153 @@
+# coding=utf-8
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from argparse import ArgumentParser
+from itertools import count
+from time import time
+from typing import Any, Callable, Optional
+
+from .runner import PROFILES, fastq_body, find_regressions, generate_chunk, measure
+
+# Runs the ingestion path of the api in-process: the app is imported with its redis client replaced by an in-process
+# stand-in (fakeredis, which runs the Lua scripts with lupa) or a client of the given server, and the chunks are sent
+# with the Flask test client. No filter runs, so the buffer is made large enough to admit every chunk.
+
+
+def connect(redis: Optional[str]) -> Any:
+    """:param redis: host:port of a redis server whose database is flushed, None for fakeredis."""
+    if redis is None:
+        try:
+            from fakeredis import FakeRedis
+        except ImportError:
+            print('The benchmark needs fakeredis with Lua support (pip install "swgts_api[benchmark]") or a redis '
+                  'server (--redis).')
+            sys.exit(-1)
+        return FakeRedis()
+    from redis import Redis
+    host, port = redis.rsplit(':', 1)
+    return Redis(host=host, port=int(port))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the stages of chunk ingestion in the api.')
+    parser.add_argument('--chunk-bases', type=str, default='10000,30000,100000,300000',
+                        help='The chunk sizes (bases) to benchmark, comma-separated.')
+    parser.add_argument('--profiles', type=str, default=','.join(PROFILES),
+                        help=f'The read profiles to benchmark, comma-separated ({", ".join(PROFILES)}).')
+    parser.add_argument('--stages', type=str, default=None,
+                        help='Only benchmark these stages, comma-separated (default all).')
+    parser.add_argument('--rounds', type=int, default=5, help='Timed rounds per case.')
+    parser.add_argument('--minimum-seconds', type=float, default=0.2, help='Minimum duration of a round.')
+    parser.add_argument('--redis', type=str, default=None,
+                        help='host:port of a redis server to use instead of fakeredis, its database is flushed.')
+    parser.add_argument('--output', type=str, default=None, help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Results of an earlier run. Exits with 1 if a case got slower by more than the tolerance.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='How much slower a case may get compared to the baseline (default 0.1 = 10 %%).')
+    arguments = parser.parse_args()
+    output_path = None if arguments.output is None else os.path.abspath(arguments.output)
+
+    redis_server = connect(arguments.redis)
+    redis_server.flushdb()
+
+    # The configuration (and with it the log file) is relative to the working directory
+    initial_directory = os.getcwd()
+    working_directory = tempfile.mkdtemp(prefix='swgts-benchmark-')
+    os.makedirs(os.path.join(working_directory, 'output'))
+    os.chdir(working_directory)
+    from .. import context_manager
+    context_manager.Redis = lambda **_: redis_server
+    from ..app import app
+    from ..chunks import validate_json_chunk, split_too_long_reads, chunk_from_fastq
+    from ..context_manager import admit_job, create_context
+    from ..job import pack_job
+    from flask import request
+    # Logging every admitted job would dominate the small chunks
+    logging.disable(logging.INFO)
+
+    maximum_pending_bytes = 2 ** 62
+    app.config['MAXIMUM_PENDING_BYTES'] = maximum_pending_bytes
+    client = app.test_client()
+    # Chunks with an ordinal are only admitted once, every call sends the next one
+    ordinals = count()
+    context = None
+    # The job the admission stage admits, packed for the current context
+    job = None
+
+    def reset() -> None:
+        global context
+        redis_server.flushdb()
+        context = create_context(['benchmark.fastq'], ordinals=True)
+
+    def decode_json(body: bytes) -> None:
+        with app.test_request_context(method='POST', data=body, content_type='application/json'):
+            request.get_json()
+
+    def split_and_pack(chunk: list[list[list[str]]]) -> None:
+        pairs, chunk_ordinals, bases, _ = split_too_long_reads(chunk, maximum_pending_bytes, next(ordinals))
+        pack_job(pairs, context, bases, time(), chunk_ordinals)
+
+    def reset_admission(chunk: list[list[list[str]]], bases: int) -> None:
+        global job
+        reset()
+        job = pack_job(chunk, context, bases, time(), list(range(len(chunk))))
+
+    def admit(bases: int) -> None:
+        status, _, _ = admit_job(context, job, bases, 0, 0, next(ordinals))
+        assert status == 200, f'The admission failed with {status}.'
+
+    def post(endpoint: str, body: bytes, content_type: str) -> None:
+        response = client.post(f'/context/{context}/{endpoint}', data=body, content_type=content_type,
+                               headers={'First-Ordinal': str(next(ordinals))})
+        assert response.status_code == 200, f'The {endpoint} request failed with {response.status_code}.'
+
+    results: list[dict[str, Any]] = []
+    reset()
+    for profile_name in arguments.profiles.split(','):
+        profile = PROFILES[profile_name]
+        for chunk_bases in map(int, arguments.chunk_bases.split(',')):
+            chunk = generate_chunk(profile, chunk_bases)
+            bases = sum(len(read[1]) for pair in chunk for read in pair)
+            json_body = json.dumps(chunk).encode()
+            fastq = fastq_body(chunk)
+            # stage -> (function, reset)
+            stages: dict[str, tuple[Callable[[], Any], Optional[Callable[[], Any]]]] = {
+                'json decode': (lambda: decode_json(json_body), None),
+                'json validate': (lambda: validate_json_chunk(chunk, 1), None),
+                'fastq decode': (lambda: chunk_from_fastq([fastq], 1, len(fastq)), None),
+                'split and pack': (lambda: split_and_pack(chunk), None),
+                'admission': (lambda: admit(bases), lambda: reset_admission(chunk, bases)),
+                'json request': (lambda: post('reads', json_body, 'application/json'), reset),
+                'fastq request': (lambda: post('fastq', fastq, 'text/plain'), reset),
+            }
+            for stage, (function, stage_reset) in stages.items():
+                if arguments.stages is not None and stage not in arguments.stages.split(','):
+                    continue
+                result = {'stage': stage, 'profile': profile.name, 'chunk bases': chunk_bases, 'reads': len(chunk),
+                          'bases': bases, **measure(function, stage_reset, arguments.rounds, arguments.minimum_seconds)}
+                result['bases per second'] = bases / result['best seconds']
+                results.append(result)
+                print(f'{stage:>14} {profile.name:>5} {chunk_bases:>8} bases: {result["best seconds"] * 1e6:10.1f} us '
+                      f'(median {result["median seconds"] * 1e6:.1f} us), '
+                      f'{result["bases per second"] / 1e6:.1f} Mbases/s')
+    redis_server.flushdb()
+    os.chdir(initial_directory)
+    shutil.rmtree(working_directory, ignore_errors=True)
+
+    if output_path is not None:
+        with open(output_path, 'w') as output:
+            json.dump(results, output, indent=2)
+        print(f'Wrote the results of {len(results)} cases to {arguments.output}')
+    if arguments.baseline is not None:
+        with open(arguments.baseline, 'r') as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), arguments.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if len(regressions) > 0:
+            sys.exit(1)
+        print(f'No case got slower than {arguments.baseline} by more than {arguments.tolerance:.0%}.')
@@ -0,0 +1,95 @@
+# coding=utf-8
+import random
+from statistics import median
+from time import perf_counter
+from typing import Any, Callable, NamedTuple, Optional
+
+# Microbenchmarks of the stages a chunk passes in the api. Every stage is called in a loop for a number of rounds, each
+# long enough to be timed reliably, and the best and median round are reported per call, see measure. Stages with
+# state in redis are reset before every round.
+
+
+class ReadProfile(NamedTuple):
+    name: str
+    # The mean read length, the lengths vary by variation * read_length in both directions
+    read_length: int
+    variation: float
+
+
+PROFILES: dict[str, ReadProfile] = {
+    'short': ReadProfile('short', 150, 0),
+    'ont': ReadProfile('ont', 5000, 0.5),
+}
+
+
+def generate_chunk(profile: ReadProfile, chunk_bases: int, pair_count: int = 1,
+                   seed: int = 0) -> list[list[list[str]]]:
+    """Random reads in the format of the reads endpoint, as many as fit into chunk_bases (at least one pair)."""
+    rng = random.Random(seed)
+    chunk: list[list[list[str]]] = []
+    bases = 0
+    while len(chunk) == 0 or bases < chunk_bases:
+        pair = []
+        for mate in range(pair_count):
+            length = max(1, int(profile.read_length * rng.uniform(1 - profile.variation, 1 + profile.variation)))
+            pair.append([f'@read_{len(chunk)}/{mate + 1}', ''.join(rng.choices('ACGT', k=length)), '+',
+                         ''.join(rng.choices('+5?I', k=length))])
+            bases += length
+        if len(chunk) > 0 and bases > chunk_bases:
+            break
+        chunk.append(pair)
+    return chunk
+
+
+def fastq_body(chunk: list[list[list[str]]]) -> bytes:
+    """The chunk as interleaved FASTQ, the body of the fastq endpoint."""
+    return ''.join(f'{line}\n' for pair in chunk for read in pair for line in read).encode()
+
+
+def measure(function: Callable[[], Any], reset: Optional[Callable[[], Any]] = None, rounds: int = 5,
+            minimum_seconds: float = 0.2) -> dict[str, float]:
+    """Times function like timeit: the calls per round are doubled until a round takes minimum_seconds.
+    :param reset: Called before every round, it is not timed.
+    :return: The calls per round and the best and median seconds per call."""
+    calls = 1
+    while True:
+        if reset is not None:
+            reset()
+        start = perf_counter()
+        for _ in range(calls):
+            function()
+        if perf_counter() - start >= minimum_seconds:
+            break
+        calls *= 2
+
+    timings = []
+    for _ in range(rounds):
+        if reset is not None:
+            reset()
+        start = perf_counter()
+        for _ in range(calls):
+            function()
+        timings.append((perf_counter() - start) / calls)
+    return {'calls per round': calls, 'best seconds': min(timings), 'median seconds': median(timings)}
+
+
+def case_key(result: dict[str, Any]) -> tuple[str, str, int]:
+    return result['stage'], result['profile'], result['chunk bases']
+
+
+def find_regressions(results: list[dict[str, Any]], baseline: list[dict[str, Any]],
+                     tolerance: float) -> list[str]:
+    """Compares the best time per call of every case with the same case of an earlier run.
+    :param tolerance: How much slower (0.1 = 10 %) a case may get before it counts as a regression.
+    :return: A description of every regression."""
+    previous = {case_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(case_key(result))
+        if before is None:
+            continue
+        if result['best seconds'] > before['best seconds'] * (1 + tolerance):
+            regressions.append(f'{result["stage"]} ({result["profile"]} reads, {result["chunk bases"]} bases): '
+                               f'{before["best seconds"] * 1e6:.1f} us -> {result["best seconds"] * 1e6:.1f} us '
+                               f'({result["best seconds"] / before["best seconds"] - 1:+.0%})')
+    return regressions
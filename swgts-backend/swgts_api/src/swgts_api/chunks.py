@@ -0,0 +1,98 @@
+# coding=utf-8
+from typing import Optional, Tuple, Union
+
+from .fastq import GZIP_MAGIC, gunzip, parse_fastq
+
+# Validation and preparation of submitted chunks, shared by the WSGI and the ASGI application. Nothing in here talks
+# to redis.
+
+# The request header carrying the ordinal of the first read of a chunk, see parse_first_ordinal
+FIRST_ORDINAL_HEADER: str = 'First-Ordinal'
+
+
+def validate_json_chunk(chunk: object, pair_count: int) -> Optional[str]:
+    """Checks the structure of a chunk submitted as json.
+    :return: None if the chunk is fine, else the message for the client."""
+    if not isinstance(chunk, list):
+        return '"chunks" is not a list.'
+    for pair in chunk:
+        if not isinstance(pair, list):
+            return 'There is a pair which is not a list.'
+        if len(pair) != pair_count:
+            return (f'I thought you wanted to submit {pair_count}-paired reads, '
+                    f'but here I got a pair that had {len(pair)} reads.')
+        for read in pair:
+            if not isinstance(read, list):
+                return 'There is a read which is not a list.'
+            if len(read) != 4:
+                return 'There is a read with a length != 4.'
+            # Here would be the place to perform additional sanity checks
+    return None
+
+
+def chunk_from_fastq(parts: list[bytes], pair_count: int, limit: int) -> list[list[list[bytes]]]:
+    """Builds a chunk from FASTQ data. Paired reads are either interleaved in a single part or given as one part per
+    file. Parts may be gzip compressed.
+    :raises PayloadTooLarge: If a (decompressed) part exceeds limit bytes.
+    :raises ValueError: If the data is not well-formed FASTQ or can not be split into pairs."""
+    records_per_part = [parse_fastq(gunzip(part, limit) if part.startswith(GZIP_MAGIC) else part, limit)
+                        for part in parts]
+
+    if len(parts) == 1:
+        # Interleaved, the mates of a read follow each other
+        records = records_per_part[0]
+        if len(records) % pair_count != 0:
+            raise ValueError(f'I thought you wanted to submit {pair_count}-paired reads, '
+                             f'but {len(records)} reads can not be split into pairs.')
+        return [records[index:index + pair_count] for index in range(0, len(records), pair_count)]
+    elif len(parts) == pair_count:
+        if any(len(records) != len(records_per_part[0]) for records in records_per_part):
+            raise ValueError('The parts contain different numbers of reads.')
+        return [list(pair) for pair in zip(*records_per_part)]
+    raise ValueError(f'I thought you wanted to submit {pair_count}-paired reads, but here I got {len(parts)} parts.')
+
+
+def parse_first_ordinal(value: Optional[str]) -> Optional[int]:
+    """Parses the FIRST_ORDINAL_HEADER of a chunk submission. Clients number their reads (pairs) consecutively from 0
+    on and send the ordinal of the first read of every chunk, the server then reports the kept reads as a bitmap of
+    ordinals when the context is closed.
+    :return: None if the client does not send ordinals.
+    :raises ValueError: If the value is not a non-negative integer."""
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise ValueError(f'{FIRST_ORDINAL_HEADER} is not a non-negative integer.')
+    return int(value)
+
+
+def split_too_long_reads(chunk: list[list[list[Union[str, bytes]]]], maximum_pending_bytes: int,
+                         first_ordinal: Optional[int] = None) \
+        -> Tuple[list[list[list[Union[str, bytes]]]], Optional[list[int]], int, int]:
+    """Separates the pairs that fit into the buffer from those with a read that is longer than the whole buffer. The
+    latter are discarded anyways and don't matter for buffer calculation.
+    :param first_ordinal: The ordinal of the first pair of the chunk, if the client sends ordinals.
+    :return: The pairs short enough, their ordinals (None without a first ordinal), the sum of their sequence lengths
+    and the bases of the discarded reads."""
+    effective_cumulated_chunk_size: int = 0
+    discarded_bases: int = 0
+
+    pairs_short_enough = []
+    ordinals = None if first_ordinal is None else []
+    for pair_index, pair in enumerate(chunk):
+        filtered_pair = []
+        pair_size: int = 0
+        for read in pair:
+            if len(read[1]) <= maximum_pending_bytes:
+                # Only count the length of the actual sequence
+                pair_size += len(read[1])
+                filtered_pair.append(read)
+            else:
+                discarded_bases += len(read[1])
+                break
+        else:
+            #All reads fit the size and can be enqueued for filtering
+            pairs_short_enough.append(filtered_pair)
+            effective_cumulated_chunk_size += pair_size
+            if ordinals is not None:
+                ordinals.append(first_ordinal + pair_index)
+    return pairs_short_enough, ordinals, effective_cumulated_chunk_size, discarded_bases
@@ -0,0 +1,119 @@
+# coding=utf-8
+from os import path
+from time import time
+from typing import Any, Optional
+from uuid import UUID
+
+from .estimator import Throughput, estimate_throughput, WORKERS_KEY, WORK_IN_FLIGHT_KEY
+from .finalization import finalization_key, saved_reads_key, kept_ordinals_key
+from .metrics import BUSY_RATIO_KEY, busy_ratio, histogram_key, render
+from .scripts import WORK_ACTIVE_KEY, WORK_BASES_KEY, WORK_READY_KEY, work_queue_key, work_sizes_key
+
+# The redis commands of context_manager and async_context_manager. Every helper either queues commands on a pipeline
+# (a synchronous or an asyncio one, queueing does not block in either) or builds the keys and arguments of a script
+# (see scripts), or interprets the replies. The two modules only differ in how they wait for the replies.
+
+Pipeline = Any
+
+
+def queue_create_context(pipeline: Pipeline, context: UUID, filenames: list[str], ordinals: bool,
+                         config: dict[str, Any]) -> None:
+    """See context_manager.create_context"""
+    if ordinals:
+        # An empty bitmap, so that a context without any saved read is still reported as a bitmap
+        pipeline.setex(kept_ordinals_key(context), config['CONTEXT_TIMEOUT'], b'')
+
+    pipeline.setex(f'context:{context}:pending_bytes', config['CONTEXT_TIMEOUT'], 0)
+    pipeline.setex(f'context:{context}:pair_count', config['CONTEXT_TIMEOUT'], len(filenames))
+    pipeline.setex(f'context:{context}:processed_reads', config['CONTEXT_TIMEOUT'], 0)
+
+    for pair_index, filename in enumerate(filenames):
+        #We save only the basename to avoid creating of directories etc.
+        pipeline.setex(f'context:{context}:pair:{pair_index}:filename', config['CONTEXT_TIMEOUT'],
+                       path.basename(filename))
+
+
+def admission_arguments(context: UUID, job: Optional[bytes], effective_cumulated_chunk_size: int,
+                        dropped_reads: int, discarded_bases: int, first_ordinal: Optional[int],
+                        config: dict[str, Any]) -> dict[str, list]:
+    """The keys and args of scripts.ADMISSION_SCRIPT, see context_manager.admit_job"""
+    return {'keys': [f'context:{context}:pair_count', f'context:{context}:pending_bytes',
+                     f'context:{context}:processed_reads', work_queue_key(context), 'stats:bases',
+                     f'context:{context}:admitted', work_sizes_key(context), WORK_ACTIVE_KEY, WORK_BASES_KEY,
+                     WORK_READY_KEY],
+            'args': [effective_cumulated_chunk_size, config['MAXIMUM_PENDING_BYTES'], config['CONTEXT_TIMEOUT'],
+                     dropped_reads, discarded_bases, b'' if job is None else job,
+                     '' if first_ordinal is None else first_ordinal, str(context)]}
+
+
+def claim_finalization_arguments(context: UUID, claim: str, config: dict[str, Any]) -> dict[str, list]:
+    """The keys and args of scripts.CLAIM_FINALIZATION_SCRIPT, see context_manager.claim_finalization"""
+    return {'keys': [f'context:{context}:pair_count', f'context:{context}:pending_bytes', finalization_key(context),
+                     saved_reads_key(context)],
+            'args': [config['CONTEXT_TIMEOUT'], time(), claim, config['FINALIZATION_STALE_AFTER']]}
+
+
+def queue_queue_depth(pipeline: Pipeline, context: UUID) -> None:
+    """Replies with the jobs of the context waiting for a filter worker and their bases, see parse_queue_depth."""
+    pipeline.llen(work_queue_key(context))
+    pipeline.hget(WORK_BASES_KEY, str(context))
+
+
+def parse_queue_depth(replies: list) -> tuple[int, int]:
+    jobs, bases = replies
+    return int(jobs), int(bases or 0)
+
+
+def queue_throughput(pipeline: Pipeline) -> None:
+    """Replies with the heartbeats of the filter workers, the queued bases and the bases the workers are filtering, see
+    parse_throughput."""
+    pipeline.hgetall(WORKERS_KEY)
+    pipeline.hvals(WORK_BASES_KEY)
+    pipeline.hgetall(WORK_IN_FLIGHT_KEY)
+
+
+def parse_throughput(replies: list, config: dict[str, Any]) -> tuple[Throughput, list[bytes]]:
+    """See estimator.estimate_throughput"""
+    heartbeats, queued_bases, in_flight = replies
+    return estimate_throughput(heartbeats, queued_bases, in_flight, time(), config['HEARTBEAT_TIMEOUT'])
+
+
+def queue_forget_workers(pipeline: Pipeline, workers: list[bytes]) -> None:
+    """Forgets workers that stopped sending heartbeats, including the job they were filtering."""
+    pipeline.hdel(WORKERS_KEY, *workers)
+    pipeline.hdel(WORK_IN_FLIGHT_KEY, *workers)
+
+
+def parse_finalization(reply: dict[bytes, bytes]) -> Optional[dict[str, str]]:
+    """See context_manager.get_finalization"""
+    if len(reply) == 0:
+        return None
+    return {key.decode('utf-8'): value.decode('utf-8') for key, value in reply.items()}
+
+
+def parse_saved_read_ids(reply: list[bytes]) -> list[str]:
+    return [read_id.decode('ascii') for read_id in reply]
+
+
+def queue_metrics(pipeline: Pipeline, names: list[str]) -> None:
+    """Replies with the histograms of the given names and the state of the queue and the workers, see parse_metrics."""
+    for name in names:
+        pipeline.hgetall(histogram_key(name))
+    pipeline.llen(WORK_READY_KEY)
+    pipeline.llen(WORK_ACTIVE_KEY)
+    pipeline.hgetall(BUSY_RATIO_KEY)
+    pipeline.hgetall(WORKERS_KEY)
+
+
+def parse_metrics(names: list[str], replies: list, throughput: Throughput) -> tuple[str, list[bytes]]:
+    """See context_manager.get_metrics
+    :return: The metrics and the workers whose busy ratio is to be forgotten."""
+    *histograms, queued_jobs, queued_contexts, busy, heartbeats = replies
+    ratio, gone = busy_ratio(busy, heartbeats)
+    return render(dict(zip(names, histograms)), [
+        ('queued_jobs', 'Jobs waiting for a filter worker', queued_jobs),
+        ('queued_contexts', 'Contexts with jobs waiting for a filter worker', queued_contexts),
+        ('pending_bases', 'Bases admitted but not yet filtered', throughput.backlog),
+        ('live_workers', 'Filter workers with a recent heartbeat', throughput.live_workers),
+        ('throughput_bases_per_second', 'Bases the live filter workers filter per second', throughput.bases_per_second),
+        ('worker_busy_ratio', 'Mean share of time the live filter workers spend filtering', ratio)]), gone
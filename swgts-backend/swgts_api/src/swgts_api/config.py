@@ -18,8 +18,40 @@ HANDS_OFF : bool = False
 
 # The count of base pairs aka bytes per context that are allowed to be in RAM at a time
 MAXIMUM_PENDING_BYTES: int = 300000
+# The maximum size of a (decompressed) request to the FASTQ endpoint
+MAXIMUM_FASTQ_REQUEST_BYTES: int = 64 * 1024 * 1024
 # How long after the last contact should a context be deleted?
 CONTEXT_TIMEOUT: int = 60
 
+# Closed contexts are finalized in background threads of the api, this many at a time per process
+FINALIZATION_THREADS: int = 2
+# How many saved reads are fetched from redis and written at once while finalizing
+FINALIZATION_BATCH_SIZE: int = 1000
+# The gzip compression level (1-9) of the saved reads
+FINALIZATION_COMPRESSION_LEVEL: int = 3
+# Seconds a client is asked to wait before asking again whether the finalization is done
+FINALIZATION_RETRY_AFTER: int = 1
+# A finalization that made no progress for this many seconds is taken to be abandoned (e.g. its api process restarted),
+# the next close request starts it over. Has to be less than CONTEXT_TIMEOUT, which is when the abandoned one expires
+FINALIZATION_STALE_AFTER: int = 30
+# Filter workers that did not report for this many seconds are no longer counted for the throughput of the server
+HEARTBEAT_TIMEOUT: int = 30
+# Seconds a client is asked to wait for the filter (Retry-After) while the throughput of the server is not known yet
+RETRY_AFTER_FALLBACK: int = 5
+# The upper bound of Retry-After, so that clients check back before a stall could clear
+MAXIMUM_RETRY_AFTER: int = 60
+# How often (seconds) each api process adds its latency histograms to the ones in redis, see /metrics
+METRICS_FLUSH_INTERVAL: int = 10
+# Profile every nth request with cProfile (0 disables profiling). The profiles of each process add up and are dumped to
+# PROFILE_DIRECTORY every minute, python -m swgts_filter.profiling merges them into a report
+PROFILE_EVERY_NTH_REQUEST: int = 0
+PROFILE_DIRECTORY: str = path.join(OUTPUT_DIRECTORY, 'profiles')
+# Where the filter spills kept reads if its SAVED_READS_STORAGE is FILES, has to be the same directory for both
+SPILL_DIRECTORY: str = '/spill'
+
 #docker name or hostname of the redis service
-REDIS_SERVER: str = 'redis'
\ No newline at end of file
+REDIS_SERVER: str = 'redis'
+REDIS_PORT: int = 6379
+#Only used by the ASGI application (async_app): The maximum number of redis connections per process, requests wait for
+#a free connection once all are in use
+REDIS_MAX_CONNECTIONS: int = 64
\ No newline at end of file
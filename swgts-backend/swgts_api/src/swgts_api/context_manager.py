@@ -1,24 +1,37 @@
 import logging
 import os
-from os import path
 from typing import Tuple, Optional, Any
 from uuid import UUID, uuid4
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from redis import Redis
+from redis.commands.core import Script
 from time import time
 import sys
-import pathlib
+
+from . import commands
+from .finalization import finalize_context, saved_reads_key, kept_ordinals_key, finalization_key
+from .estimator import Throughput, bases_ahead, estimate_wait
+from .metrics import HISTOGRAMS, HISTOGRAMS_KEY, BUSY_RATIO_KEY, timed
+from .scripts import ADMISSION_SCRIPT, CLAIM_FINALIZATION_SCRIPT, WORK_ACTIVE_KEY
 
 lo = logging.getLogger('Context Manager')
 lo.setLevel('INFO')
 
 redis_server: Optional[Redis] = None
+admission_script: Optional[Script] = None
+claim_finalization_script: Optional[Script] = None
+finalizer: Optional[ThreadPoolExecutor] = None
 CONFIG: Optional[dict[str, Any]] = None
 
 
 def setup_state_server(config: dict[str, Any]):
-    global CONFIG, redis_server
+    global CONFIG, redis_server, admission_script, claim_finalization_script, finalizer
     CONFIG = config
-    redis_server = Redis(host=config.get('REDIS_SERVER'))
+    redis_server = Redis(host=config.get('REDIS_SERVER'), port=config['REDIS_PORT'])
+    admission_script = redis_server.register_script(ADMISSION_SCRIPT)
+    claim_finalization_script = redis_server.register_script(CLAIM_FINALIZATION_SCRIPT)
+    finalizer = ThreadPoolExecutor(max_workers=config['FINALIZATION_THREADS'], thread_name_prefix='finalizer')
 
 def redis_ping() -> bool:
     return redis_server.ping()
@@ -28,8 +41,12 @@ def context_exists(context: UUID) -> bool:
     return redis_server.exists(f'context:{context}:pair_count') == 1
 
 
-def get_pair_count(context: UUID) -> int:
-    return int(redis_server.get(f'context:{context}:pair_count'))
+@lru_cache(maxsize=4096)
+def get_cached_pair_count(context: UUID) -> Optional[int]:
+    """The pair count of a context never changes, so it is only fetched once per process. None if there is no such
+    context (context ids are never reused, so this can be cached as well)."""
+    pair_count = redis_server.get(f'context:{context}:pair_count')
+    return None if pair_count is None else int(pair_count)
 
 
 def get_pending_bytes_count(context: UUID) -> int:
@@ -38,103 +55,108 @@ def get_pending_bytes_count(context: UUID) -> int:
 def get_processed_read_count(context: UUID) -> int:
     return int(redis_server.get(f'context:{context}:processed_reads'))
 
-def increase_processed_read_count(context: UUID, amount: int) -> int:
-    return int(redis_server.incrby(f'context:{context}:processed_reads', amount))
-
-def create_context(filenames: list[str]) -> UUID:
+@timed('api_redis_seconds', 'operation="create"')
+def create_context(filenames: list[str], ordinals: bool = False) -> UUID:
+    """:param ordinals: The client sends ordinals with its chunks, the saved reads are reported as a bitmap of them."""
     new_context_id = uuid4()
     pipeline = redis_server.pipeline()
-
-    pipeline.setex(f'context:{new_context_id}:pending_bytes', CONFIG['CONTEXT_TIMEOUT'], 0)
-    pipeline.setex(f'context:{new_context_id}:pair_count', CONFIG['CONTEXT_TIMEOUT'], len(filenames))
-    pipeline.setex(f'context:{new_context_id}:processed_reads', CONFIG['CONTEXT_TIMEOUT'], 0)
-
-    for pair_index, filename in enumerate(filenames):
-        #We save only the basename to avoid creating of directories etc.
-        pipeline.setex(f'context:{new_context_id}:pair:{pair_index}:filename', CONFIG['CONTEXT_TIMEOUT'], path.basename(filename))
-
+    commands.queue_create_context(pipeline, new_context_id, filenames, ordinals, CONFIG)
     pipeline.execute()
     return new_context_id
 
-def change_pending_bytes_count(context: UUID, diff: int) -> int:
-    now_pending = redis_server.incrby(f'context:{context}:pending_bytes', diff)
-    redis_server.expire(f'context:{context}:pending_bytes', CONFIG['CONTEXT_TIMEOUT'])
-    return int(now_pending)
-
-def enqueue_chunks(chunks : list[list[list[str]]], context_id:UUID, effective_cumulated_chunk_size:int, request_reception_time: float):
-    job_id = uuid4()
-    read_count : int = len(chunks)
-    if read_count == 0:
-        # Nothing to enqueue
-        lo.error(f'I won\'t enqueue an empty job.')
-        return
-    else:
-        lo.info(f'Enqueueueing {read_count} reads as job {job_id}.')
-    pair_count : int = len(chunks[0])
-
-    #TODO: Implement cleanup strategy for orphaned jobs
-    transaction = redis_server.pipeline(transaction=True)
-    transaction.lpush(f'work:{job_id}',f"{context_id}") #Implicit conversion to string
-    transaction.lpush(f'work:{job_id}',effective_cumulated_chunk_size)
-    transaction.lpush(f'work:{job_id}', read_count)  # Number of paired reads
-    transaction.lpush(f'work:{job_id}', pair_count)  # Pair Count
-    transaction.lpush(f'work:{job_id}', request_reception_time)  # Time Enqueue
-
-    for read_idx, reads in enumerate(chunks):
-        for pair_idx, read in enumerate(chunks[read_idx]):
-            for line in chunks[read_idx][pair_idx]:
-                transaction.lpush(f'work:{job_id}',line)
-    transaction.lpush(f'work:queue', f"{job_id}") #Implicit conversion to string
-    transaction.execute()
-
-def get_queue_speed(context: UUID) -> float:
-    last_speed_measurements = [float(x.decode()) for x in redis_server.lrange(f'context:{context}:speed',0,-1)]
-    if len(last_speed_measurements) == 0:
-        return 0
-    else:
-        return sum(last_speed_measurements) / len(last_speed_measurements)
-def close_context(context: UUID, hands_off: bool) -> Tuple[int, list[str]]:
-    # FIXME sanity check redis response
-    # FIXME redis-server-side CONTEXT_TIMEOUT may happen while writing
-    lo.info(f'Closing Context {context} ...')
-    starting_time = time()
-
-    context_output_folder = path.join(CONFIG['UPLOAD_DIRECTORY'], str(context))
-    if not hands_off:
-        os.makedirs(context_output_folder)
-
-    pair_count = int(redis_server.get(f'context:{context}:pair_count'))
-    redis_server.delete(f'context:{context}:pair_count')
-
-    saved_reads_ids = list(read.split(b'\n', 1)[0].decode('ascii') for read in redis_server.smembers(f'context:{context}:pair:{0}:reads'))
-
-    for pair_index in range(pair_count):
-        #redis_server.persist(f'context:{context}:pair:{pair_index}:filename')
-        #redis_server.persist(f'context:{context}:pair:{pair_index}:reads')
-
-        output_filename = redis_server.get(f'context:{context}:pair:{pair_index}:filename').decode('utf-8')
-        redis_server.delete(f'context:{context}:pair:{pair_index}:filename')
-
-        if not hands_off:
-            with open(pathlib.Path(path.join(context_output_folder, output_filename)).name, 'wb') as handle:
-                handle.write(b'\n'.join(redis_server.smembers(f'context:{context}:pair:{pair_index}:reads')))
-
-        redis_server.delete(f'context:{context}:pair:{pair_index}:reads')
-
-    processed_reads = int(redis_server.get(f'context:{context}:processed_reads'))
-    redis_server.delete(f'context:{context}:processed_reads')
-    redis_server.delete(f'context:{context}:pending_bytes')
-    redis_server.delete(f'context:{context}:speed')
-
-    finishing_time = time()
-    lo.info(f'Closed Context {context} in {finishing_time-starting_time} seconds')
-
-    return processed_reads, saved_reads_ids
+@timed('api_redis_seconds', 'operation="admission"')
+def admit_job(context: UUID, job: Optional[bytes], effective_cumulated_chunk_size: int, dropped_reads: int,
+              discarded_bases: int, first_ordinal: Optional[int] = None) -> Tuple[int, int, int]:
+    """Atomically checks the buffer of the context, reserves the pending bytes, refreshes the timeouts and enqueues the
+    job in a single round trip, see scripts.ADMISSION_SCRIPT.
+    :param job: The packed job, None if no read of the chunk needs filtering.
+    :param dropped_reads: Reads (pairs) of the chunk that are discarded without filtering.
+    :param discarded_bases: The bases of those reads.
+    :param first_ordinal: The ordinal of the first read of the chunk, chunks with an ordinal are only admitted once.
+    :return: The status (404, 413, 422 or 200 if admitted), the pending bytes and the processed reads."""
+    status, pending_bytes, processed_reads = admission_script(**commands.admission_arguments(
+        context, job, effective_cumulated_chunk_size, dropped_reads, discarded_bases, first_ordinal, CONFIG))
+    if status == 200 and job is not None:
+        lo.info(f'Enqueued a job of {effective_cumulated_chunk_size} bases for context {context}.')
+    return int(status), int(pending_bytes), int(processed_reads)
+
+def get_queue_depth(context: UUID) -> Tuple[int, int]:
+    """:return: The jobs of the context waiting for a filter worker and their bases."""
+    pipeline = redis_server.pipeline()
+    commands.queue_queue_depth(pipeline, context)
+    return commands.parse_queue_depth(pipeline.execute())
 
+def get_queued_context_count() -> int:
+    """The contexts with jobs waiting for a filter worker, they take turns."""
+    return int(redis_server.llen(WORK_ACTIVE_KEY))
 
-def get_saved_read_count(context: UUID) -> int:
-    # We assume that this context has at least 1 file.
-    return int(redis_server.scard(f'context:{context}:pair:0:reads'))
+@timed('api_redis_seconds', 'operation="throughput"')
+def get_throughput() -> Throughput:
+    """The throughput of all filter workers together and the bases waiting for them, see estimator. Workers that
+    stopped reporting are forgotten."""
+    pipeline = redis_server.pipeline()
+    commands.queue_throughput(pipeline)
+    throughput, stale = commands.parse_throughput(pipeline.execute(), CONFIG)
+    if len(stale) > 0:
+        pipeline = redis_server.pipeline()
+        commands.queue_forget_workers(pipeline, stale)
+        pipeline.execute()
+    return throughput
+
+def get_retry_after(bases: int, pending_bytes: int) -> float:
+    """Seconds until the given amount of the pending bases of a context is expected to be filtered, while the
+    queued contexts take turns (see estimator.bases_ahead).
+    :param pending_bytes: The pending bases of the context."""
+    throughput = get_throughput()
+    return estimate_wait(throughput, bases_ahead(bases, pending_bytes, throughput.backlog, get_queued_context_count()),
+                         CONFIG['RETRY_AFTER_FALLBACK'], CONFIG['MAXIMUM_RETRY_AFTER'])
+
+@timed('api_redis_seconds', 'operation="claim_finalization"')
+def claim_finalization(context: UUID) -> Tuple[int, int, str]:
+    """Closes the context for further chunks and claims its finalization, see scripts.CLAIM_FINALIZATION_SCRIPT.
+    :return: The status (404, 503, 201 if claimed now or 200 if claimed before), the pending bytes and the claim."""
+    claim = uuid4().hex
+    status, pending_bytes = claim_finalization_script(**commands.claim_finalization_arguments(context, claim, CONFIG))
+    return int(status), int(pending_bytes), claim
+
+def start_finalization(context: UUID, claim: str) -> None:
+    """Finalizes a claimed context in the background, see finalization.finalize_context.
+    :param claim: The claim returned by claim_finalization."""
+    lo.info(f'Closing Context {context} ...')
+    finalizer.submit(finalize_context, redis_server, context, claim, CONFIG)
+
+@timed('api_redis_seconds', 'operation="finalization"')
+def get_finalization(context: UUID) -> Optional[dict[str, str]]:
+    """The progress of the finalization of a context, None if it was never claimed (or timed out)."""
+    return commands.parse_finalization(redis_server.hgetall(finalization_key(context)))
+
+def get_saved_read_ids(context: UUID) -> list[str]:
+    return commands.parse_saved_read_ids(redis_server.lrange(saved_reads_key(context), 0, -1))
+
+def get_saved_bitmap(context: UUID) -> Optional[bytes]:
+    """The bitmap of the ordinals of the saved reads (bit i is the (i % 8)-th most significant bit of byte i // 8),
+    None if the client of the context does not send ordinals."""
+    return redis_server.get(kept_ordinals_key(context))
+
+
+def flush_metrics() -> None:
+    """Adds the observations of this process to the histograms in redis, at most every METRICS_FLUSH_INTERVAL
+    seconds."""
+    if HISTOGRAMS.due(CONFIG['METRICS_FLUSH_INTERVAL']):
+        pipeline = redis_server.pipeline(transaction=False)
+        HISTOGRAMS.flush(pipeline)
+        pipeline.execute()
+
+def get_metrics() -> str:
+    """The histograms of all api and filter processes and the state of the queue, in the Prometheus text format."""
+    throughput = get_throughput()
+    names = [name.decode('utf-8') for name in redis_server.smembers(HISTOGRAMS_KEY)]
+    pipeline = redis_server.pipeline()
+    commands.queue_metrics(pipeline, names)
+    metrics, gone = commands.parse_metrics(names, pipeline.execute(), throughput)
+    if len(gone) > 0:
+        redis_server.hdel(BUSY_RATIO_KEY, *gone)
+    return metrics
 
 def share_timeout(timeout: int) -> None:
     if not redis_server.set('config:expiry', timeout):
@@ -142,6 +164,3 @@ def share_timeout(timeout: int) -> None:
         sys.exit(-2)
     else:
         lo.info('Wrote timeout config value into redis')
-
-def increment_processed_bases(bases: int) -> None:
-    redis_server.incrby('stats:bases', bases)
\ No newline at end of file
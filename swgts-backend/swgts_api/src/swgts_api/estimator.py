@@ -0,0 +1,62 @@
+# coding=utf-8
+from typing import NamedTuple
+
+# Server-wide throughput estimation, shared by context_manager and async_context_manager. The filter workers keep an
+# exponentially weighted moving average of the bases they filter per second and publish it with a heartbeat in the
+# redis hash WORKERS_KEY (field: worker name, value: "<bases per second> <unix time>"). The bases admitted but not yet
+# filtered by all contexts are the queued bases (scripts.WORK_BASES_KEY) and the bases of the jobs the live workers are
+# filtering (WORK_IN_FLIGHT_KEY), both kept by the scripts that enqueue and dequeue jobs. A worker that dies with a job
+# stops sending heartbeats, so its job is no longer counted.
+
+WORKERS_KEY: str = 'stats:workers'
+# The bases of the job every worker is filtering (field: worker name), mirrored in swgts_filter.server.scheduler
+WORK_IN_FLIGHT_KEY: str = 'work:in_flight'
+
+
+class Throughput(NamedTuple):
+    # Bases per second of all live workers together, 0 if unknown
+    bases_per_second: float
+    live_workers: int
+    # Bases admitted but not yet filtered, in all contexts
+    backlog: int
+
+
+def estimate_throughput(heartbeats: dict[bytes, bytes], queued_bases: list[bytes], in_flight: dict[bytes, bytes],
+                        now: float, heartbeat_timeout: float) -> tuple[Throughput, list[bytes]]:
+    """Sums up the rates of the workers that sent a heartbeat within heartbeat_timeout seconds. Workers that did not
+    filter anything yet are assumed to be as fast as the others.
+    :param queued_bases: The queued bases of every context.
+    :param in_flight: The bases every worker is filtering.
+    :return: The estimate and the workers whose heartbeat is too old."""
+    rates: list[float] = []
+    live_workers: int = 0
+    backlog: int = sum(map(int, queued_bases))
+    stale: list[bytes] = []
+    for worker, heartbeat in heartbeats.items():
+        rate, timestamp = heartbeat.split(b' ')
+        if now - float(timestamp) > heartbeat_timeout:
+            stale.append(worker)
+            continue
+        live_workers += 1
+        backlog += int(in_flight.get(worker, 0))
+        if float(rate) > 0:
+            rates.append(float(rate))
+    bases_per_second = 0 if len(rates) == 0 else sum(rates) / len(rates) * live_workers
+    return Throughput(bases_per_second, live_workers, max(backlog, 0)), stale
+
+
+def bases_ahead(bases: int, pending_bytes: int, backlog: int, queued_contexts: int) -> int:
+    """The bases the workers filter until the given amount of the pending bases of a context is filtered. The queued
+    contexts take turns (see swgts_api.scripts), so the context gets about an equal share of the throughput, but never
+    waits for more than the whole backlog.
+    :param pending_bytes: The pending bases of the context."""
+    return max(min(bases * max(queued_contexts, 1), backlog - pending_bytes + bases), bases)
+
+
+def estimate_wait(throughput: Throughput, bases: int, fallback: float, maximum: float) -> float:
+    """Estimates how long it takes until the given amount of bases is filtered.
+    :param fallback: The estimate if the throughput is unknown.
+    :param maximum: The upper bound of the estimate, clients should check back before a stall could clear."""
+    if throughput.bases_per_second <= 0:
+        return fallback
+    return round(min(max(bases, 0) / throughput.bases_per_second, maximum), 3)
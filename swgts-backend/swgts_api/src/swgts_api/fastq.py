@@ -0,0 +1,60 @@
+# coding=utf-8
+import zlib
+
+GZIP_MAGIC: bytes = b'\x1f\x8b'
+
+
+class PayloadTooLarge(ValueError):
+    pass
+
+
+def gunzip(data: bytes, limit: int) -> bytes:
+    """Decompresses (possibly multi-member) gzip data.
+    :raises PayloadTooLarge: If the data is larger than limit bytes or decompresses to more than limit bytes.
+    :raises ValueError: If the data is not valid gzip."""
+    if len(data) > limit:
+        raise PayloadTooLarge(f'The request is larger than {limit} bytes.')
+    members = []
+    size = 0
+    while len(data) > 0:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            member = decompressor.decompress(data, limit - size + 1)
+        except zlib.error as e:
+            raise ValueError(f'The gzip data is broken ({e}).')
+        size += len(member)
+        if size > limit:
+            raise PayloadTooLarge(f'The request decompresses to more than {limit} bytes.')
+        if not decompressor.eof:
+            raise ValueError('The gzip data is truncated.')
+        members.append(member)
+        data = decompressor.unused_data
+    return b''.join(members)
+
+
+def parse_fastq(data: bytes, limit: int) -> list[list[bytes]]:
+    """Splits FASTQ data into records of 4 lines. The data is split in one go and the record structure is checked
+    on the whole columns of header, plus and quality lines instead of record by record.
+    :raises PayloadTooLarge: If the data is larger than limit bytes.
+    :raises ValueError: If the data is not well-formed FASTQ."""
+    if len(data) > limit:
+        raise PayloadTooLarge(f'The request is larger than {limit} bytes.')
+    if data.startswith(GZIP_MAGIC):
+        raise ValueError('The FASTQ data is still compressed.')
+    if b'\r' in data:
+        data = data.replace(b'\r\n', b'\n')
+    lines = data.split(b'\n')
+    # A trailing newline is optional
+    if len(lines[-1]) == 0:
+        lines.pop()
+    if len(lines) % 4 != 0:
+        raise ValueError(f'The FASTQ data has {len(lines)} lines, which is not a multiple of 4.')
+
+    headers, sequences, pluses, qualities = lines[0::4], lines[1::4], lines[2::4], lines[3::4]
+    if not all(header.startswith(b'@') for header in headers):
+        raise ValueError('There is a FASTQ record whose header does not start with @.')
+    if not all(plus.startswith(b'+') for plus in pluses):
+        raise ValueError('There is a FASTQ record whose third line does not start with +.')
+    if list(map(len, sequences)) != list(map(len, qualities)):
+        raise ValueError('There is a FASTQ record whose sequence and quality differ in length.')
+    return [list(record) for record in zip(headers, sequences, pluses, qualities)]
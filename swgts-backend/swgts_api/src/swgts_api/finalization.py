@@ -0,0 +1,266 @@
+# coding=utf-8
+import gzip
+import logging
+import os
+import shutil
+import zlib
+from base64 import b64encode
+from os import path, makedirs
+from queue import Queue
+from threading import Thread
+from time import time
+from typing import Any, Callable, Iterator, Optional
+from uuid import UUID
+
+from redis import Redis, WatchError
+from redis.client import Pipeline
+
+from .metrics import HISTOGRAMS
+
+# Finalization of closed contexts, shared by context_manager and async_context_manager. It runs in the background of
+# the api process and streams the saved reads out of redis batch by batch (or appends the segment files the filter
+# spilled them to), so the memory of the api stays flat regardless of the sample size. Its progress is kept in redis
+# (see finalization_key), so every api process can answer for it, and if the process finalizing a context goes away,
+# the next close request claims the finalization again (see scripts.CLAIM_FINALIZATION_SCRIPT).
+
+lo = logging.getLogger('Finalization')
+lo.setLevel('INFO')
+
+# Batches a pair writer may buffer before the finalization waits for it
+WRITER_QUEUE_LENGTH: int = 2
+
+
+def finalization_key(context: UUID) -> str:
+    """The hash holding the progress of the finalization: state (running, done or failed), pair count, written reads,
+    total (the processed reads, once done), started and updated (timestamps of the claim and the last progress) and
+    claim (the token of the finalization that may record progress)."""
+    return f'context:{context}:finalization'
+
+
+def saved_reads_key(context: UUID) -> str:
+    """The list of the ids of the saved reads (headers of the first mates), filled while finalizing."""
+    return f'context:{context}:saved'
+
+
+def kept_ordinals_key(context: UUID) -> str:
+    """The bitmap of the ordinals of the saved reads, only for contexts whose client sends ordinals. It replaces the
+    list of ids of the saved reads."""
+    return f'context:{context}:kept'
+
+
+def encode_saved_bitmap(bitmap: bytes) -> str:
+    """The bitmap of saved ordinals as sent to clients: zlib-compressed and base64-encoded. Runs of reads that were
+    all kept or all discarded compress well, so this stays small even for large samples."""
+    return b64encode(zlib.compress(bitmap)).decode('ascii')
+
+
+def output_filename(filename: str) -> str:
+    """The saved reads are always written gzip-compressed."""
+    basename = path.basename(filename)
+    return basename if basename.endswith('.gz') else f'{basename}.gz'
+
+
+def segment_path(spill_directory: str, context: UUID, segment: str, pair_index: int) -> str:
+    """Where the filter spills kept reads (SAVED_READS_STORAGE = 'FILES'), see swgts_filter.server.spill"""
+    return path.join(spill_directory, str(context), f'{segment}.{pair_index}.gz')
+
+
+class _PairWriter(Thread):
+    """Compresses and writes the reads of one file of the pairs, so all files of a context are written concurrently.
+    Every batch becomes a gzip member of its own and segments are already gzip-compressed, so they are appended as
+    they are. The queue is bounded, so a slow writer throttles the finalization instead of piling up reads in
+    memory."""
+
+    def __init__(self, output_path: str, compression_level: int):
+        super().__init__(daemon=True)
+        self.output_path = output_path
+        self.compression_level = compression_level
+        self.batches: Queue = Queue(maxsize=WRITER_QUEUE_LENGTH)
+        self.error: Optional[Exception] = None
+
+    def run(self) -> None:
+        try:
+            with open(self.output_path, 'wb') as handle:
+                while (batch := self.batches.get()) is not None:
+                    if isinstance(batch, str):
+                        with open(batch, 'rb') as segment:
+                            shutil.copyfileobj(segment, handle)
+                    else:
+                        handle.write(gzip.compress(b''.join(read + b'\n' for read in batch if read is not None),
+                                                   compresslevel=self.compression_level))
+        except Exception as e:
+            self.error = e
+            # Keep consuming, the finalization must not block on a full queue
+            while self.batches.get() is not None:
+                pass
+
+    def finish(self) -> None:
+        self.batches.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def _segment_read_ids(segment: str) -> Iterator[bytes]:
+    """The headers of the reads in a segment of the first mates"""
+    with gzip.open(segment, 'rb') as handle:
+        for line_index, line in enumerate(handle):
+            if line_index % 4 == 0:
+                yield line.rstrip(b'\n')
+
+
+class FinalizationLost(Exception):
+    """The finalization was claimed again in the meantime, see scripts.CLAIM_FINALIZATION_SCRIPT"""
+
+
+def _remove(paths: list[str]) -> None:
+    for file_path in paths:
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+
+def _update_claimed(redis_server: Redis, context: UUID, claim: str, update: Callable[[Pipeline], Any]) -> None:
+    """Runs the commands update queues on a pipeline as a transaction, unless the finalization was claimed again.
+    :raises FinalizationLost: If it was, nothing is changed then."""
+    status_key = finalization_key(context)
+    with redis_server.pipeline() as pipeline:
+        try:
+            pipeline.watch(status_key)
+            if pipeline.hget(status_key, 'claim') != claim.encode():
+                raise FinalizationLost()
+            pipeline.multi()
+            update(pipeline)
+            pipeline.execute()
+        except WatchError:
+            raise FinalizationLost()
+
+
+def _save_read_ids(redis_server: Redis, context: UUID, claim: str, read_ids: list[bytes], timeout: int,
+                   ordinals: bool) -> None:
+    """Adds a batch of saved reads to the result and keeps the context from timing out while it is finalized.
+    :param ordinals: If the saved reads are already known from their ordinals, only the progress is updated."""
+    if len(read_ids) == 0:
+        return
+
+    def update(pipeline: Pipeline) -> None:
+        if not ordinals:
+            pipeline.rpush(saved_reads_key(context), *read_ids)
+        pipeline.hincrby(finalization_key(context), 'written reads', len(read_ids))
+        pipeline.hset(finalization_key(context), 'updated', time())
+        for key in [finalization_key(context), saved_reads_key(context), kept_ordinals_key(context),
+                    f'context:{context}:processed_reads', f'context:{context}:segments']:
+            pipeline.expire(key, timeout)
+
+    _update_claimed(redis_server, context, claim, update)
+
+
+def finalize_context(redis_server: Redis, context: UUID, claim: str, config: dict[str, Any]) -> None:
+    """Writes the saved reads of a claimed context (see scripts.CLAIM_FINALIZATION_SCRIPT) to the upload directory
+    and collects the ids of the saved reads (unless they are known by their ordinals). Afterwards, the reads are deleted from redis and the finalization is
+    marked as done. Any error marks it as failed instead. If the finalization is claimed again in the meantime, it stops
+    and leaves everything to the new claim.
+    :param redis_server: A synchronous redis client, this is meant to run in a background thread.
+    :param claim: The token the finalization was claimed with."""
+    lo.info(f'Finalizing Context {context} ...')
+    starting_time = time()
+    timeout: int = config['CONTEXT_TIMEOUT']
+    status_key = finalization_key(context)
+    saved_key = saved_reads_key(context)
+    part_paths: list[str] = []
+
+    try:
+        pair_count = int(redis_server.hget(status_key, 'pair count'))
+        ordinals = redis_server.exists(kept_ordinals_key(context)) == 1
+        reads_keys = [f'context:{context}:pair:{pair_index}:reads' for pair_index in range(pair_count)]
+        filename_keys = [f'context:{context}:pair:{pair_index}:filename' for pair_index in range(pair_count)]
+
+        output_paths: list[str] = []
+        if not config['HANDS_OFF']:
+            context_output_folder = path.join(config['UPLOAD_DIRECTORY'], str(context))
+            makedirs(context_output_folder, exist_ok=True)
+            output_paths = [path.join(context_output_folder, output_filename(filename.decode('utf-8')))
+                            for filename in redis_server.mget(filename_keys)]
+        # Every claim writes files of its own, an abandoned finalization may still be writing to the files of its claim
+        part_paths = [f'{output_path}.{claim}.part' for output_path in output_paths]
+        writers = [_PairWriter(part_path, config['FINALIZATION_COMPRESSION_LEVEL']) for part_path in part_paths]
+        for writer in writers:
+            writer.start()
+
+        try:
+            # The mates of a pair share a field in the hashes of all files (its ordinal or a unique id, see
+            # swgts_filter.server), so the mates of a batch of first mates can be fetched directly and all files are
+            # written in the same order
+            cursor: int = 0
+            while True:
+                cursor, first_mates = redis_server.hscan(reads_keys[0], cursor, count=config['FINALIZATION_BATCH_SIZE'])
+                if len(first_mates) > 0:
+                    fields = list(first_mates.keys())
+                    records = list(first_mates.values())
+                    if len(writers) > 0:
+                        writers[0].batches.put(records)
+                        for writer, reads_key in zip(writers[1:], reads_keys[1:]):
+                            writer.batches.put(redis_server.hmget(reads_key, fields))
+                    # The id of a read is the header of its first mate
+                    read_ids = [record.split(b'\n', 1)[0] for record in records]
+
+                    _save_read_ids(redis_server, context, claim, read_ids, timeout, ordinals)
+                if cursor == 0:
+                    break
+
+            # Reads spilled by the filter, their segments are appended to the output as they are
+            segments_key = f'context:{context}:segments'
+            for first_segment in range(0, redis_server.llen(segments_key), config['FINALIZATION_BATCH_SIZE']):
+                for segment in redis_server.lrange(segments_key, first_segment,
+                                                   first_segment + config['FINALIZATION_BATCH_SIZE'] - 1):
+                    segment = segment.decode('ascii')
+                    for pair_index, writer in enumerate(writers):
+                        writer.batches.put(segment_path(config['SPILL_DIRECTORY'], context, segment, pair_index))
+                    read_ids: list[bytes] = []
+                    for read_id in _segment_read_ids(segment_path(config['SPILL_DIRECTORY'], context, segment, 0)):
+                        read_ids.append(read_id)
+                        if len(read_ids) == config['FINALIZATION_BATCH_SIZE']:
+                            _save_read_ids(redis_server, context, claim, read_ids, timeout, ordinals)
+                            read_ids = []
+                    _save_read_ids(redis_server, context, claim, read_ids, timeout, ordinals)
+        finally:
+            for writer in writers:
+                writer.finish()
+        for part_path, output_path in zip(part_paths, output_paths):
+            os.replace(part_path, output_path)
+
+        total = int(redis_server.get(f'context:{context}:processed_reads') or 0)
+
+        def done(pipeline: Pipeline) -> None:
+            pipeline.hset(status_key, mapping={'state': 'done', 'total': total})
+            pipeline.expire(status_key, timeout)
+            pipeline.expire(saved_key, timeout)
+            pipeline.expire(kept_ordinals_key(context), timeout)
+            pipeline.delete(*reads_keys, *filename_keys, f'context:{context}:processed_reads',
+                            f'context:{context}:pending_bytes', segments_key,
+                            f'context:{context}:admitted')
+
+        _update_claimed(redis_server, context, claim, done)
+        shutil.rmtree(path.join(config['SPILL_DIRECTORY'], str(context)), ignore_errors=True)
+    except FinalizationLost:
+        lo.warning(f'The finalization of context {context} was claimed again, leaving it to the new claim.')
+        _remove(part_paths)
+        return
+    except Exception:
+        lo.exception(f'Could not finalize context {context}.')
+        _remove(part_paths)
+
+        def failed(pipeline: Pipeline) -> None:
+            pipeline.hset(status_key, 'state', 'failed')
+            pipeline.expire(status_key, timeout)
+
+        try:
+            _update_claimed(redis_server, context, claim, failed)
+        except FinalizationLost:
+            pass
+        return
+
+    finishing_time = time()
+    HISTOGRAMS.observe('finalization_seconds', finishing_time - starting_time)
+    lo.info(f'Finalized Context {context} in {finishing_time-starting_time} seconds')
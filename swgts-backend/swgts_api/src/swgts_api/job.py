@@ -0,0 +1,28 @@
+# coding=utf-8
+import struct
+from typing import Optional, Union
+from uuid import UUID
+
+# Jobs are handed to the filter workers as a single binary value. The layout is mirrored in swgts_filter.server.job and
+# needs to be changed in both places (bump JOB_VERSION when doing so):
+#   header   : magic, version, context uuid, effective cumulated chunk size, reception time, read count, pair count
+#   ordinals : only in version 2, one unsigned 64 bit client-assigned ordinal for every read
+#   lengths  : one unsigned 32 bit length for every line (read count * pair count * 4 lines)
+#   payload  : the concatenated lines without separators
+# Jobs without ordinals are still written as version 1.
+JOB_MAGIC: bytes = b'SWJB'
+JOB_VERSION: int = 2
+_JOB_HEADER = struct.Struct('<4sB16sQdIH')
+
+
+def pack_job(chunk: list[list[list[Union[str, bytes]]]], context_id: UUID, effective_cumulated_chunk_size: int,
+             request_reception_time: float, ordinals: Optional[list[int]] = None) -> bytes:
+    """Encodes a chunk of (paired) reads into a single job value.
+    :param chunk: For each read index, for each file the 4 lines making up one read (as str or bytes).
+    :param ordinals: The ordinals the client assigned to the reads of the chunk, if any."""
+    lines = [line if isinstance(line, bytes) else line.encode() for pair in chunk for read in pair for line in read]
+    header = _JOB_HEADER.pack(JOB_MAGIC, 1 if ordinals is None else JOB_VERSION, context_id.bytes,
+                              effective_cumulated_chunk_size, request_reception_time, len(chunk), len(chunk[0]))
+    packed_ordinals = b'' if ordinals is None else struct.pack(f'<{len(ordinals)}Q', *ordinals)
+    lengths = struct.pack(f'<{len(lines)}I', *map(len, lines))
+    return b''.join((header, packed_ordinals, lengths, *lines))
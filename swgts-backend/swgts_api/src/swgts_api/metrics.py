@@ -0,0 +1,145 @@
+# coding=utf-8
+import functools
+import inspect
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter, time
+from typing import Any, Callable, Iterable, Optional
+
+# Latency histograms of the api and the filter (see swgts_filter.server.metrics for its copy of the recording side, the
+# keys, the buckets and Histograms need to be changed in both places).
+# Every process records observations in memory and adds them to redis every METRICS_FLUSH_INTERVAL seconds, so the
+# histograms of all api and filter processes add up in redis and any api process can serve them (see render).
+# Layout: the set HISTOGRAMS_KEY holds the names of the histograms, the hash histogram_key(name) holds the count of
+# every bucket ("<labels>|<upper bound>"), the sum ("<labels>|sum") and the count ("<labels>|count") of each series.
+
+HISTOGRAMS_KEY: str = 'metrics:histograms'
+# The share of the time each filter worker was busy, by worker, see swgts_filter.server.metrics
+BUSY_RATIO_KEY: str = 'metrics:busy'
+PREFIX: str = 'swgts_'
+
+# Upper bounds of the buckets for durations in seconds
+SECONDS_BUCKETS: tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                                      30, 60, 300)
+# Upper bounds of the buckets for durations per read or base
+SECONDS_PER_UNIT_BUCKETS: tuple[float, ...] = (1e-8, 1e-7, 1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1)
+
+
+def histogram_key(name: str) -> str:
+    return f'metrics:histogram:{name}'
+
+
+class Histograms:
+    """The observations of a process since the last flush. Thread-safe."""
+
+    def __init__(self) -> None:
+        self.lock: Lock = Lock()
+        # (name, labels) -> counts per bucket (the last one is +Inf), sum
+        self.series: dict[tuple[str, str], tuple[list[int], list[float]]] = {}
+        self.buckets: dict[str, tuple[float, ...]] = {}
+        self.last_flush: float = time()
+
+    def observe(self, name: str, value: float, labels: str = '',
+                buckets: tuple[float, ...] = SECONDS_BUCKETS) -> None:
+        """:param labels: Prometheus labels of the series, e.g. 'route="/server-status"'."""
+        with self.lock:
+            self.buckets.setdefault(name, buckets)
+            counts, total = self.series.setdefault((name, labels), ([0] * (len(buckets) + 1), [0.0]))
+            counts[bisect_left(buckets, value)] += 1
+            total[0] += value
+
+    def due(self, interval: float) -> bool:
+        return time() - self.last_flush >= interval
+
+    def flush(self, pipeline: Any) -> None:
+        """Queues the observations since the last flush on a (sync or async) redis pipeline, the caller executes it."""
+        with self.lock:
+            series, self.series = self.series, {}
+            self.last_flush = time()
+        for (name, labels), (counts, total) in series.items():
+            key = histogram_key(name)
+            pipeline.sadd(HISTOGRAMS_KEY, name)
+            for bound, count in zip(self.buckets[name] + (float('inf'),), counts):
+                if count > 0:
+                    pipeline.hincrby(key, f'{labels}|{bound:g}', count)
+            pipeline.hincrbyfloat(key, f'{labels}|sum', total[0])
+            pipeline.hincrby(key, f'{labels}|count', sum(counts))
+
+
+HISTOGRAMS: Histograms = Histograms()
+
+
+def timed(name: str, labels: str = '') -> Callable:
+    """Records the duration of every call of the decorated (sync or async) function in HISTOGRAMS."""
+    def decorator(function: Callable) -> Callable:
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    HISTOGRAMS.observe(name, perf_counter() - start, labels)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                HISTOGRAMS.observe(name, perf_counter() - start, labels)
+        return wrapper
+    return decorator
+
+
+def busy_ratio(busy: dict[bytes, bytes], heartbeats: dict[bytes, bytes]) -> tuple[Optional[float], list[bytes]]:
+    """The mean busy ratio of the live workers (those with a heartbeat, see estimator).
+    :return: The ratio (None without live workers) and the workers that are gone."""
+    ratios = [float(ratio) for worker, ratio in busy.items() if worker in heartbeats]
+    return sum(ratios) / len(ratios) if len(ratios) > 0 else None, [worker for worker in busy if worker not in heartbeats]
+
+
+def _series(labels: str, extra: str) -> str:
+    labels = ','.join(label for label in (labels, extra) if label)
+    return f'{{{labels}}}' if labels else ''
+
+
+def render(histograms: dict[str, dict[bytes, bytes]], gauges: Iterable[tuple[str, str, Optional[float]]]) -> str:
+    """Renders the histograms from redis and some gauges in the Prometheus text format.
+    :param histograms: The contents of histogram_key(name) by name.
+    :param gauges: (name, help, value) of every gauge, gauges without a value are left out."""
+    lines: list[str] = []
+    for name, help_text, value in gauges:
+        if value is None:
+            continue
+        lines += [f'# HELP {PREFIX}{name} {help_text}', f'# TYPE {PREFIX}{name} gauge', f'{PREFIX}{name} {value:g}']
+
+    for name in sorted(histograms):
+        # labels -> (upper bound -> count, sum, count)
+        series: dict[str, tuple[dict[float, int], list[float]]] = {}
+        for field, value in histograms[name].items():
+            labels, bound = field.decode('utf-8').rsplit('|', 1)
+            buckets, totals = series.setdefault(labels, ({}, [0.0, 0]))
+            if bound == 'sum':
+                totals[0] = float(value)
+            elif bound == 'count':
+                totals[1] = int(value)
+            else:
+                buckets[float(bound)] = int(value)
+
+        # Only buckets with observations are stored, every series gets the buckets of all of them
+        bounds = sorted({bound for buckets, _ in series.values() for bound in buckets} - {float('inf')})
+        lines.append(f'# TYPE {PREFIX}{name} histogram')
+        for labels in sorted(series):
+            buckets, (total, count) = series[labels]
+            cumulative = 0
+            for bound in bounds:
+                cumulative += buckets.get(bound, 0)
+                le = f'le="{bound:g}"'
+                lines.append(f'{PREFIX}{name}_bucket{_series(labels, le)} {cumulative}')
+            le = 'le="+Inf"'
+            lines.append(f'{PREFIX}{name}_bucket{_series(labels, le)} {count}')
+            lines.append(f'{PREFIX}{name}_sum{_series(labels, "")} {total:g}')
+            lines.append(f'{PREFIX}{name}_count{_series(labels, "")} {count}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,74 @@
+# coding=utf-8
+import cProfile
+import os
+import pstats
+from itertools import count
+from socket import gethostname
+from threading import Lock
+from time import time
+from typing import Optional
+
+# Sampled profiling of api requests, a copy of swgts_filter.profiling (the api does not depend on the filter). Every nth
+# request is profiled with cProfile, the profiles of a process add up and are dumped to one file per process from time
+# to time. Run python -m swgts_filter.profiling on the dumps for a report of the hot paths.
+
+
+class SamplingProfiler:
+    """Profiles every nth section of code (a job or a request) and accumulates the profiles of this process. Only one
+    section per process is profiled at a time, as cProfile can not profile several threads at once on all python
+    versions; sections that come up while another is profiled are skipped."""
+
+    def __init__(self, every_nth: int, directory: str, name: str, dump_interval: float = 60):
+        """:param every_nth: 0 disables profiling.
+        :param name: The prefix of the dump files, followed by host and process id."""
+        self.every_nth = every_nth
+        self.directory = directory
+        self.name = name
+        self.dump_interval = dump_interval
+        self.counter = count()
+        self.lock: Lock = Lock()
+        self.stats: Optional[pstats.Stats] = None
+        self.last_dump: float = time()
+
+    def start(self) -> Optional[cProfile.Profile]:
+        """:return: The running profile if this section is sampled, to be passed to stop."""
+        if self.every_nth <= 0 or next(self.counter) % self.every_nth != 0:
+            return None
+        if not self.lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is active, e.g. someone is debugging
+            self.lock.release()
+            return None
+        return profile
+
+    def stop(self, profile: Optional[cProfile.Profile]) -> None:
+        if profile is None:
+            return
+        profile.disable()
+        try:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            if time() - self.last_dump >= self.dump_interval:
+                self._dump()
+        finally:
+            self.lock.release()
+
+    def dump(self) -> None:
+        """Writes the profiles accumulated so far, replacing the previous dump of this process."""
+        with self.lock:
+            self._dump()
+
+    def _dump(self) -> None:
+        self.last_dump = time()
+        if self.stats is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        dump_path = os.path.join(self.directory, f'{self.name}-{gethostname()}-{os.getpid()}.prof')
+        self.stats.dump_stats(f'{dump_path}.part')
+        os.replace(f'{dump_path}.part', dump_path)
@@ -0,0 +1,114 @@
+# coding=utf-8
+from uuid import UUID
+
+# Server-side redis scripts, shared by context_manager and async_context_manager.
+
+# The filter work queue is fair between contexts: every context has a queue of its own jobs (and their sizes in
+# bases), the contexts with queued jobs take turns in WORK_ACTIVE_KEY and the filter workers serve them by deficit round
+# robin weighted by bases (see swgts_filter.server.scheduler). Every enqueued job pushes a token to WORK_READY_KEY, which
+# idle workers block on.
+WORK_ACTIVE_KEY: str = 'work:active'
+WORK_READY_KEY: str = 'work:ready'
+# The queued bases per context
+WORK_BASES_KEY: str = 'work:bases'
+
+
+def work_queue_key(context: UUID) -> str:
+    return f'work:queue:{context}'
+
+
+def work_sizes_key(context: UUID) -> str:
+    return f'work:sizes:{context}'
+
+
+# Admits a chunk into the buffer of a context in a single round trip. Checking and reserving the pending bytes happen
+# atomically, so concurrent requests of the same context can not overshoot MAXIMUM_PENDING_BYTES together.
+# Chunks carrying a first ordinal are admitted at most once, so clients can safely resend a chunk whose response they
+# did not get.
+# KEYS: pair_count, pending_bytes, processed_reads, work queue of the context, stats:bases, admitted first ordinals,
+#       job sizes of the context, WORK_ACTIVE_KEY, WORK_BASES_KEY, WORK_READY_KEY
+# ARGV: effective cumulated chunk size, maximum pending bytes, context timeout, reads dropped for being too long,
+#       bases of those reads, job (empty if there is nothing to filter), first ordinal (empty if the client sends none),
+#       context id
+# Returns {status, pending bytes, processed reads} where status is 404 (no such context), 413 (chunk larger than the
+# buffer), 422 (buffer full) or 200 (admitted and enqueued, or admitted before). Nothing is changed unless the chunk
+# is admitted now.
+ADMISSION_SCRIPT: str = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {404, 0, 0}
+end
+local pending = tonumber(redis.call('GET', KEYS[2]) or '0')
+local processed = tonumber(redis.call('GET', KEYS[3]) or '0')
+if ARGV[7] ~= '' and redis.call('SISMEMBER', KEYS[6], ARGV[7]) == 1 then
+    return {200, pending, processed}
+end
+local size = tonumber(ARGV[1])
+local maximum = tonumber(ARGV[2])
+if size > maximum then
+    return {413, pending, processed}
+end
+if pending + size > maximum then
+    return {422, pending, processed}
+end
+
+pending = redis.call('INCRBY', KEYS[2], size)
+processed = redis.call('INCRBY', KEYS[3], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+redis.call('EXPIRE', KEYS[3], ARGV[3])
+if ARGV[7] ~= '' then
+    redis.call('SADD', KEYS[6], ARGV[7])
+    redis.call('EXPIRE', KEYS[6], ARGV[3])
+end
+if tonumber(ARGV[5]) > 0 then
+    redis.call('INCRBY', KEYS[5], ARGV[5])
+end
+if ARGV[6] ~= '' then
+    if redis.call('LLEN', KEYS[4]) == 0 then
+        redis.call('RPUSH', KEYS[8], ARGV[8])
+    end
+    redis.call('LPUSH', KEYS[4], ARGV[6])
+    redis.call('LPUSH', KEYS[7], size)
+    redis.call('HINCRBY', KEYS[9], ARGV[8], size)
+    redis.call('LPUSH', KEYS[10], 1)
+end
+return {200, pending, processed}
+"""
+
+# Claims the finalization of a context once all of its reads are filtered. Removing the pair count closes the context
+# for further chunks, so exactly one close request starts the finalization. A running finalization that made no
+# progress for a while is taken to be abandoned (e.g. its api process restarted) and is claimed again, it then starts
+# over from the beginning. Only the finalization holding the current claim may record progress, see
+# finalization.finalize_context.
+# KEYS: pair_count, pending_bytes, finalization, saved read ids
+# ARGV: context timeout, current time, claim (a unique token of the caller), seconds without progress after which a
+#       running finalization is abandoned
+# Returns {status, pending bytes} where status is 404 (no such context), 503 (reads still pending), 201 (claimed, the
+# caller has to start the finalization) or 200 (the finalization was claimed before).
+CLAIM_FINALIZATION_SCRIPT: str = """
+local state = redis.call('HGET', KEYS[3], 'state')
+if state then
+    local updated = tonumber(redis.call('HGET', KEYS[3], 'updated') or redis.call('HGET', KEYS[3], 'started'))
+    if state ~= 'running' or tonumber(ARGV[2]) - updated <= tonumber(ARGV[4]) then
+        return {200, 0}
+    end
+    redis.call('HSET', KEYS[3], 'written reads', 0, 'started', ARGV[2], 'updated', ARGV[2], 'claim', ARGV[3])
+    redis.call('EXPIRE', KEYS[3], ARGV[1])
+    redis.call('DEL', KEYS[4])
+    return {201, 0}
+end
+local pair_count = redis.call('GET', KEYS[1])
+if not pair_count then
+    return {404, 0}
+end
+local pending = tonumber(redis.call('GET', KEYS[2]) or '0')
+if pending ~= 0 then
+    return {503, pending}
+end
+
+redis.call('HSET', KEYS[3], 'state', 'running', 'pair count', pair_count, 'written reads', 0, 'started', ARGV[2],
+           'updated', ARGV[2], 'claim', ARGV[3])
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+redis.call('DEL', KEYS[1])
+return {201, 0}
+"""
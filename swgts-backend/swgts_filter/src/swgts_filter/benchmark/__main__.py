@@ -1,127 +1,95 @@
 # coding=utf-8
-import glob
-import gzip
-import sys
+import csv
+import json
 import os
-import time
-from importlib import reload
-from typing import Optional
-
-from Bio import SeqIO
-
-import filter
-from .config import TEST_MODES_PATH, TEST_SAMPLES_PATH
-
-# TODO: Multiprocessing to add parallel processing of benchmarks?
-
-if __name__ == '__main__':
-
-    if len(sys.argv) != 2:
-        print('specify output file ...')
-
-    TEST_MODES = []
-    for f in glob.glob(os.path.join(TEST_MODES_PATH, '*')):
-        TEST_MODES.append(os.path.join(TEST_MODES_PATH, f))
-
-
-    print(f'Found the following filter configurations: {TEST_MODES}')
-    with open(sys.argv[1],'w') as outfile:
-        print("Running Benchmarks ...")
-        for filter_cfg in TEST_MODES:
-
-            with open(filter_cfg, 'r') as cfg_file:
-
-                content = cfg_file.read()
-
-                params: Optional[dict[str, str]] = None
-                samples: Optional[list[str]] = None
-
-                exec(content)  # Very Python
-
-                if params is None:
-                    # The exec should have initialized parameters
-                    print(f"{filter_cfg} hasn't initialized the benchmark. Please check the file!")
-                    sys.exit(-1)
-
-
-                if samples is None:
-                    # The exec should have initialized samples
-                    print(f"{filter_cfg} hasn't provided any samples. Please check the file!")
-                    sys.exit(-1)
-
-                for sample in samples:
-
-                    #append path
-                    sample = os.path.join(TEST_SAMPLES_PATH, sample)
-
-                    start = time.time()
-
-                    reload(filter)
-
-                    print(f'Initializing the filter with: {params}')  # params comes from the exec
-                    filter.init_filter(params)
-                    # TODO: Actually do something
-                    print(f'Benchmarking the file: {sample}')
-
-                    reads = None
-
-                    if sample.endswith('.gz'):
-                        handle = gzip.open(sample, "rt")
-                        reads = SeqIO.parse(handle, 'fastq')
-                    else:
-                        reads = SeqIO.parse(sample, 'fastq')
-
-                    total = 0
-                    filtered = 0
-
-                    tp = 0
-                    tn = 0
-                    fp = 0
-                    fn = 0
+import sys
+import tempfile
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from typing import Any, Union
 
-                    for read in reads:
-                        total += 1
+from .config import TEST_MODES_PATH, TEST_SAMPLES_PATH, BENCHMARK_PROCESSES
+from .runner import Configuration, load_configurations, run_benchmark
+from .synthetic import generate_reads, read_fasta, write_fastq
 
-                        hasFiltered = not filter.is_read_legal(
-                            ['dummyid',
-                             read.seq,
-                             '+',
-                             'dummyquality'
-                             ])
 
-                        identifier = read.id.split('_')[0]
-                        try:
-                            assert(identifier in ['human','pathogen'])
-                        except AssertionError as msg:
-                                print('Identifier: {} makes no sense (should be human or pathogen)'.format(identifier))
-                        shouldFilter = identifier == 'human'
+def synthetic_configurations(reference: str, sample: str) -> list[Configuration]:
+    """Configurations for a sample generated from reference, using reference itself as the database."""
+    positive_contig = next(read_fasta(reference))[0]
+    params = {'filter_mode': 'COMBINED', 'mapping_preset': 'map-ont', 'minimap2_reference_database': reference,
+              'minimap2_positive_contig': positive_contig, 'minimap2_quality_threshold': 20}
+    return [
+        Configuration('combined', params, None, None, [sample]),
+        Configuration('combined-prefilter', params, {'min_shared_kmers': 2}, None, [sample]),
+        Configuration('combined-prefix', params, None, {'prefix_length': 500}, [sample]),
+        Configuration('none', {**params, 'filter_mode': 'NONE'}, None, None, [sample]),
+    ]
 
-                        filtered += hasFiltered
 
-                        if shouldFilter and hasFiltered:
-                            tp += 1
-                        elif not shouldFilter and hasFiltered:
-                            fp += 1
-                        elif shouldFilter and not hasFiltered:
-                            fn += 1
-                        elif not shouldFilter and not hasFiltered:
-                            tn += 1
+def _run(task: tuple[int, Configuration, Union[str, list[str]]]) -> tuple[int, dict[str, Any]]:
+    index, configuration, sample = task
+    return index, run_benchmark(configuration, sample)
 
-                    end = time.time()
 
-                    elapsed_time = end - start
-                    print('Filtered {} of {} reads! (elapsed time: {}s)'.format(filtered,total,elapsed_time))
-                    print('TP: {} TN: {} FP: {} FN: {}'.format(tp, tn, fp, fn))
+def _csv_value(value: Any) -> Any:
+    return json.dumps(value) if isinstance(value, dict) else value
 
-                    if filtered == 0:
-                        print('Nothing was filtered ... this is probably suspicious!')
-                    else:
-                        prec = tp / (tp + fp)
-                        rec = tp / (tp + fn)
-                        f1 = 2 * tp / (2 * tp + fp + fn)
-                        print('Precision: {} Recall: {} F1: {}'.format(prec,rec,f1))
 
-                    #Write to csv for easier downstream analysis
-                    outfile.write('{},{},{},{},{},{},{},{},{},{},{},{}\n'.format(
-                        params,sample,filtered,total,elapsed_time,tp,tn,fp,fn,prec,rec,f1
-                    ))
\ No newline at end of file
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark filter configurations on labeled samples.')
+    parser.add_argument('--modes', type=str, default=TEST_MODES_PATH,
+                        help='The directory of the filter configurations.')
+    parser.add_argument('--samples', type=str, default=TEST_SAMPLES_PATH,
+                        help='The directory the samples of the configurations are relative to.')
+    parser.add_argument('--output', type=str, required=True, help='Write the results to this JSON file.')
+    parser.add_argument('--csv', type=str, default=None, help='Additionally write the results to this CSV file.')
+    parser.add_argument('--processes', type=int, default=BENCHMARK_PROCESSES,
+                        help='How many benchmarks run in parallel.')
+    parser.add_argument('--synthetic', type=str, default=None, metavar='REFERENCE',
+                        help='Generate a labeled sample from this (pathogen) reference and benchmark it with the '
+                             'reference as the database, e.g. example_data/EPI_ISL_402124.fasta.gz')
+    parser.add_argument('--synthetic-reads', type=int, default=2000, help='Reads in the synthetic sample.')
+    parser.add_argument('--read-length', type=int, default=1000, help='Mean length of the synthetic reads.')
+    parser.add_argument('--error-rate', type=float, default=0.01,
+                        help='Substitution rate of the synthetic pathogen reads.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic sample.')
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as synthetic_directory:
+        configurations: list[Configuration] = []
+        if os.path.isdir(arguments.modes):
+            configurations = load_configurations(arguments.modes)
+        if arguments.synthetic is not None:
+            sample = os.path.join(synthetic_directory, 'synthetic.fq')
+            with open(sample, 'w') as handle:
+                write_fastq(generate_reads(arguments.synthetic, arguments.synthetic_reads, arguments.read_length,
+                                           error_rate=arguments.error_rate, seed=arguments.seed), handle)
+            configurations += synthetic_configurations(arguments.synthetic, sample)
+        if len(configurations) == 0:
+            print(f'Found no filter configurations in {arguments.modes}, use --synthetic to run without them.')
+            sys.exit(-1)
+
+        # Every configuration with every one of its samples
+        tasks = [(configuration, sample if os.path.isabs(sample) else os.path.join(arguments.samples, sample))
+                 if isinstance(sample, str) else
+                 (configuration, [file if os.path.isabs(file) else os.path.join(arguments.samples, file)
+                                  for file in sample])
+                 for configuration in configurations for sample in configuration.samples]
+        print(f'Running {len(tasks)} benchmarks with {arguments.processes} processes ...')
+
+        results: list[dict[str, Any]] = [{}] * len(tasks)
+        # A fresh process per benchmark, so index load time and peak memory are its own
+        with Pool(arguments.processes, maxtasksperchild=1) as pool:
+            for index, result in pool.imap_unordered(_run, [(index, *task) for index, task in enumerate(tasks)]):
+                results[index] = result
+                print(f'{result["configuration"]} on {result["sample"]}: {result["reads per second"]:.1f} reads/s, '
+                      f'precision {result["precision"]:.4f}, recall {result["recall"]:.4f}, F1 {result["f1"]:.4f}')
+
+    with open(arguments.output, 'w') as output:
+        json.dump(results, output, indent=2)
+    if arguments.csv is not None:
+        with open(arguments.csv, 'w', newline='') as output:
+            writer = csv.DictWriter(output, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows({key: _csv_value(value) for key, value in result.items()} for result in results)
+    print(f'Wrote the results of {len(results)} benchmarks to {arguments.output}')
@@ -1,4 +1,9 @@
 # coding=utf-8
+import os
 
+# The filter configurations to benchmark, one file per configuration (see runner.load_configuration)
 TEST_MODES_PATH: str = '/input/benchmarks'
+# The samples the configurations refer to are relative to this directory
 TEST_SAMPLES_PATH: str = '/input/samples'
+# How many benchmarks run in parallel. Every one loads its own index, so this is bounded by memory for large databases
+BENCHMARK_PROCESSES: int = os.cpu_count() or 1
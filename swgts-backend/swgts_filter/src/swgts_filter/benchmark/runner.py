@@ -0,0 +1,147 @@
+# coding=utf-8
+import glob
+import gzip
+import os
+import resource
+from array import array
+from time import perf_counter
+from typing import Any, Iterator, NamedTuple, Optional, Union
+
+# A single benchmark run: one filter configuration on one sample, in a process of its own (see __main__), so the index
+# load time and the peak memory usage belong to this run alone.
+
+
+class Configuration(NamedTuple):
+    name: str
+    # The keyword arguments of filter.init_filter
+    params: dict[str, Any]
+    # The keyword arguments of filter.init_prefilter and filter.init_cascade, if any
+    prefilter: Optional[dict[str, Any]]
+    cascade: Optional[dict[str, Any]]
+    # The samples, a list of files for paired reads
+    samples: list[Union[str, list[str]]]
+
+
+def load_configuration(path: str) -> Configuration:
+    """Loads a configuration file. It is python code that sets params and samples, and optionally prefilter and
+    cascade.
+    :raises ValueError: If the file does not set params or samples."""
+    variables: dict[str, Any] = {'params': None, 'prefilter': None, 'cascade': None, 'samples': None}
+    with open(path, 'r') as configuration_file:
+        exec(configuration_file.read(), variables)  # Very Python
+    if variables['params'] is None:
+        raise ValueError(f"{path} hasn't initialized the benchmark. Please check the file!")
+    if variables['samples'] is None:
+        raise ValueError(f"{path} hasn't provided any samples. Please check the file!")
+    return Configuration(os.path.basename(path), variables['params'], variables['prefilter'], variables['cascade'],
+                         variables['samples'])
+
+
+def load_configurations(directory: str) -> list[Configuration]:
+    return [load_configuration(path) for path in sorted(glob.glob(os.path.join(directory, '*')))
+            if os.path.isfile(path)]
+
+
+def read_fastq(path: str) -> Iterator[list[str]]:
+    """:return: The four lines of every record of a (possibly gzip compressed) FASTQ file."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as handle:
+        record: list[str] = []
+        for line in handle:
+            record.append(line.rstrip('\r\n'))
+            if len(record) == 4:
+                yield record
+                record = []
+        if len(record) > 0:
+            raise ValueError(f'{path}: The last record is truncated.')
+
+
+def read_label(header: str) -> Optional[bool]:
+    """Whether a read should be filtered (host) or kept (pathogen), from its id: human_... or pathogen_... (as written
+    by synthetic), or ..._hum or ..._pat. None if the read is not labeled."""
+    read_id = header.lstrip('@').split()[0]
+    prefix, suffix = read_id.split('_')[0], read_id.rsplit('_', 1)[-1]
+    if prefix == 'human' or suffix == 'hum':
+        return True
+    if prefix == 'pathogen' or suffix == 'pat':
+        return False
+    return None
+
+
+def percentile(sorted_values: Union[list[float], array], fraction: float) -> float:
+    """Nearest-rank percentile of ascending values, 0 if there are none."""
+    if len(sorted_values) == 0:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, max(0, int(fraction * len(sorted_values) + 0.5) - 1))]
+
+
+def run_benchmark(configuration: Configuration, sample: Union[str, list[str]]) -> dict[str, Any]:
+    """Filters every read of the sample with the configuration, one read at a time.
+    :param sample: A FASTQ file, or the files of paired reads.
+    :return: The results, see the README."""
+    from swgts_filter import filter
+
+    load_start = perf_counter()
+    filter.init_filter(**configuration.params)
+    if configuration.prefilter is not None:
+        filter.init_prefilter(**configuration.prefilter)
+    if configuration.cascade is not None:
+        filter.init_cascade(**configuration.cascade)
+    index_load_seconds = perf_counter() - load_start
+
+    files = [sample] if isinstance(sample, str) else sample
+    latencies = array('d')
+    bases = filtered = tp = tn = fp = fn = unlabeled = 0
+    # Reads rejected by the prefilter without alignment, and how many of them were pathogen reads
+    prefiltered = prefiltered_pathogen = 0
+    for read in zip(*map(read_fastq, files)):
+        read = list(read)
+        filter_start = perf_counter()
+        has_filtered = not filter.is_read_legal(read)
+        latencies.append(perf_counter() - filter_start)
+        bases += sum(len(mate[1]) for mate in read)
+        filtered += has_filtered
+
+        should_filter = read_label(read[0][0])
+        if configuration.prefilter is not None and not filter.passes_prefilter(read):
+            prefiltered += 1
+            prefiltered_pathogen += should_filter is False
+        if should_filter is None:
+            unlabeled += 1
+        elif should_filter:
+            tp += has_filtered
+            fn += not has_filtered
+        else:
+            fp += has_filtered
+            tn += not has_filtered
+
+    filter_seconds = sum(latencies)
+    latencies = sorted(latencies)
+    precision = tp / (tp + fp) if tp + fp > 0 else 0
+    recall = tp / (tp + fn) if tp + fn > 0 else 0
+    return {
+        'configuration': configuration.name,
+        'sample': ','.join(os.path.basename(file) for file in files),
+        'filter mode': configuration.params.get('filter_mode'),
+        'mapping preset': configuration.params.get('mapping_preset'),
+        'quality threshold': configuration.params.get('minimap2_quality_threshold'),
+        'prefilter': configuration.prefilter,
+        'cascade': configuration.cascade,
+        'reads': len(latencies),
+        'bases': bases,
+        'filtered': filtered,
+        'index load seconds': index_load_seconds,
+        'filter seconds': filter_seconds,
+        'reads per second': len(latencies) / filter_seconds if filter_seconds > 0 else 0,
+        'bases per second': bases / filter_seconds if filter_seconds > 0 else 0,
+        'latency p50 seconds': percentile(latencies, 0.5),
+        'latency p99 seconds': percentile(latencies, 0.99),
+        # Linux reports kilobytes
+        'peak rss bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'tp': tp, 'tn': tn, 'fp': fp, 'fn': fn, 'unlabeled': unlabeled,
+        'precision': precision,
+        'recall': recall,
+        'f1': 2 * tp / (2 * tp + fp + fn) if tp + fp + fn > 0 else 0,
+        'prefiltered': prefiltered,
+        'prefiltered pathogen': prefiltered_pathogen,
+    }
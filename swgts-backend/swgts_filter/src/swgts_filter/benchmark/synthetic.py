@@ -0,0 +1,75 @@
+# coding=utf-8
+import gzip
+import random
+from typing import Iterator, TextIO
+
+# Synthetic labeled reads, so the benchmark runs offline against the bundled example reference. Pathogen reads are
+# sampled from the reference (either strand) with substitution errors, host reads are random sequence with the GC
+# content of the human genome. The label is the prefix of the read id (pathogen_<n> or human_<n>), see
+# runner.read_label.
+
+HUMAN_GC_CONTENT: float = 0.41
+_COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+
+def read_fasta(path: str) -> Iterator[tuple[str, str]]:
+    """:return: The (name, sequence) of every record of a (possibly gzip compressed) FASTA file."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as handle:
+        name, sequence = None, []
+        for line in handle:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(sequence)
+                name, sequence = line[1:], []
+            elif line:
+                sequence.append(line.upper())
+        if name is not None:
+            yield name, ''.join(sequence)
+
+
+def _mutate(sequence: str, error_rate: float, rng: random.Random) -> str:
+    if error_rate <= 0:
+        return sequence
+    bases = list(sequence)
+    for position in range(len(bases)):
+        if rng.random() < error_rate:
+            bases[position] = rng.choice([base for base in 'ACGT' if base != bases[position]])
+    return ''.join(bases)
+
+
+def generate_reads(reference_path: str, count: int, read_length: int, pathogen_fraction: float = 0.5,
+                   error_rate: float = 0.01, seed: int = 0) -> Iterator[tuple[str, str, str]]:
+    """
+    :param read_length: The mean length of the reads, the lengths vary by up to half of it.
+    :return: (id, sequence, quality) of every read.
+    """
+    rng = random.Random(seed)
+    references = [sequence for _, sequence in read_fasta(reference_path) if len(sequence) > 0]
+    if len(references) == 0:
+        raise ValueError(f'{reference_path} contains no sequence.')
+    for index in range(count):
+        length = max(1, int(read_length * rng.uniform(0.5, 1.5)))
+        if rng.random() < pathogen_fraction:
+            reference = rng.choice(references)
+            length = min(length, len(reference))
+            start = rng.randrange(len(reference) - length + 1)
+            sequence = _mutate(reference[start:start + length], error_rate, rng)
+            if rng.random() < 0.5:
+                sequence = sequence.translate(_COMPLEMENT)[::-1]
+            read_id = f'pathogen_{index}'
+        else:
+            sequence = ''.join(rng.choices('ACGT', weights=[1 - HUMAN_GC_CONTENT, HUMAN_GC_CONTENT,
+                                                              HUMAN_GC_CONTENT, 1 - HUMAN_GC_CONTENT], k=length))
+            read_id = f'human_{index}'
+        yield read_id, sequence, ''.join(rng.choices('+5?I', k=length))
+
+
+def write_fastq(reads: Iterator[tuple[str, str, str]], handle: TextIO) -> int:
+    """:return: The number of reads written."""
+    written = 0
+    for read_id, sequence, quality in reads:
+        handle.write(f'@{read_id}\n{sequence}\n+\n{quality}\n')
+        written += 1
+    return written
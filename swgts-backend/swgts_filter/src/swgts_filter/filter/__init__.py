@@ -1,34 +1,226 @@
 # coding=utf-8
 import os
 import time
+from hashlib import blake2b
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
-from typing import Optional, Callable
+from threading import local
+from typing import Optional, Callable, AnyStr
 
-from mappy import Aligner
+from mappy import Aligner, Alignment, ThreadBuffer
+from redis import Redis
 
-ALL = ['is_read_legal', 'init_filter']
+from .cache import DecisionCache, decision_key
+from .prefilter import KmerPrefilter
+
+ALL = ['is_read_legal', 'decide_chunk', 'init_filter', 'init_decision_cache', 'decision_cache_counters',
+       'init_prefilter', 'passes_prefilter', 'init_cascade', 'init_dummy']
 
 aligner: Optional[Aligner] = None
 MINIMAP2_CONTIG: Optional[str] = None
 MINIMAP2_QUALITY_THRESHOLD: Optional[int] = None
+ALIGNMENT_THREADS: int = 1
 _actual_is_read_legal: Optional[Callable[[list[str]], bool]] = None
 logger = getLogger(__name__)
+# Every thread that maps reads needs its own minimap2 buffer, the index itself is shared
+_thread_state = local()
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_pid: Optional[int] = None
+_decision_cache: Optional[DecisionCache] = None
+_prefilter: Optional[KmerPrefilter] = None
+PREFILTER_MIN_SHARED_KMERS: int = 1
+PREFIX_MAPPING_LENGTH: int = 0
+PREFIX_MAPPING_MIN_MAPQ: int = 30
+MATE_CASCADE: bool = False
+MATE_CASCADE_MIN_MAPQ: int = 30
+# The synthetic cost and outcome of the NONE mode, see init_dummy
+DUMMY_SECONDS_PER_READ: float = 0.005
+DUMMY_SECONDS_PER_BASE: float = 0
+DUMMY_KEEP_FRACTION: float = 1
+# Identifies the filter configuration, see init_decision_cache
+_filter_fingerprint: str = ''
 
 
 def info(*args, **kwargs) -> None:
     logger.info(*args, **kwargs)
 
 
-def is_read_legal(read: list[list[str]]) -> bool:
+def is_read_legal(read: list[list[AnyStr]]) -> bool:
     """Return True if you want to keep the read.
-    :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
-    if read[0][2] == 'TOO_LONG':
+    :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str or
+    bytes) ."""
+    if _decision_cache is None:
+        return _is_read_legal_uncached(read)
+    key = decision_key(read)
+    decision = _decision_cache.get(key)
+    if decision is None:
+        decision = _is_read_legal_uncached(read)
+        _decision_cache.put(key, decision)
+    return decision
+
+
+def decide_chunk(chunk: list[list[list[AnyStr]]]) -> list[bool]:
+    """Return for every read of the chunk whether it should be kept (see is_read_legal), in the order of the chunk.
+    :param chunk: For each read index, the read as n lists of reads (see is_read_legal).
+    If the decision cache is enabled, it is queried for the whole chunk at once and identical reads of the chunk are
+    only aligned once. If more than one alignment thread is configured, the remaining reads are split into one slice
+    per thread and the slices are filtered concurrently against the shared index. mappy releases the GIL while
+    mapping."""
+    if _decision_cache is None:
+        decisions = _decide_concurrently(chunk)
+    else:
+        keys = [decision_key(reads) for reads in chunk]
+        decisions = _decision_cache.get_many(keys)
+        # Identical reads within the chunk are decided once
+        undecided: dict[bytes, int] = {}
+        for index, decision in enumerate(decisions):
+            if decision is None:
+                undecided.setdefault(keys[index], index)
+        new_decisions = dict(zip(undecided, _decide_concurrently([chunk[index] for index in undecided.values()])))
+        _decision_cache.put_many(new_decisions)
+        decisions = [new_decisions[key] if decision is None else decision for key, decision in zip(keys, decisions)]
+
+    return decisions
+
+
+def passes_prefilter(read: list[list[AnyStr]]) -> bool:
+    """Return False if the read can be rejected without aligning it, i.e. its mates share less than
+    PREFILTER_MIN_SHARED_KMERS sampled k-mers with the positive contig. Always True if the prefilter is disabled.
+    :param read: The read as n lists of reads (see is_read_legal)."""
+    if _prefilter is None:
+        return True
+    shared = 0
+    for mate in read:
+        shared += _prefilter.shared_kmers(mate[1], PREFILTER_MIN_SHARED_KMERS - shared)
+        if shared >= PREFILTER_MIN_SHARED_KMERS:
+            return True
+    return False
+
+
+def _is_read_legal_uncached(read: list[list[AnyStr]]) -> bool:
+    if read[0][2] in ('TOO_LONG', b'TOO_LONG'):
+        return False
+    if not passes_prefilter(read):
         return False
     return _actual_is_read_legal(read)
 
 
-def init_filter(filter_mode : str, mapping_preset: str, minimap2_reference_database: str, minimap2_positive_contig: str, minimap2_quality_threshold : int):
-    global _actual_is_read_legal
+def _decide_concurrently(reads: list[list[list[AnyStr]]]) -> list[bool]:
+    if ALIGNMENT_THREADS < 2 or len(reads) < 2:
+        return _decide_slice(reads)
+
+    slice_length = -(-len(reads) // ALIGNMENT_THREADS)
+    slices = [reads[start:start + slice_length] for start in range(0, len(reads), slice_length)]
+    return [decision for decided in _alignment_executor().map(_decide_slice, slices) for decision in decided]
+
+
+def _decide_slice(reads: list[list[list[AnyStr]]]) -> list[bool]:
+    return [_is_read_legal_uncached(read) for read in reads]
+
+
+def _alignment_executor() -> ThreadPoolExecutor:
+    # Threads do not survive a fork, so every worker process lazily creates its own pool
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=ALIGNMENT_THREADS, thread_name_prefix='alignment')
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def _thread_buffer() -> ThreadBuffer:
+    buffer = getattr(_thread_state, 'buffer', None)
+    if buffer is None:
+        buffer = _thread_state.buffer = ThreadBuffer()
+    return buffer
+
+
+def init_prefilter(min_shared_kmers: int, kmer_length: int = 15, stride: int = 4) -> None:
+    """Enables a k-mer based first stage in COMBINED mode: reads that share less than min_shared_kmers sampled k-mers
+    with the positive contig are rejected without being aligned. Needs to be called after init_filter.
+    :param min_shared_kmers: The confidence threshold, 0 disables the prefilter. Higher values reject more reads
+    early, at the risk of rejecting short or error-prone reads of the target.
+    :param kmer_length: Length of the k-mers.
+    :param stride: Only every stride-th k-mer of a read is looked up."""
+    global _prefilter, PREFILTER_MIN_SHARED_KMERS, _filter_fingerprint
+    if min_shared_kmers <= 0:
+        _prefilter = None
+        return
+    if _actual_is_read_legal is not is_read_legal_combined:
+        info('The prefilter is only available in COMBINED mode, it stays disabled.')
+        _prefilter = None
+        return
+
+    reference = aligner.seq(MINIMAP2_CONTIG)
+    if reference is None:
+        raise Exception(f'ERROR: positive contig {MINIMAP2_CONTIG} is not part of the index')
+    _prefilter = KmerPrefilter(reference, kmer_length, stride)
+    PREFILTER_MIN_SHARED_KMERS = min_shared_kmers
+    _filter_fingerprint = blake2b(repr((_filter_fingerprint, min_shared_kmers, kmer_length, stride)).encode(),
+                                  digest_size=8).hexdigest()
+    info(f'Prefilter initialized with {len(reference)} bases of {MINIMAP2_CONTIG}.')
+
+
+def init_cascade(prefix_length: int = 0, prefix_min_mapq: int = 30, mate_cascade: bool = False,
+                 mate_min_mapq: int = 30) -> None:
+    """Enables cascading mapping in COMBINED and NEGATIVE mode. Needs to be called after init_filter.
+    :param prefix_length: Single end reads longer than this are first mapped with only their first prefix_length
+    bases. If that yields a confident hit, the decision is taken on it, otherwise the full read is mapped. 0 disables
+    prefix mapping.
+    :param prefix_min_mapq: A prefix hit is confident if its mapping quality is at least this high (in NEGATIVE mode
+    at least MINIMAP2_QUALITY_THRESHOLD as well) and all hits of the prefix are on the same contig.
+    :param mate_cascade: Paired reads are first mapped with only their first mate. In COMBINED mode the pair is kept
+    if the mate hits the positive contig with a mapping quality of at least mate_min_mapq, in NEGATIVE mode it is
+    discarded if the mate hits with a mapping quality of at least MINIMAP2_QUALITY_THRESHOLD. Otherwise the pair is
+    mapped.
+    :param mate_min_mapq: See mate_cascade."""
+    global PREFIX_MAPPING_LENGTH, PREFIX_MAPPING_MIN_MAPQ, MATE_CASCADE, MATE_CASCADE_MIN_MAPQ, _filter_fingerprint
+    PREFIX_MAPPING_LENGTH = prefix_length
+    PREFIX_MAPPING_MIN_MAPQ = prefix_min_mapq
+    MATE_CASCADE = mate_cascade
+    MATE_CASCADE_MIN_MAPQ = mate_min_mapq
+    _filter_fingerprint = blake2b(repr((_filter_fingerprint, prefix_length, prefix_min_mapq, mate_cascade,
+                                        mate_min_mapq)).encode(), digest_size=8).hexdigest()
+    if prefix_length > 0:
+        info(f'Prefix mapping enabled for reads longer than {prefix_length} bases.')
+    if mate_cascade:
+        info('Mate cascade enabled for paired reads.')
+
+
+def init_decision_cache(max_bytes: int, redis_server: Optional[Redis] = None, redis_ttl: int = 3600) -> None:
+    """Enables caching of filter decisions by the sequences of a read. Needs to be called after init_filter.
+    :param max_bytes: Memory cap of the per process LRU cache, 0 disables the cache.
+    :param redis_server: If given, decisions are additionally shared with all other workers through redis.
+    :param redis_ttl: How long decisions are kept in redis (seconds)."""
+    global _decision_cache
+    if max_bytes <= 0:
+        _decision_cache = None
+        return
+    _decision_cache = DecisionCache(max_bytes, _filter_fingerprint, redis_server, redis_ttl)
+    info(f'Decision cache initialized with {max_bytes} bytes{" and a shared redis tier" if redis_server else ""}.')
+
+
+def decision_cache_counters() -> dict[str, int]:
+    """Returns the decision cache hits, misses and evictions since the last call (empty if the cache is disabled)."""
+    if _decision_cache is None:
+        return {}
+    return _decision_cache.pop_counters()
+
+
+def init_filter(filter_mode : str, mapping_preset: str, minimap2_reference_database: str, minimap2_positive_contig: str, minimap2_quality_threshold : int,
+                alignment_threads: int = 1):
+    global _actual_is_read_legal, ALIGNMENT_THREADS, _filter_fingerprint
+
+    ALIGNMENT_THREADS = alignment_threads
+    # Everything that changes the outcome of a decision. The index is identified by its size and modification time as
+    # well, so that rebuilding it under the same name does not reuse the decisions of the old one.
+    index_version: Optional[tuple[int, int]] = None
+    if os.path.isfile(minimap2_reference_database):
+        index = os.stat(minimap2_reference_database)
+        index_version = index.st_size, index.st_mtime_ns
+    _filter_fingerprint = blake2b(repr((filter_mode, mapping_preset, os.path.basename(minimap2_reference_database),
+                                        index_version,
+                                        minimap2_positive_contig, minimap2_quality_threshold)).encode(),
+                                  digest_size=8).hexdigest()
 
     info(f'Filter initialization {filter_mode}')
 
@@ -54,19 +246,71 @@ def init_filter(filter_mode : str, mapping_preset: str, minimap2_reference_datab
     info(f'Filter initialized.')
 
 
-def is_read_legal_dummy(_: list[list[str]]) -> bool:
-    time.sleep(0.005)
-    """Always returns True, pauses however for one second which can be used for benchmarking purposes"""
-    return True
+def init_dummy(seconds_per_read: float = 0.005, seconds_per_base: float = 0, keep_fraction: float = 1) -> None:
+    """Sets the synthetic cost and outcome of the NONE mode, which stands in for alignment when load testing the rest
+    of the system.
+    :param seconds_per_read: How long deciding on a read takes, plus seconds_per_base for each of its bases.
+    :param keep_fraction: The share of reads that are kept (0-1). The decision is derived from the sequences of the
+    mates like the key of the decision cache, so it is the same every time a read is filtered."""
+    global DUMMY_SECONDS_PER_READ, DUMMY_SECONDS_PER_BASE, DUMMY_KEEP_FRACTION, _filter_fingerprint
+    DUMMY_SECONDS_PER_READ = seconds_per_read
+    DUMMY_SECONDS_PER_BASE = seconds_per_base
+    DUMMY_KEEP_FRACTION = keep_fraction
+    _filter_fingerprint = blake2b(repr((_filter_fingerprint, keep_fraction)).encode(), digest_size=8).hexdigest()
+
+
+def is_read_legal_dummy(read: list[list[AnyStr]]) -> bool:
+    """Keeps DUMMY_KEEP_FRACTION of the reads (all by default) after pausing as long as aligning them would take
+    (see init_dummy), which can be used for benchmarking purposes"""
+    cost = DUMMY_SECONDS_PER_READ + DUMMY_SECONDS_PER_BASE * sum(len(mate[1]) for mate in read)
+    if cost > 0:
+        time.sleep(cost)
+    if DUMMY_KEEP_FRACTION >= 1:
+        return True
+    return int.from_bytes(decision_key(read)[:4], 'little') < DUMMY_KEEP_FRACTION * 2 ** 32
+
+def _confident_prefix_hit(read: list[list[AnyStr]], min_mapq: int) -> Optional[Alignment]:
+    """Maps only the prefix of a long single end read and returns its primary hit if it is confident, None if prefix
+    mapping is disabled, does not apply to the read or the hit is not confident."""
+    if PREFIX_MAPPING_LENGTH <= 0 or len(read) != 1 or len(read[0][1]) <= PREFIX_MAPPING_LENGTH:
+        return None
+    hits = list(aligner.map(read[0][1][:PREFIX_MAPPING_LENGTH], buf=_thread_buffer()))
+    if len(hits) == 0 or hits[0].mapq < min_mapq or any(hit.ctg != hits[0].ctg for hit in hits):
+        return None
+    return hits[0]
+
+
+def _decisive_first_mate_hit(read: list[list[AnyStr]], is_decisive: Callable[[Alignment], bool]) -> Optional[Alignment]:
+    """Maps only the first mate of a paired read and returns its primary hit if it decides the pair, None if the mate
+    cascade is disabled, the read is not paired or the hit does not decide the pair."""
+    if not MATE_CASCADE or len(read) < 2:
+        return None
+    hit = next(aligner.map(read[0][1], buf=_thread_buffer()), None)
+    if hit is None or not is_decisive(hit):
+        return None
+    return hit
+
+
+def _keeps_pair(hit: Alignment) -> bool:
+    return hit.ctg == MINIMAP2_CONTIG and hit.mapq >= MATE_CASCADE_MIN_MAPQ
+
+
+def _discards_pair(hit: Alignment) -> bool:
+    return hit.mapq >= MINIMAP2_QUALITY_THRESHOLD
+
 
 def is_read_legal_combined(read: list[list[str]]) -> bool:
     """Return True if you want to keep the read.
     :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
 
-    try:
-        hit = next(aligner.map(*[r[1] for r in read]))
-    except StopIteration:
-        return False
+    hit = _confident_prefix_hit(read, PREFIX_MAPPING_MIN_MAPQ)
+    if hit is None:
+        hit = _decisive_first_mate_hit(read, _keeps_pair)
+    if hit is None:
+        try:
+            hit = next(aligner.map(*[r[1] for r in read], buf=_thread_buffer()))
+        except StopIteration:
+            return False
     return hit.ctg == MINIMAP2_CONTIG
 
 
@@ -74,9 +318,14 @@ def is_read_legal_negative(read: list[list[str]]) -> bool:
     """Return True if you want to keep the read.
     :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str) ."""
 
-    try:
-        hit = next(aligner.map(*[r[1] for r in read]))
-    except StopIteration:
-        return True
+    # A confident prefix hit is always above the quality threshold, i.e. the read is discarded
+    hit = _confident_prefix_hit(read, max(PREFIX_MAPPING_MIN_MAPQ, MINIMAP2_QUALITY_THRESHOLD))
+    if hit is None:
+        hit = _decisive_first_mate_hit(read, _discards_pair)
+    if hit is None:
+        try:
+            hit = next(aligner.map(*[r[1] for r in read], buf=_thread_buffer()))
+        except StopIteration:
+            return True
 
     return hit.mapq < MINIMAP2_QUALITY_THRESHOLD
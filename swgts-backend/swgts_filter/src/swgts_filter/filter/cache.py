@@ -0,0 +1,114 @@
+# coding=utf-8
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import Lock
+from typing import AnyStr, Optional
+
+from redis import Redis
+
+# Rough memory cost of one cached decision: the ordered dict slot, the 16 byte digest object and the decision
+ENTRY_SIZE: int = 160
+
+
+def decision_key(read: list[list[AnyStr]]) -> bytes:
+    """The cache key of a read, a digest of the sequences of all mates.
+    :param read: The read as n lists of reads (n=1 for single end, n=2 for paired end) ( 4 element List of str or
+    bytes) ."""
+    digest = blake2b(digest_size=16)
+    for mate in read:
+        sequence = mate[1]
+        digest.update(sequence if isinstance(sequence, bytes) else sequence.encode())
+        # Separate the mates so that moving bases from one mate to the other changes the key
+        digest.update(b'\0')
+    return digest.digest()
+
+
+class DecisionCache:
+    """A bounded LRU cache of filter decisions, optionally backed by a redis tier that is shared by all workers.
+    All methods are safe to be called from multiple threads."""
+
+    def __init__(self, max_bytes: int, namespace: str, redis_server: Optional[Redis] = None, redis_ttl: int = 3600):
+        """:param max_bytes: Memory cap of the local tier.
+        :param namespace: Identifies the filter configuration, decisions of different configurations never mix.
+        :param redis_server: If given, decisions are shared through redis.
+        :param redis_ttl: How long decisions are kept in redis (seconds)."""
+        self._capacity: int = max(max_bytes // ENTRY_SIZE, 1)
+        self._entries: OrderedDict[bytes, bool] = OrderedDict()
+        self._lock: Lock = Lock()
+        self._namespace: str = namespace
+        self._redis: Optional[Redis] = redis_server
+        self._redis_ttl: int = redis_ttl
+        self._counters: dict[str, int] = {'hits': 0, 'shared hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key: bytes) -> Optional[bool]:
+        """Looks up a single decision in the local tier."""
+        with self._lock:
+            decision = self._entries.get(key)
+            if decision is None:
+                self._counters['misses'] += 1
+            else:
+                self._entries.move_to_end(key)
+                self._counters['hits'] += 1
+            return decision
+
+    def put(self, key: bytes, decision: bool) -> None:
+        """Stores a single decision in the local tier."""
+        with self._lock:
+            self._insert(key, decision)
+
+    def get_many(self, keys: list[bytes]) -> list[Optional[bool]]:
+        """Looks up decisions in the local tier and the remaining ones with a single round trip in the shared tier."""
+        with self._lock:
+            decisions = [self._entries.get(key) for key in keys]
+            for key, decision in zip(keys, decisions):
+                if decision is not None:
+                    self._entries.move_to_end(key)
+            self._counters['hits'] += sum(decision is not None for decision in decisions)
+
+        missing = [index for index, decision in enumerate(decisions) if decision is None]
+        if self._redis is not None and len(missing) > 0:
+            shared = self._redis.mget([self._redis_key(keys[index]) for index in missing])
+            with self._lock:
+                for index, value in zip(missing, shared):
+                    if value is not None:
+                        decisions[index] = value == b'1'
+                        self._insert(keys[index], decisions[index])
+                        self._counters['shared hits'] += 1
+
+        with self._lock:
+            self._counters['misses'] += sum(decision is None for decision in decisions)
+        return decisions
+
+    def put_many(self, decisions: dict[bytes, bool]) -> None:
+        """Stores decisions in the local tier and with a single round trip in the shared tier."""
+        if len(decisions) == 0:
+            return
+        with self._lock:
+            for key, decision in decisions.items():
+                self._insert(key, decision)
+        if self._redis is not None:
+            pipeline = self._redis.pipeline(transaction=False)
+            for key, decision in decisions.items():
+                pipeline.set(self._redis_key(key), b'1' if decision else b'0', ex=self._redis_ttl)
+            pipeline.execute()
+
+    def pop_counters(self) -> dict[str, int]:
+        """Returns the hit, miss and eviction counts since the last call and resets them."""
+        with self._lock:
+            counters = self._counters
+            self._counters = dict.fromkeys(counters, 0)
+        return counters
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _insert(self, key: bytes, decision: bool) -> None:
+        # Caller holds the lock
+        self._entries[key] = decision
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+            self._counters['evictions'] += 1
+
+    def _redis_key(self, key: bytes) -> str:
+        return f'cache:decision:{self._namespace}:{key.hex()}'
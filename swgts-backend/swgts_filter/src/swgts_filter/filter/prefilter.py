@@ -0,0 +1,46 @@
+# coding=utf-8
+from typing import AnyStr
+from zlib import crc32
+
+_COMPLEMENT = bytes.maketrans(b'ACGTacgt', b'TGCAtgca')
+
+
+def reverse_complement(sequence: bytes) -> bytes:
+    return sequence.translate(_COMPLEMENT)[::-1]
+
+
+class KmerPrefilter:
+    """A bitmap over the k-mers of a reference (both strands), used to reject reads that cannot align to it before
+    they are aligned. Membership tests are approximate: hash collisions can only make a read look like it shares
+    k-mers with the reference, which sends it to the aligner. A read is thus never rejected because of a collision."""
+
+    def __init__(self, reference: AnyStr, kmer_length: int = 15, stride: int = 4, bitmap_bits: int = 25) -> None:
+        """:param reference: The sequence of the reference.
+        :param kmer_length: Length of the k-mers.
+        :param stride: Only every stride-th k-mer of a read is looked up. Any exact match of at least
+        kmer_length + stride - 1 bases between read and reference is still guaranteed to be found.
+        :param bitmap_bits: The bitmap has 2^bitmap_bits bits (2^25 bits = 4 MiB)."""
+        self.kmer_length: int = kmer_length
+        self.stride: int = stride
+        self._mask: int = (1 << bitmap_bits) - 1
+        self._bitmap: bytearray = bytearray(1 << max(bitmap_bits - 3, 0))
+
+        reference = (reference if isinstance(reference, bytes) else reference.encode()).upper()
+        for strand in (reference, reverse_complement(reference)):
+            for start in range(len(strand) - kmer_length + 1):
+                bit = crc32(strand[start:start + kmer_length]) & self._mask
+                self._bitmap[bit >> 3] |= 1 << (bit & 7)
+
+    def shared_kmers(self, sequence: AnyStr, enough: int) -> int:
+        """Counts the sampled k-mers of the sequence that are (probably) contained in the reference, stops counting
+        once enough are found."""
+        sequence = (sequence if isinstance(sequence, bytes) else sequence.encode()).upper()
+        bitmap, mask, kmer_length = self._bitmap, self._mask, self.kmer_length
+        shared = 0
+        for start in range(0, len(sequence) - kmer_length + 1, self.stride):
+            bit = crc32(sequence[start:start + kmer_length]) & mask
+            if bitmap[bit >> 3] & (1 << (bit & 7)):
+                shared += 1
+                if shared >= enough:
+                    break
+        return shared
@@ -0,0 +1,37 @@
+# coding=utf-8
+import glob
+import os
+import pstats
+import sys
+from argparse import ArgumentParser
+
+# Merges the profile dumps of the filter workers and the api (see SamplingProfiler) into a report of the hot paths.
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Merge sampled profiles and rank the hot paths.')
+    parser.add_argument('dumps', type=str, nargs='+', help='Profile dumps (.prof) or directories containing them.')
+    parser.add_argument('--top', type=int, default=30, help='How many functions to list per ranking.')
+    parser.add_argument('--filter', type=str, default=None,
+                        help='Only list functions matching this regular expression, e.g. a module name.')
+    parser.add_argument('--callers', action='store_true', help='Also list the callers of the listed functions.')
+    parser.add_argument('--output', type=str, default=None, help='Write the merged profile to this file.')
+    arguments = parser.parse_args()
+
+    dumps: list[str] = []
+    for dump in arguments.dumps:
+        dumps += sorted(glob.glob(os.path.join(dump, '*.prof'))) if os.path.isdir(dump) else [dump]
+    if len(dumps) == 0:
+        print('No profile dumps found.')
+        sys.exit(1)
+
+    stats = pstats.Stats(*dumps)
+    print(f'Merged {len(dumps)} profile dumps.')
+    if arguments.output is not None:
+        stats.dump_stats(arguments.output)
+
+    restrictions = [arguments.top] if arguments.filter is None else [arguments.filter, arguments.top]
+    # Where the time is spent (without callees) and which call paths it is spent under
+    for sort_key in [pstats.SortKey.TIME, pstats.SortKey.CUMULATIVE]:
+        stats.sort_stats(sort_key).print_stats(*restrictions)
+    if arguments.callers:
+        stats.sort_stats(pstats.SortKey.TIME).print_callers(*restrictions)
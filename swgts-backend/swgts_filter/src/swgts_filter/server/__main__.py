@@ -2,12 +2,23 @@
 import logging
 import sys
 import os
+import threading
+from socket import gethostname
 from time import time, sleep
-from uuid import UUID
-
-from swgts_filter.filter import init_filter, is_read_legal
+from typing import Any, Optional, Union
+from uuid import UUID, uuid4
+
+from swgts_filter.filter import init_filter, decide_chunk, init_prefilter, init_cascade, init_decision_cache, \
+    init_dummy, decision_cache_counters
+from swgts_filter.profiling import SamplingProfiler
+from swgts_filter.server.job import unpack_job
+from swgts_filter.server.memory import engine_memory_usage
+from swgts_filter.server.metrics import HISTOGRAMS, BUSY_RATIO_KEY, BusyTime, SECONDS_PER_UNIT_BUCKETS
+from swgts_filter.server.autoscaling import Autoscaler, total_throughput
+from swgts_filter.server.scheduler import Scheduler, WORK_BASES_KEY, WORK_READY_KEY
+from swgts_filter.server.spill import spill_reads, sweep_orphaned_segments
 from redis import Redis
-from multiprocessing import Pool, Event, Manager
+from multiprocessing import Process, Event
 from swgts_filter.server.config import *
 import signal
 
@@ -18,6 +29,9 @@ if os.path.exists(CONFIG_FILE):
 else:
     print('Using defaults, no config file specified')
 
+# Mirror of the key in swgts_api.estimator: the heartbeats of the workers
+WORKERS_KEY: str = 'stats:workers'
+
 #This is the same timeout that is used in the api portion, the timeout value is exchanged via redis
 CONTEXT_TIMEOUT = None
 
@@ -38,7 +52,7 @@ def get_context_timeout():
 logging.basicConfig(filename=LOG_FILE, level='INFO',
                     format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
 
-redis_server = Redis(host=REDIS_SERVER)
+redis_server = Redis(host=REDIS_SERVER, port=REDIS_PORT)
 
 logger = logging.getLogger()
 logger.addHandler(logging.StreamHandler())
@@ -47,7 +61,12 @@ logger.info('Setting up server.')
 
 logger.info('Calling init_filter')
 
-init_filter(FILTER_MODE, MAPPING_PRESET, MINIMAP2_REFERENCE_DATABASE, MINIMAP2_POSITIVE_CONTIG, MINIMAP2_QUALITY_THRESHOLD)
+init_filter(FILTER_MODE, MAPPING_PRESET, MINIMAP2_REFERENCE_DATABASE, MINIMAP2_POSITIVE_CONTIG, MINIMAP2_QUALITY_THRESHOLD,
+            ALIGNMENT_THREADS)
+init_prefilter(PREFILTER_MIN_SHARED_KMERS, PREFILTER_KMER_LENGTH, PREFILTER_STRIDE)
+init_cascade(PREFIX_MAPPING_LENGTH, PREFIX_MAPPING_MIN_MAPQ, MATE_CASCADE, MATE_CASCADE_MIN_MAPQ)
+init_dummy(DUMMY_SECONDS_PER_READ, DUMMY_SECONDS_PER_BASE, DUMMY_KEEP_FRACTION)
+init_decision_cache(DECISION_CACHE_BYTES, redis_server if DECISION_CACHE_SHARED else None, DECISION_CACHE_TTL)
 
 if not redis_server.ping():
     logger.fatal('Could not connect to stateful backend. Goodbye.')
@@ -55,12 +74,34 @@ if not redis_server.ping():
 
 logger.info('Setting up queue and worker')
 
-def mark_for_saving(context: UUID, reads: list[list[list[str]]], how_many_were_processed: int) -> None:
+scheduler = Scheduler(redis_server, FAIR_QUEUE_QUANTUM)
+profiler = SamplingProfiler(PROFILE_EVERY_NTH_JOB, PROFILE_DIRECTORY, 'filter')
+
+def mark_for_saving(context: UUID, reads: list[list[list[bytes]]], how_many_were_processed: int,
+                    ordinals: Optional[list[int]] = None) -> None:
     pipeline = redis_server.pipeline()
 
-    for pair in reads:
-        for pair_index, read in enumerate(pair):
-            pipeline.sadd(f'context:{context}:pair:{pair_index}:reads', '\n'.join(read))
+    # The client numbers its reads, so the kept ones can be reported as a bitmap of their ordinals
+    if ordinals is not None:
+        for ordinal in ordinals:
+            pipeline.setbit(f'context:{context}:kept', ordinal, 1)
+    pipeline.expire(f'context:{context}:kept', get_context_timeout())
+
+    if SAVED_READS_STORAGE == 'FILES':
+        # Redis only learns the name of the segment
+        if len(reads) > 0:
+            pipeline.rpush(f'context:{context}:segments',
+                           spill_reads(SPILL_DIRECTORY, context, reads, SPILL_COMPRESSION_LEVEL))
+        pipeline.expire(f'context:{context}:segments', get_context_timeout())
+    else:
+        # All mates of a pair share a field, which keeps the files of a pair in sync when the api streams them out
+        # while finalizing. Read ids are not unique in every sample (merged runs, some ONT output), so the field is
+        # the ordinal of the pair or, without ordinals, unique to the job and the pair within it
+        job_token = uuid4().hex
+        for index, pair in enumerate(reads):
+            field = ordinals[index] if ordinals is not None else f'{job_token}:{index}'
+            for pair_index, read in enumerate(pair):
+                pipeline.hset(f'context:{context}:pair:{pair_index}:reads', field, b'\n'.join(read))
 
     pair_count_raw = redis_server.get(f'context:{context}:pair_count')
 
@@ -84,85 +125,250 @@ def change_pending_bytes_count(context: UUID, diff: int) -> int:
     redis_server.expire(f'context:{context}:pending_bytes', get_context_timeout())
     return int(now_pending)
 
-def spawn_worker(worker_id: int, is_shutting_down : Event):
+def flush_metrics() -> None:
+    """Adds the observations of this process to the histograms in redis, see swgts_api.metrics"""
+    pipeline = redis_server.pipeline(transaction=False)
+    HISTOGRAMS.flush(pipeline)
+    pipeline.execute()
+
+def report_throughput(worker_name: str, bases_per_second: float) -> None:
+    # Read by the api to estimate how long the queued bases take (see swgts_api.estimator)
+    redis_server.hset(WORKERS_KEY, worker_name, f'{bases_per_second} {time()}')
+
+def spawn_worker(worker_id: int, is_draining: Event):
     logger.info(f'Worker spawned with id {worker_id}')
-    while not is_shutting_down.is_set():
-        #Fetch a job
-        work_assignment = redis_server.brpop(f'work:queue',60)
+    worker_name = f'{gethostname()}:{os.getpid()}:{worker_id}'
+    # Exponentially weighted moving average of the filtered bases per second, 0 until the first job is done
+    bases_per_second: float = 0
+    busy_time = BusyTime()
+    while not is_draining.is_set():
+        report_throughput(worker_name, bases_per_second)
+        if HISTOGRAMS.due(METRICS_FLUSH_INTERVAL):
+            flush_metrics()
+        if time() - busy_time.since >= METRICS_FLUSH_INTERVAL:
+            busy_time.report(redis_server, worker_name)
+        #Fetch a job, contexts take turns
+        work_assignment = scheduler.next_job(HEARTBEAT_INTERVAL, worker_name)
 
         if work_assignment is None:
             logger.info(f'Worker {worker_id} reporting: Nothing to be done here, boring ...')
             continue
         else:
+            dequeue_time = time()
+            profile = profiler.start()
+            try:
+                try:
+                    job = unpack_job(work_assignment)
+                except ValueError as e:
+                    logger.error(f'Worker {worker_id} reporting: I found a malformed job ({e}), I will drop it!')
+                    continue
+                HISTOGRAMS.observe('job_unpack_seconds', time() - dequeue_time)
+                # The reception time is taken by the api, so this includes the clock offset between the hosts
+                HISTOGRAMS.observe('queue_wait_seconds', max(dequeue_time - job.request_reception_time, 0))
+                context_id = job.context_id
+                effective_cumulative_chunk_size = job.effective_cumulative_chunk_size
+                # Only the time spent filtering, the time the job waited in the queue says nothing about this worker
+                start_time = time()
+                chunk = job.chunk
+
+                logger.info(f'Worker {worker_id} reporting: I am working on a chunk for context {context_id} (ECCS: {effective_cumulative_chunk_size}) with {len(chunk)} reads (in pairs of {job.pair_count})!')
+
+                #logger.info(f'Worker {worker_id} reporting: I reconstructed the reads, time to filter them!')
+                decisions: list[bool] = decide_chunk(chunk)
+                to_save: list[list[list[bytes]]] = [reads for reads, keep in zip(chunk, decisions) if keep]
+                filter_time = time() - start_time
+                HISTOGRAMS.observe('filter_seconds', filter_time)
+                if len(chunk) > 0:
+                    HISTOGRAMS.observe('filter_seconds_per_read', filter_time / len(chunk), buckets=SECONDS_PER_UNIT_BUCKETS)
+                if effective_cumulative_chunk_size > 0:
+                    HISTOGRAMS.observe('filter_seconds_per_base', filter_time / effective_cumulative_chunk_size,
+                                       buckets=SECONDS_PER_UNIT_BUCKETS)
+                logger.info(f'Worker {worker_id} reporting: I filtered {len(chunk)-len(to_save)} of {len(chunk)}, time to mark the reads for saving')
+                kept_ordinals: Optional[list[int]] = None
+                if job.ordinals is not None:
+                    kept_ordinals = [ordinal for ordinal, keep in zip(job.ordinals, decisions) if keep]
+                saving_start_time = time()
+                mark_for_saving(context_id, to_save, len(chunk), kept_ordinals)
+                HISTOGRAMS.observe('mark_for_saving_seconds', time() - saving_start_time)
+                logger.info(f'Worker {worker_id} reporting: I will now update the pending byte count')
+                redis_server.incrby('stats:bases', effective_cumulative_chunk_size)
+                change_pending_bytes_count(context_id, -effective_cumulative_chunk_size)
+                logger.info(f'Worker {worker_id} reporting: Done!')
+                end_time = time()
+                HISTOGRAMS.observe('job_seconds', end_time - dequeue_time)
+                busy_time.add(end_time - dequeue_time)
+                if effective_cumulative_chunk_size > 0 and end_time > start_time:
+                    rate = effective_cumulative_chunk_size / (end_time - start_time)
+                    bases_per_second = rate if bases_per_second == 0 \
+                        else THROUGHPUT_EWMA_ALPHA * rate + (1 - THROUGHPUT_EWMA_ALPHA) * bases_per_second
+
+                pipeline = redis_server.pipeline()
+                for counter, value in decision_cache_counters().items():
+                    pipeline.hincrby('stats:decision_cache', counter, value)
+                pipeline.execute()
+            finally:
+                # Also when the job fails (or is malformed), so it no longer counts as waiting and the next job can be
+                # profiled
+                scheduler.job_done(worker_name)
+                profiler.stop(profile)
+
+    flush_metrics()
+    profiler.dump()
+    redis_server.hdel(WORKERS_KEY, worker_name)
+    redis_server.hdel(BUSY_RATIO_KEY, worker_name)
+    logger.info(f'Worker {worker_id} shutting down.')
 
-            # Redis brpop can be called on multiple lists and thus returns a tuple, first value is the list
-            pending_job_id = work_assignment[1].decode()
-            context_id = redis_server.brpop(f'work:{pending_job_id}')[1].decode()
-            #TODO: Extract correct type instead of casting to int
-            effective_cumulative_chunk_size = int(redis_server.brpop(f'work:{pending_job_id}')[1].decode())
-
-            read_count = int(redis_server.brpop(f'work:{pending_job_id}')[1].decode())
-            pair_count = int(redis_server.brpop(f'work:{pending_job_id}')[1].decode())
-            start_time = float(redis_server.brpop(f'work:{pending_job_id}')[1].decode())
-
-            logger.info(f'Worker {worker_id} reporting: I am working on a chunk for context {context_id} (ECCS: {effective_cumulative_chunk_size}) with {read_count} reads (in pairs of {pair_count})!')
-
-            if redis_server.llen(f'work:{pending_job_id}') == 0:
-                #We have an empty or incomplete work package
-                logger.info(f'Worker {worker_id} reporting: I found an incomplete or empty chunk, I will delete it!')
-                continue
-
-            #reconstruct chunk
-            chunk = []
-            for read_idx in range(read_count):
-                reads = []
-                for pair_idx in range(pair_count):
-                    l1 = redis_server.brpop(f'work:{pending_job_id}')[1].decode()
-                    l2 = redis_server.brpop(f'work:{pending_job_id}')[1].decode()
-                    l3 = redis_server.brpop(f'work:{pending_job_id}')[1].decode()
-                    l4 = redis_server.brpop(f'work:{pending_job_id}')[1].decode()
-                    reads.append([l1, l2, l3, l4])
-                chunk.append(reads)
-            #logger.info(f'Worker {worker_id} reporting: I reconstructed the reads, time to filter them!')
-            to_save: list[list[list[str]]] = []
-            for corresponding_reads in chunk:
-                if is_read_legal(corresponding_reads):
-                    to_save.append(corresponding_reads)
-            logger.info(f'Worker {worker_id} reporting: I filtered {len(chunk)-len(to_save)} of {len(chunk)}, time to mark the reads for saving')
-            mark_for_saving(context_id, to_save, len(chunk))
-            logger.info(f'Worker {worker_id} reporting: I will now update the pending byte count')
-            redis_server.incrby('stats:bases', effective_cumulative_chunk_size)
-            change_pending_bytes_count(context_id, -effective_cumulative_chunk_size)
-            logger.info(f'Worker {worker_id} reporting: Done!')
-            end_time = time()
-
-            pipeline = redis_server.pipeline()
-            pipeline.lpush(f'context:{context_id}:speed',(end_time-start_time)/effective_cumulative_chunk_size)
-            pipeline.ltrim(f'context:{context_id}:speed',0,9)
-            pipeline.execute()
+def report_memory_usage(pids: list[int], workers: int) -> None:
+    usage = engine_memory_usage(pids)
+    logger.info(f'Memory usage of the {WORKER_ENGINE} engine ({usage["processes"]} processes): '
+                f'RSS {usage["rss"] >> 20} MiB, PSS {usage["pss"] >> 20} MiB, private {usage["private"] >> 20} MiB')
+    pipeline = redis_server.pipeline()
+    pipeline.hset(f'stats:memory:{gethostname()}', mapping={'engine': WORKER_ENGINE, 'workers': workers, **usage})
+    pipeline.expire(f'stats:memory:{gethostname()}', 60)
+    pipeline.execute()
 
-    logger.info(f'Worker {worker_id} shutting down.')
 
-with Manager() as manager:
+def run_worker_process(worker_id: int, is_draining: Event) -> None:
+    # Ctrl+C reaches the whole process group, the supervisor drains the workers instead. The handlers of the supervisor
+    # are inherited with the fork
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    spawn_worker(worker_id, is_draining)
+
+
+class Workers:
+    """The workers of the engine. Each has an event that drains it: it finishes its current job and exits."""
+
+    def __init__(self) -> None:
+        self.next_id: int = 0
+        # worker id -> (thread or process, drain event)
+        self.running: dict[int, tuple[Union[threading.Thread, Process], Any]] = {}
+        self.draining: dict[int, tuple[Union[threading.Thread, Process], Any]] = {}
+
+    def start(self) -> None:
+        worker_id = self.next_id
+        self.next_id += 1
+        worker: Union[threading.Thread, Process]
+        if WORKER_ENGINE == 'THREAD':
+            is_draining = threading.Event()
+            worker = threading.Thread(target=spawn_worker, args=(worker_id, is_draining), name=f'worker-{worker_id}')
+        else:
+            # Forked, the index is shared copy-on-write
+            is_draining = Event()
+            worker = Process(target=run_worker_process, args=(worker_id, is_draining), name=f'worker-{worker_id}')
+        worker.start()
+        self.running[worker_id] = (worker, is_draining)
+
+    def drain(self) -> None:
+        """Drains the youngest worker."""
+        worker_id = max(self.running)
+        worker, is_draining = self.running.pop(worker_id)
+        is_draining.set()
+        self.draining[worker_id] = (worker, is_draining)
+        logger.info(f'Draining worker {worker_id}.')
+
+    def reap(self) -> None:
+        """Forgets the workers that exited."""
+        for workers in (self.running, self.draining):
+            for worker_id, (worker, _) in list(workers.items()):
+                if not worker.is_alive():
+                    worker.join()
+                    del workers[worker_id]
+                    if workers is self.running:
+                        logger.error(f'Worker {worker_id} exited unexpectedly.')
+
+    def names(self) -> list[str]:
+        """The names the running workers report under, see spawn_worker."""
+        return [f'{gethostname()}:{worker.pid if isinstance(worker, Process) else os.getpid()}:{worker_id}'
+                for worker_id, (worker, _) in self.running.items()]
+
+    def pids(self) -> list[int]:
+        return [os.getpid()] + [worker.pid for worker, _ in (*self.running.values(), *self.draining.values())
+                                if isinstance(worker, Process)]
+
+    def shutdown(self) -> None:
+        while len(self.running) > 0:
+            self.drain()
+        for worker, _ in self.draining.values():
+            worker.join()
+        self.draining.clear()
+
+
+def queue_state(workers: Workers) -> tuple[int, int, float, Optional[float]]:
+    """:return: The queued jobs and bases of all contexts, the throughput of all workers (bases per second) and the mean
+    busy ratio of the workers of this container (None if none of them reported one yet)."""
+    names = workers.names()
+    pipeline = redis_server.pipeline(transaction=False)
+    # Every queued job comes with a ready token, see scheduler
+    pipeline.llen(WORK_READY_KEY)
+    pipeline.hvals(WORK_BASES_KEY)
+    pipeline.hgetall(WORKERS_KEY)
+    if len(names) > 0:
+        pipeline.hmget(BUSY_RATIO_KEY, names)
+    queued_jobs, queued_bases, heartbeats, *busy = pipeline.execute()
+    ratios = [float(ratio) for ratio in (busy[0] if len(busy) > 0 else []) if ratio is not None]
+    return (int(queued_jobs), sum(map(int, queued_bases)), total_throughput(heartbeats, time(), 3 * HEARTBEAT_INTERVAL),
+            sum(ratios) / len(ratios) if len(ratios) > 0 else None)
+
+
+def supervise(workers: Workers) -> None:
+    """Keeps the workers running (and scales them, see AUTOSCALING) until SIGINT or SIGTERM, then drains them."""
+    is_shutting_down = threading.Event()
 
-    IS_SHUTTING_DOWN: Event = manager.Event()
     def signal_handler(sig, frame):
-        logger.info('Got SIGINT, trying to shut down.')
-        IS_SHUTTING_DOWN.set()
+        logger.info(f'Got {signal.Signals(sig).name}, trying to shut down.')
+        is_shutting_down.set()
 
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
     logger.info('Press Ctrl+C to safely shutdown')
 
-    pool: Pool = Pool(processes = WORKER_THREADS)
-    SERVER_LAUNCH_TIME = time()
-    logger.info('Server launched.')
-    dummy_result = pool.starmap_async(spawn_worker, ((x, IS_SHUTTING_DOWN) for x in range(WORKER_THREADS)))
-    logger.info('Worker threads launched!')
-    while not IS_SHUTTING_DOWN.is_set():
-        #logger.info('I am still alive')
+    autoscaler: Optional[Autoscaler] = None
+    target: int = WORKER_THREADS
+    if AUTOSCALING:
+        autoscaler = Autoscaler(AUTOSCALE_MINIMUM_WORKERS, WORKER_THREADS, AUTOSCALE_TARGET_WAIT,
+                                AUTOSCALE_IDLE_UTILIZATION, AUTOSCALE_SCALE_DOWN_DELAY)
+        target = AUTOSCALE_MINIMUM_WORKERS
+    next_decision = next_memory_report = next_sweep = time()
+    while not is_shutting_down.is_set():
+        workers.reap()
+        now = time()
+        if autoscaler is not None and now >= next_decision:
+            queued_jobs, queued_bases, bases_per_second, utilization = queue_state(workers)
+            target = autoscaler.target(len(workers.running), queued_jobs, queued_bases, bases_per_second,
+                                       utilization, now)
+            if target != len(workers.running):
+                logger.info(f'Scaling from {len(workers.running)} to {target} workers ({queued_jobs} jobs with '
+                            f'{queued_bases} bases queued, {bases_per_second:.0f} bases/s, busy ratio {utilization}).')
+            next_decision = now + AUTOSCALE_INTERVAL
+        # Also replaces workers that exited unexpectedly
+        while len(workers.running) < target:
+            workers.start()
+        while len(workers.running) > target:
+            workers.drain()
+        if now >= next_memory_report:
+            report_memory_usage(workers.pids(), len(workers.running))
+            next_memory_report = now + 10
+        if SAVED_READS_STORAGE == 'FILES' and now >= next_sweep:
+            removed = sweep_orphaned_segments(SPILL_DIRECTORY, redis_server, get_context_timeout())
+            if removed > 0:
+                logger.info(f'Removed the segments of {removed} timed out contexts.')
+            next_sweep = now + 60
         # Main thread may not block since this would prevent signal handler from working
-        sleep(10)
-    logger.info('Closing worker pool')
-    pool.close()
-    logger.info('Joining worker pool')
-    pool.join()
+        sleep(1)
+
+    logger.info('Draining the workers')
+    workers.shutdown()
+
+
+if WORKER_ENGINE not in ('THREAD', 'PROCESS'):
+    logger.fatal(f'Unknown worker engine {WORKER_ENGINE}. Goodbye.')
+    sys.exit(1)
+
+# THREAD: One process, one loaded index, a thread per worker. Mapping releases the GIL, so the workers still run in
+# parallel while none of them can turn shared pages of the index into private memory.
+# PROCESS: A forked process per worker, exiting workers return their private memory.
+SERVER_LAUNCH_TIME = time()
+logger.info('Server launched.')
+supervise(Workers())
+logger.info('All workers shut down.')
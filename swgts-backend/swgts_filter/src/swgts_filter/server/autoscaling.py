@@ -0,0 +1,72 @@
+# coding=utf-8
+from math import ceil
+from typing import Optional
+
+# How many workers a filter container runs, decided from the queued jobs (see scheduler) and the busy ratio of its
+# workers (see metrics). Workers are added quickly while the queue grows faster than it is filtered, but only removed
+# one at a time after they stayed idle for a while, so a short pause between two uploads does not cost capacity.
+
+
+def total_throughput(heartbeats: dict[bytes, bytes], now: float, heartbeat_timeout: float) -> float:
+    """Mirror of swgts_api.estimator.estimate_throughput: the bases per second of all workers (of all containers) that
+    sent a heartbeat within heartbeat_timeout seconds, 0 if unknown. Workers that did not filter anything yet are
+    assumed to be as fast as the others."""
+    rates: list[float] = []
+    live_workers: int = 0
+    for heartbeat in heartbeats.values():
+        rate, timestamp = heartbeat.split(b' ')
+        if now - float(timestamp) > heartbeat_timeout:
+            continue
+        live_workers += 1
+        if float(rate) > 0:
+            rates.append(float(rate))
+    return 0 if len(rates) == 0 else sum(rates) / len(rates) * live_workers
+
+
+class Autoscaler:
+    """Decides how many workers should run, between minimum and maximum."""
+
+    def __init__(self, minimum: int, maximum: int, target_wait: float, idle_utilization: float,
+                 scale_down_delay: float):
+        """:param target_wait: Workers are added while filtering the queued bases would take longer than this (seconds).
+        :param idle_utilization: Workers are removed while no job is queued and the mean busy ratio of the workers
+        stays below this (0-1) ...
+        :param scale_down_delay: ... for this many seconds, one worker per delay."""
+        if not 0 <= minimum <= maximum:
+            raise ValueError(f'The bounds of the workers are invalid: {minimum} to {maximum}.')
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_wait = target_wait
+        self.idle_utilization = idle_utilization
+        self.scale_down_delay = scale_down_delay
+        # Since when the workers are idle, None while they are not
+        self.idle_since: Optional[float] = None
+
+    def clamp(self, workers: int) -> int:
+        return min(max(workers, self.minimum), self.maximum)
+
+    def target(self, workers: int, queued_jobs: int, queued_bases: int, bases_per_second: float,
+               utilization: Optional[float], now: float) -> int:
+        """:param workers: The running workers (not counting those that drain).
+        :param bases_per_second: The throughput of all workers, 0 if unknown.
+        :param utilization: The mean busy ratio of the workers (0-1), None if none of them reported one yet.
+        :return: How many workers should run."""
+        if queued_jobs > 0:
+            self.idle_since = None
+            if bases_per_second <= 0:
+                # Nothing was filtered yet (or no worker runs), grow step by step until the throughput is known
+                return self.clamp(workers + 1)
+            wait = queued_bases / bases_per_second
+            if wait > self.target_wait:
+                # The throughput grows about linearly with the workers
+                return self.clamp(max(ceil(workers * wait / self.target_wait), workers + 1))
+            return self.clamp(workers)
+
+        if utilization is None or utilization >= self.idle_utilization:
+            self.idle_since = None
+        elif self.idle_since is None:
+            self.idle_since = now
+        elif now - self.idle_since >= self.scale_down_delay:
+            self.idle_since = now
+            return self.clamp(workers - 1)
+        return self.clamp(workers)
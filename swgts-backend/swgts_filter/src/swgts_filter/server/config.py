@@ -8,7 +8,7 @@ INPUT_DIRECTORY: str = path.join(getcwd(), 'input')
 # The secondary configuration file to load to override the defaults set in here
 CONFIG_FILE: str = path.join(INPUT_DIRECTORY, 'config_filter.py')
 
-#Can be either COMBINED or NEGATIVE, NONE is a dummy that simply accepts all reads
+#Can be either COMBINED or NEGATIVE, NONE is a dummy that accepts reads at a synthetic cost (see DUMMY_SECONDS_PER_READ)
 #COMBINED: Uses a database where one reference is labeled as the target (MINIMAP2_POSITIVE_CONTIG)
 #NEGATIVE: Only host database is provided and all hits are discarded
 FILTER_MODE: str = 'COMBINED'
@@ -23,6 +23,89 @@ MINIMAP2_QUALITY_THRESHOLD : int = 20
 
 #docker name or hostname of the redis service
 REDIS_SERVER: str = 'redis'
+REDIS_PORT: int = 6379
 
-#Number of concurrent worker threads used for filtering
-WORKER_THREADS: int = 8
\ No newline at end of file
+#Number of concurrent worker threads used for filtering (the upper bound if AUTOSCALING is enabled)
+WORKER_THREADS: int = 8
+
+#How the workers are run, can be either PROCESS or THREAD
+#PROCESS: Each worker is a forked process, the index is shared copy-on-write between them
+#THREAD: All workers are threads of a single process sharing one loaded index
+WORKER_ENGINE: str = 'PROCESS'
+
+#Number of threads each worker uses to align the reads of a single chunk, all of them share the loaded index
+ALIGNMENT_THREADS: int = 1
+
+#Only used in COMBINED mode: Reads sharing less than PREFILTER_MIN_SHARED_KMERS k-mers (of length PREFILTER_KMER_LENGTH,
+#every PREFILTER_STRIDE-th k-mer of the read is sampled) with the positive contig are rejected without aligning them.
+#0 disables the prefilter
+PREFILTER_MIN_SHARED_KMERS: int = 0
+PREFILTER_KMER_LENGTH: int = 15
+PREFILTER_STRIDE: int = 4
+
+#Single end reads longer than PREFIX_MAPPING_LENGTH are first mapped with only their first PREFIX_MAPPING_LENGTH bases.
+#If the prefix hit has a mapping quality of at least PREFIX_MAPPING_MIN_MAPQ and all its hits are on the same contig,
+#the decision is taken on it, otherwise the full read is mapped. Useful for long nanopore reads, 0 disables it
+PREFIX_MAPPING_LENGTH: int = 0
+PREFIX_MAPPING_MIN_MAPQ: int = 30
+
+#Paired reads are first mapped with only their first mate. COMBINED: the pair is kept if the mate hits the positive
+#contig with a mapping quality of at least MATE_CASCADE_MIN_MAPQ. NEGATIVE: the pair is discarded if the mate hits with
+#a mapping quality of at least MINIMAP2_QUALITY_THRESHOLD. Only undecided pairs are mapped as a pair
+MATE_CASCADE: bool = False
+MATE_CASCADE_MIN_MAPQ: int = 30
+
+#Only used in NONE mode: instead of aligning, every read takes DUMMY_SECONDS_PER_READ plus DUMMY_SECONDS_PER_BASE per
+#base and DUMMY_KEEP_FRACTION (0-1) of the reads are kept. Stands in for alignment when load testing the rest of the
+#system
+DUMMY_SECONDS_PER_READ: float = 0.005
+DUMMY_SECONDS_PER_BASE: float = 0
+DUMMY_KEEP_FRACTION: float = 1
+
+#Memory (in bytes) each worker process may use to cache filter decisions by read sequence, 0 disables the cache.
+#Useful for amplicon data, where many reads are identical. Hits and misses are counted in the redis hash stats:decision_cache
+DECISION_CACHE_BYTES: int = 0
+#If enabled, cached decisions are additionally shared between all workers (and filter containers) through redis
+DECISION_CACHE_SHARED: bool = False
+#How long shared decisions are kept in redis (seconds)
+DECISION_CACHE_TTL: int = 3600
+
+#Where the reads kept by the filter are stored until their context is closed, can be either REDIS or FILES
+#REDIS: In redis, its memory grows with the kept reads of all open contexts
+#FILES: In gzip-compressed segment files (one per job and file of the pairs) under SPILL_DIRECTORY, which has to be
+#shared with the api (same path). Only the names of the segments are kept in redis
+SAVED_READS_STORAGE: str = 'REDIS'
+SPILL_DIRECTORY: str = '/spill'
+#The gzip compression level (1-9) of the segments
+SPILL_COMPRESSION_LEVEL: int = 1
+
+#How often (seconds) idle workers report that they are alive, the api only counts workers whose last report is recent
+HEARTBEAT_INTERVAL: int = 10
+#The weight of the latest job in the moving average of the bases per second each worker reports (0-1), higher values
+#follow changes of the load faster but are noisier
+THROUGHPUT_EWMA_ALPHA: float = 0.2
+
+#The jobs of all contexts are served in turns (deficit round robin), each turn a context may have up to this many bases
+#filtered (at least one job). Smaller values let small contexts overtake large ones sooner, around the chunk size of
+#the clients is a good choice
+FAIR_QUEUE_QUANTUM: int = 30000
+
+#Grow and shrink the workers with the load, between AUTOSCALE_MINIMUM_WORKERS and WORKER_THREADS. Every
+#AUTOSCALE_INTERVAL seconds, workers are added while the queued bases (of all contexts) would take longer than
+#AUTOSCALE_TARGET_WAIT seconds to filter. Once no job is queued and the mean busy ratio of the workers stayed below
+#AUTOSCALE_IDLE_UTILIZATION (0-1) for AUTOSCALE_SCALE_DOWN_DELAY seconds, one worker is drained (it finishes its
+#current job and exits), then the next one after another delay
+AUTOSCALING: bool = False
+AUTOSCALE_MINIMUM_WORKERS: int = 1
+AUTOSCALE_INTERVAL: int = 10
+AUTOSCALE_TARGET_WAIT: float = 10
+AUTOSCALE_IDLE_UTILIZATION: float = 0.3
+AUTOSCALE_SCALE_DOWN_DELAY: int = 120
+
+#How often (seconds) the workers add their latency histograms and busy ratio to redis, the api serves them at /metrics
+METRICS_FLUSH_INTERVAL: int = 10
+
+#Profile every PROFILE_EVERY_NTH_JOB-th job with cProfile (0 disables profiling). The profiles of each worker process
+#add up and are dumped to PROFILE_DIRECTORY every minute, python -m swgts_filter.profiling merges them into a report
+PROFILE_EVERY_NTH_JOB: int = 0
+PROFILE_DIRECTORY: str = path.join(getcwd(), 'profiles')
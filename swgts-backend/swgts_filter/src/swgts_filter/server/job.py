@@ -0,0 +1,51 @@
+# coding=utf-8
+import struct
+from itertools import accumulate
+from typing import NamedTuple, Optional
+from uuid import UUID
+
+# Mirror of the job layout in swgts_api.job, see there for a description of the format.
+JOB_MAGIC: bytes = b'SWJB'
+JOB_VERSION: int = 2
+_JOB_HEADER = struct.Struct('<4sB16sQdIH')
+
+
+class Job(NamedTuple):
+    context_id: UUID
+    effective_cumulative_chunk_size: int
+    request_reception_time: float
+    pair_count: int
+    # For each read index, for each file the 4 lines making up one read
+    chunk: list[list[list[bytes]]]
+    # The ordinals the client assigned to the reads, None for version 1 jobs
+    ordinals: Optional[list[int]] = None
+
+
+def unpack_job(blob: bytes) -> Job:
+    """Decodes a job value produced by the api. The lines are returned as bytes, nothing is decoded.
+    :raises ValueError: If the value is not a job, has an unknown version or is truncated."""
+    if len(blob) < _JOB_HEADER.size:
+        raise ValueError('Job is shorter than its header.')
+    magic, version, context_id, effective_cumulative_chunk_size, request_reception_time, read_count, pair_count = \
+        _JOB_HEADER.unpack_from(blob)
+    if magic != JOB_MAGIC:
+        raise ValueError('Not a job.')
+    if version not in (1, JOB_VERSION):
+        raise ValueError(f'Unsupported job format version {version}.')
+
+    lengths_offset = _JOB_HEADER.size + (8 * read_count if version == 2 else 0)
+    line_count = read_count * pair_count * 4
+    payload_offset = lengths_offset + 4 * line_count
+    if len(blob) < payload_offset:
+        raise ValueError('Job is truncated.')
+    ordinals = list(struct.unpack_from(f'<{read_count}Q', blob, _JOB_HEADER.size)) if version == 2 else None
+    ends = list(accumulate(struct.unpack_from(f'<{line_count}I', blob, lengths_offset), initial=payload_offset))
+    if ends[-1] != len(blob):
+        raise ValueError('Job payload does not match the announced line lengths.')
+
+    lines = [blob[start:end] for start, end in zip(ends, ends[1:])]
+    stride = 4 * pair_count
+    chunk = [[lines[read_start:read_start + 4] for read_start in range(pair_start, pair_start + stride, 4)]
+             for pair_start in range(0, line_count, stride)]
+    return Job(UUID(bytes=context_id), effective_cumulative_chunk_size, request_reception_time, pair_count, chunk,
+               ordinals)
@@ -0,0 +1,35 @@
+# coding=utf-8
+from typing import Iterable
+
+# Fields of /proc/<pid>/smaps_rollup we report. Pss splits shared pages between the processes sharing them, which is
+# what makes copy-on-write sharing of the index (or the lack thereof) visible when comparing engines.
+_SMAPS_FIELDS: dict[str, str] = {'Rss': 'rss', 'Pss': 'pss', 'Private_Clean': 'private', 'Private_Dirty': 'private'}
+
+
+def memory_usage(pid: int) -> dict[str, int]:
+    """Returns rss, pss and private memory of a process in bytes. Only works on Linux, returns an empty dict if the
+    process is gone or the information is not available."""
+    usage: dict[str, int] = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', 'r') as rollup:
+            for line in rollup:
+                field, _, value = line.partition(':')
+                if field in _SMAPS_FIELDS:
+                    key = _SMAPS_FIELDS[field]
+                    usage[key] = usage.get(key, 0) + int(value.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        return {}
+    return usage
+
+
+def engine_memory_usage(pids: Iterable[int]) -> dict[str, int]:
+    """Sums up the memory usage of all processes that make up a worker engine."""
+    total: dict[str, int] = {'processes': 0, 'rss': 0, 'pss': 0, 'private': 0}
+    for pid in pids:
+        usage = memory_usage(pid)
+        if len(usage) == 0:
+            continue
+        total['processes'] += 1
+        for key, value in usage.items():
+            total[key] += value
+    return total
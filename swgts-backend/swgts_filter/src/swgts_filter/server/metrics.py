@@ -0,0 +1,83 @@
+# coding=utf-8
+from bisect import bisect_left
+from threading import Lock
+from time import time
+from typing import Any
+
+from redis import Redis
+
+# Mirror of the recording side of swgts_api.metrics, see there for the redis layout. The keys, the buckets and
+# Histograms need to be changed in both places. The api serves the histograms of the workers together with its own
+# ones.
+
+HISTOGRAMS_KEY: str = 'metrics:histograms'
+# The share of the time each worker was busy since its last flush, by worker (the same names as the heartbeats)
+BUSY_RATIO_KEY: str = 'metrics:busy'
+
+# Upper bounds of the buckets for durations in seconds
+SECONDS_BUCKETS: tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                                      30, 60, 300)
+# Upper bounds of the buckets for durations per read or base
+SECONDS_PER_UNIT_BUCKETS: tuple[float, ...] = (1e-8, 1e-7, 1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1)
+
+
+def histogram_key(name: str) -> str:
+    return f'metrics:histogram:{name}'
+
+
+class Histograms:
+    """The observations of a process since the last flush. Thread-safe, so all workers of the THREAD engine share
+    one."""
+
+    def __init__(self) -> None:
+        self.lock: Lock = Lock()
+        # (name, labels) -> counts per bucket (the last one is +Inf), sum
+        self.series: dict[tuple[str, str], tuple[list[int], list[float]]] = {}
+        self.buckets: dict[str, tuple[float, ...]] = {}
+        self.last_flush: float = time()
+
+    def observe(self, name: str, value: float, labels: str = '',
+                buckets: tuple[float, ...] = SECONDS_BUCKETS) -> None:
+        with self.lock:
+            self.buckets.setdefault(name, buckets)
+            counts, total = self.series.setdefault((name, labels), ([0] * (len(buckets) + 1), [0.0]))
+            counts[bisect_left(buckets, value)] += 1
+            total[0] += value
+
+    def due(self, interval: float) -> bool:
+        return time() - self.last_flush >= interval
+
+    def flush(self, pipeline: Any) -> None:
+        """Queues the observations since the last flush on a redis pipeline, the caller executes it."""
+        with self.lock:
+            series, self.series = self.series, {}
+            self.last_flush = time()
+        for (name, labels), (counts, total) in series.items():
+            key = histogram_key(name)
+            pipeline.sadd(HISTOGRAMS_KEY, name)
+            for bound, count in zip(self.buckets[name] + (float('inf'),), counts):
+                if count > 0:
+                    pipeline.hincrby(key, f'{labels}|{bound:g}', count)
+            pipeline.hincrbyfloat(key, f'{labels}|sum', total[0])
+            pipeline.hincrby(key, f'{labels}|count', sum(counts))
+
+
+HISTOGRAMS: Histograms = Histograms()
+
+
+class BusyTime:
+    """The time a worker spends on jobs, reported as the share of the time since the last report."""
+
+    def __init__(self) -> None:
+        self.busy: float = 0
+        self.since: float = time()
+
+    def add(self, seconds: float) -> None:
+        self.busy += seconds
+
+    def report(self, redis_server: Redis, worker_name: str) -> None:
+        now = time()
+        if now > self.since:
+            redis_server.hset(BUSY_RATIO_KEY, worker_name, min(self.busy / (now - self.since), 1))
+        self.busy = 0
+        self.since = now
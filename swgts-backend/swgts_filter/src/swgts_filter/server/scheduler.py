@@ -0,0 +1,96 @@
+# coding=utf-8
+from typing import Optional
+
+from redis import Redis
+
+# Fair dequeueing of jobs, mirror of the queue layout in swgts_api.scripts: every context has a queue of its jobs
+# (work:queue:<context>) and of their sizes in bases (work:sizes:<context>), the contexts with queued jobs take turns in
+# WORK_ACTIVE_KEY. Jobs are served by deficit round robin weighted by bases: the context whose turn it is gets a quantum
+# of bases of credit once per turn and is served as long as its credit covers its next job, then it moves to the back.
+# A large upload thus gets the full throughput when it is alone, while a small one only waits for a turn.
+WORK_ACTIVE_KEY: str = 'work:active'
+WORK_READY_KEY: str = 'work:ready'
+WORK_BASES_KEY: str = 'work:bases'
+# The credit (bases) of the contexts
+WORK_DEFICIT_KEY: str = 'work:deficit'
+# The context that already got its quantum in the current turn
+WORK_TURN_KEY: str = 'work:turn'
+# The bases of the job every worker is filtering (field: worker name), mirror of swgts_api.estimator. Together with
+# WORK_BASES_KEY these are the bases waiting to be filtered.
+WORK_IN_FLIGHT_KEY: str = 'work:in_flight'
+
+# Pops the next job. The queues of the contexts are derived from their ids, so this only works on a single redis
+# instance (not a cluster).
+# KEYS: WORK_ACTIVE_KEY, WORK_DEFICIT_KEY, WORK_TURN_KEY, WORK_BASES_KEY, WORK_IN_FLIGHT_KEY
+# ARGV: quantum (bases, has to be positive), worker name
+# Returns the job or false if no job is queued. The bases of the job move from the queued to the in-flight bases of the
+# worker, which removes them once the job is done (see Scheduler.job_done). A context whose queue runs empty leaves the turns and loses its credit.
+DEQUEUE_SCRIPT: str = """
+local quantum = tonumber(ARGV[1])
+while true do
+    local context = redis.call('LINDEX', KEYS[1], 0)
+    if not context then
+        return false
+    end
+    local queue = 'work:queue:' .. context
+    local sizes = 'work:sizes:' .. context
+    local size = tonumber(redis.call('LINDEX', sizes, -1))
+    if not size then
+        redis.call('LPOP', KEYS[1])
+        redis.call('HDEL', KEYS[2], context)
+        redis.call('HDEL', KEYS[4], context)
+        redis.call('DEL', KEYS[3])
+    else
+        local deficit = tonumber(redis.call('HGET', KEYS[2], context) or '0')
+        if redis.call('GET', KEYS[3]) ~= context then
+            deficit = deficit + quantum
+            redis.call('SET', KEYS[3], context)
+        end
+        if deficit >= size then
+            local job = redis.call('RPOP', queue)
+            redis.call('RPOP', sizes)
+            redis.call('HSET', KEYS[5], ARGV[2], size)
+            if redis.call('LLEN', queue) == 0 then
+                redis.call('LPOP', KEYS[1])
+                redis.call('HDEL', KEYS[2], context)
+                redis.call('HDEL', KEYS[4], context)
+                redis.call('DEL', KEYS[3])
+            else
+                redis.call('HSET', KEYS[2], context, deficit - size)
+                redis.call('HINCRBY', KEYS[4], context, -size)
+            end
+            return job
+        end
+        redis.call('HSET', KEYS[2], context, deficit)
+        redis.call('LMOVE', KEYS[1], KEYS[1], 'LEFT', 'RIGHT')
+        redis.call('DEL', KEYS[3])
+    end
+end
+"""
+
+
+class Scheduler:
+    """Hands out the queued jobs fairly between contexts, see DEQUEUE_SCRIPT."""
+
+    def __init__(self, redis_server: Redis, quantum: int):
+        """:param quantum: The bases a context may be served per turn (at least one job, larger jobs take several turns
+        of credit). Around the size of a chunk is a good choice."""
+        if quantum <= 0:
+            raise ValueError(f'The quantum has to be positive, not {quantum}.')
+        self.redis_server = redis_server
+        self.quantum = quantum
+        self.dequeue_script = redis_server.register_script(DEQUEUE_SCRIPT)
+
+    def next_job(self, timeout: int, worker: str) -> Optional[bytes]:
+        """Waits up to timeout seconds for a job.
+        :param worker: The name of the worker, its job is counted as in flight until job_done.
+        :return: The packed job or None if there was none."""
+        # Every job comes with a token, but a token may have been lost with a worker that died between taking it and
+        # dequeueing its job, so the queues are checked after a timeout as well
+        self.redis_server.brpop(WORK_READY_KEY, timeout)
+        return self.dequeue_script(keys=[WORK_ACTIVE_KEY, WORK_DEFICIT_KEY, WORK_TURN_KEY, WORK_BASES_KEY,
+                                         WORK_IN_FLIGHT_KEY], args=[self.quantum, worker])
+
+    def job_done(self, worker: str) -> None:
+        """The job of the worker is no longer waiting to be filtered, whether it succeeded or not."""
+        self.redis_server.hdel(WORK_IN_FLIGHT_KEY, worker)
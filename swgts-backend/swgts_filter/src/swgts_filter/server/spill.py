@@ -0,0 +1,52 @@
+# coding=utf-8
+import gzip
+import os
+import shutil
+from os import path
+from time import time
+from uuid import UUID, uuid4
+
+from redis import Redis
+
+# Storage of kept reads in segment files instead of redis (SAVED_READS_STORAGE = 'FILES'). Every job that keeps reads
+# writes one gzip-compressed segment per file of the pairs into SPILL_DIRECTORY/<context>/ and only the name of the
+# segment goes into the redis list context:<context>:segments. The api reads the segments from the same directory
+# when it finalizes the context, see swgts_api.finalization. Keep the naming in sync with segment_path over there.
+
+
+def segment_path(spill_directory: str, context: UUID, segment: str, pair_index: int) -> str:
+    return path.join(spill_directory, str(context), f'{segment}.{pair_index}.gz')
+
+
+def spill_reads(spill_directory: str, context: UUID, reads: list[list[list[bytes]]], compression_level: int) -> str:
+    """Writes the kept reads of a job into a new segment. The files only appear under their final name once they are
+    complete, so a finalization never sees a partial segment.
+    :return: The name of the segment."""
+    segment = uuid4().hex
+    os.makedirs(path.join(spill_directory, str(context)), exist_ok=True)
+    for pair_index in range(len(reads[0])):
+        final_path = segment_path(spill_directory, context, segment, pair_index)
+        with open(f'{final_path}.part', 'wb') as handle:
+            handle.write(gzip.compress(b''.join(b'\n'.join(pair[pair_index]) + b'\n' for pair in reads),
+                                       compresslevel=compression_level))
+        os.replace(f'{final_path}.part', final_path)
+    return segment
+
+
+def sweep_orphaned_segments(spill_directory: str, redis_server: Redis, timeout: int) -> int:
+    """Removes the segments of contexts that timed out before they were closed.
+    :return: The number of removed context directories."""
+    if not path.isdir(spill_directory):
+        return 0
+    removed = 0
+    for context in os.listdir(spill_directory):
+        context_directory = path.join(spill_directory, context)
+        try:
+            if time() - path.getmtime(context_directory) < timeout:
+                continue
+        except OSError: # Removed by someone else in the meantime
+            continue
+        if redis_server.exists(f'context:{context}:processed_reads', f'context:{context}:finalization') == 0:
+            shutil.rmtree(context_directory, ignore_errors=True)
+            removed += 1
+    return removed
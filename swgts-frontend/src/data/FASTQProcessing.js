@@ -224,10 +224,14 @@ async function uploadFASTQ(files,
             } catch (error){
                 if (error.response.status === 503){
                     console.log(error.response.data)
-                    updateBufferFillCallback(error.response.data['pending bytes'])
-                    updateFilteredCallback(error.response.data['processed reads'])
-                    console.log('got an "orderly" 422 response asking me to slow down ...')
-                    const timeout = error.response.headers['Retry-After'];
+                    if ('written reads' in error.response.data){ //The context is closed and its reads are being written
+                        console.log(`the server has written ${error.response.data['written reads']} reads so far ...`)
+                    }
+                    else{ //Reads are still being filtered
+                        console.log('got an "orderly" 503 response, reads are still pending ...')
+                    }
+                    //Axios lowercases header names, the body carries the value as well
+                    const timeout = parseFloat(error.response.data['Retry-After'] ?? error.response.headers.get('retry-after'));
                     console.log(`sleeping for ${timeout} seconds zzzzzzzz`)
                     await sleep(timeout*1000);
                 }
@@ -1,40 +1,29 @@
 import gzip
 import mimetypes
+import zlib
 from argparse import ArgumentParser
+from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor, Future, wait, as_completed, FIRST_COMPLETED
 from json import JSONDecodeError
-from time import sleep
-from typing import Optional, Union, AnyStr, List, Tuple, Dict, TextIO, Generator, Set
+from threading import Lock
+from time import sleep, monotonic
+from typing import Optional, Union, List, Tuple, Dict, Generator, Set, Iterator, Callable
+from itertools import chain
 from uuid import UUID
 
 import os
 import httpx
 from tqdm import tqdm
 
+from .fastq import Read, FastqIndex, read_fastq_batches, copy_records
+
 long_reads_counter = 0
 
 #TODO: Differentiate between file and stream and show progress bar accordingly for files (count reads prior to parsing and set total accordingly)
 
-class Read:
-    def __init__(self, lines: List[AnyStr]) -> None:
-        self.barcode: AnyStr = lines[0].rstrip('\n')
-        self.sequence: AnyStr = lines[1].rstrip('\n')
-        self.plus: AnyStr = lines[2].rstrip('\n')
-        self.quality: AnyStr = lines[3].rstrip('\n')
-
-    def __iter__(self) -> None:
-        yield self.barcode
-        yield self.sequence
-        yield self.plus
-        yield self.quality
-
-    def bp_count(self) -> int:
-        return len(self.sequence)
-
-    def __str__(self) -> str:
-        return f'{self.barcode}\n{self.sequence}\n{self.plus}\n{self.quality}\n'
-
 def create_context(client: httpx.Client, filenames: List[str]) -> Optional[UUID]:
-    result = client.post('/context/create', json={'filenames': filenames})
+    # We number our reads, so the server can report the ones it kept as a bitmap of their ordinals
+    result = client.post('/context/create', json={'filenames': filenames, 'ordinals': True})
     if result.is_error:
         print('Could not create context.')
         return None
@@ -59,23 +48,11 @@ def query_server_status(client: httpx.Client) -> Dict[str, Union[str, float, int
     else:
         return result.json()
 
-def read_reads_from_file(filepath: str) -> Generator[Read, None, None]:
-    guessed_mimetype : Tuple[str,str] = mimetypes.guess_type(filepath)
-    file = gzip.open(filepath,'rt') if guessed_mimetype[1] == 'gzip' else open(filepath,'r')
-    buffer = []
-    while True:
-        line = next(file, None)
-        if line is not None:
-            buffer.append(line)
-        else:
-            break
-        if len(buffer) == 4:
-            yield Read(buffer)
-            buffer = []
-    file.close()
+def read_fastq_file(filepath: str, index: Optional[FastqIndex] = None) -> Iterator[Read]:
+    return chain.from_iterable(read_fastq_batches(filepath, index))
 
 
-def read_reads_from_files(all_files: List[TextIO]) -> Tuple[Generator[Read, None, None], ...]:
+def read_reads_from_files(all_files: List[str], indexes: Optional[List[FastqIndex]] = None) -> Iterator[Tuple[Read, ...]]:
     '''
     # This is medium naive, and consumes tons of RAM.
     all_lines = list(map(lambda f: f.read().splitlines(), all_files))
@@ -84,26 +61,30 @@ def read_reads_from_files(all_files: List[TextIO]) -> Tuple[Generator[Read, None
     return list(zip(*all_reads))
     '''
 
-    # This is stream-based
-    reads_per_file = map(lambda f : read_reads_from_file(f), all_files)
+    # This is stream-based, the offsets of the reads are recorded in the indexes for the reconstruction
+    reads_per_file = map(read_fastq_file, all_files, indexes if indexes is not None else [None] * len(all_files))
     return zip(*reads_per_file)
 
 def split_n_bp_worth_of_reads(
-        reads: List[Tuple[Read]], chunk_size: int, buffer_size: int, progress_bar: tqdm
+        reads: List[Tuple[Read]], chunk_size: Union[int, Callable[[], int]], buffer_size: int, progress_bar: tqdm
 ) -> Generator[List[Tuple[Read]], None, None]:
     """
     Split the reads list into chunk so that they never hit the sequence size limit.
     The smallest chunk will always be at least a single read.
 
     :param reads: The list of the reads to chomp.
-    :param max_bp: The maximum bps in the reads per chunk.
+    :param chunk_size: The maximum bps in the reads per chunk, or a function returning it, which is asked again for
+        every read (pair) so the chunk size can change during the upload.
     """
 
+    target_chunk_size: Callable[[], int] = chunk_size if callable(chunk_size) else lambda: chunk_size
     current_buffer_size: int = 0
     current_buffer: List[Tuple[Read]] = []
     global long_reads_counter
     for corresponding_reads in reads:
-        this_reads_length: int = sum(map(lambda r: r.bp_count(), corresponding_reads))
+        this_reads_length: int = 0
+        for read in corresponding_reads:
+            this_reads_length += len(read.sequence)
 
         #Special case buffer size exceeded
         if this_reads_length > buffer_size:
@@ -115,14 +96,15 @@ def split_n_bp_worth_of_reads(
             progress_bar.refresh()
             yield [corresponding_reads]
             continue
+        current_chunk_size: int = target_chunk_size()
         #Special case chunk size exceeded
-        elif this_reads_length > chunk_size:
+        if this_reads_length > current_chunk_size:
             progress_bar.total += 1
             progress_bar.refresh()
             yield [corresponding_reads]
             continue
 
-        if this_reads_length + current_buffer_size >= chunk_size:
+        if this_reads_length + current_buffer_size >= current_chunk_size:
             if len(current_buffer) > 0:
                 # The current buffer can be empty here if the length of the first corresponding_reads already
                 # exceeds our size hint. This can happen if you have
@@ -143,12 +125,63 @@ def split_n_bp_worth_of_reads(
         yield current_buffer
 
 
-def close_context(client: httpx.Client, context: UUID, verbose: bool, progress_bar : tqdm) -> Optional[Tuple[List[str], int]]:
+def fastq_request(chunk: List[Tuple[Read]], compress: bool) -> Dict[str, object]:
+    """
+    Encode a chunk for the FASTQ endpoint.
+    :param chunk: The reads to submit. 1-tuples for single file submission, 2-tuples for paired-end.
+    :param compress: Whether to gzip the FASTQ data.
+    :return: The keyword arguments for the httpx request: single files are sent as the body, paired files as one
+    multipart part per file.
+    """
+    per_file: List[bytes] = [b''.join(bytes(corresponding_reads[file_index]) for corresponding_reads in chunk)
+                             for file_index in range(len(chunk[0]))]
+    if compress:
+        per_file = [gzip.compress(data, compresslevel=1) for data in per_file]
+    if len(per_file) == 1:
+        return {'content': per_file[0], 'headers': {'Content-Type': 'application/octet-stream'}}
+    return {'files': [(str(file_index), (f'{file_index}.fastq', data)) for file_index, data in enumerate(per_file)]}
+
+
+class SavedReads:
+    """
+    The reads the server saved. Either a bitmap of the ordinals of the saved reads or, for servers that do not support
+    ordinals, the ids of the saved reads.
+    """
+    def __init__(self, payload: Dict[str, object]) -> None:
+        self.bitmap: Optional[bytes] = None
+        self.read_ids: Optional[Set[str]] = None
+        self.count: int
+        if 'saved bitmap' in payload:
+            self.bitmap = zlib.decompress(b64decode(payload['saved bitmap']))
+            self.count = int(payload['saved count'])
+        else:
+            self.read_ids = set(payload['saved'])
+            self.count = len(self.read_ids)
+
+    def ordinals(self, first_file: str) -> Generator[int, None, None]:
+        """
+        :param first_file: The first of the submitted files, only read if the server sent read ids.
+        :return: The ordinals of the saved reads (pairs), i.e. their positions in the submitted files, ascending.
+        """
+        if self.bitmap is not None:
+            for byte_index, byte in enumerate(self.bitmap):
+                if byte != 0:
+                    for bit in range(8):
+                        if byte & (0x80 >> bit):
+                            yield byte_index * 8 + bit
+        else:
+            # The server sends the ids of the first mates
+            for ordinal, read in enumerate(read_fastq_file(first_file)):
+                if read.barcode.decode() in self.read_ids:
+                    yield ordinal
+
+
+def close_context(client: httpx.Client, context: UUID, verbose: bool, progress_bar : tqdm) -> Optional[Tuple[SavedReads, int]]:
     """
     Request a context close on the server.
     :param client: Our main http client for signalization.
     :param context: The context to close.
-    :return: The total statistics we get from the server.
+    :return: The saved reads and the total statistics we get from the server.
     """
 
     while True:
@@ -161,7 +194,9 @@ def close_context(client: httpx.Client, context: UUID, verbose: bool, progress_b
 
         if result.status_code == httpx.codes.SERVICE_UNAVAILABLE: #Reads are still being processed
             timeout : float = float(payload['Retry-After'])
-            if verbose:
+            if verbose and 'written reads' in payload: #The context is closed and being written
+                progress_bar.write(f'The server has written {payload["written reads"]} reads, server asks us to check back in {timeout} seconds')
+            elif verbose:
                 progress_bar.write(f'Reads are still being processed, server asks us to check back in {timeout} seconds')
             sleep(timeout)
             continue
@@ -174,92 +209,225 @@ def close_context(client: httpx.Client, context: UUID, verbose: bool, progress_b
             progress_bar.write(f'The server did not send any payload in the response. or the payload could not be parsed.')
             return None
 
-        return payload['saved'], payload['total']
+        return SavedReads(payload), payload['total']
+
+
+class TransmissionStatistics:
+    """
+    Counts the transmissions of all chunks in flight. The counters are shared between the threads sending the chunks.
+    """
+    def __init__(self) -> None:
+        self.lock: Lock = Lock()
+        self.transmissions: int = 0
+        self.rejections: int = 0
+        self.processed_reads: int = 0
+
+    def count(self, rejected: bool) -> int:
+        """
+        Count a transmission.
+        :return: The total number of rejections so far.
+        """
+        with self.lock:
+            self.transmissions += 1
+            if rejected:
+                self.rejections += 1
+            return self.rejections
+
+
+class AdaptiveChunkSize:
+    """
+    Adapts the chunk size to what the server absorbs (additive increase, multiplicative decrease): every chunk accepted
+    fast enough grows it a bit, a rejection because the server-sided buffer is full halves it. Chunks sent before the
+    last decrease do not decrease it again, so a burst of rejections of chunks in flight only counts once.
+    """
+    # The smallest chunk size and the additive increase, as a fraction of the server-sided buffer size
+    STEP_FRACTION: int = 50
+    MULTIPLICATIVE_DECREASE: float = 0.5
+
+    def __init__(self, initial: int, buffer_size: int, target_latency: float, window: int = 1) -> None:
+        """
+        :param target_latency: Chunks answered slower than this (seconds) do not grow the chunk size.
+        :param window: The chunk size stays small enough for this many chunks to fit into the buffer together, every
+            chunk is filtered by a single worker of the server.
+        """
+        self.lock: Lock = Lock()
+        self.step: int = max(buffer_size // self.STEP_FRACTION, 1)
+        self.maximum: int = max(buffer_size // window, self.step)
+        self.size: int = min(max(initial, self.step), self.maximum)
+        self.target_latency: float = target_latency
+        # Incremented on every decrease
+        self.generation: int = 0
+
+    def __call__(self) -> int:
+        return self.size
+
+    def accept(self, generation: int, latency: float) -> None:
+        with self.lock:
+            if generation == self.generation and latency <= self.target_latency:
+                self.size = min(self.size + self.step, self.maximum)
+
+    def reject(self, generation: int) -> None:
+        with self.lock:
+            if generation == self.generation:
+                self.size = max(int(self.size * self.MULTIPLICATIVE_DECREASE), self.step)
+                self.generation += 1
+
+
+def submit_chunk(client: httpx.Client, context: UUID, chunk: List[Tuple[Read]], ordinal: int, retries: int,
+                 verbose: bool, progress_bar: tqdm, statistics: TransmissionStatistics, fastq: bool,
+                 compress: bool, chunk_sizes: Optional[AdaptiveChunkSize] = None) -> bool:
+    """
+    Send a single chunk and resend it until the server accepts it. The chunk carries the ordinal of its first read, so
+    the server admits it only once, even if we resend it after losing the response.
+    :param ordinal: The ordinal of the first read (pair) of the chunk.
+    :param chunk_sizes: If given, it is told about the latency of the chunk and its rejections.
+    :return False if the chunk could not be submitted, else True
+    """
+
+    def update_progress_bar(progress_bar: tqdm, reads: int):
+        # Responses arrive out of order, the progress only grows
+        with statistics.lock:
+            if reads <= statistics.processed_reads:
+                return
+            statistics.processed_reads = reads
+            progress_bar.n = reads
+            progress_bar.last_n = reads
+            progress_bar.update()
+
+    request_arguments: Dict[str, object]
+    if fastq:
+        request_arguments = fastq_request(chunk, compress)
+    else:
+        request_arguments = {'json': [[list(read) for read in corresponding_reads]
+                                      for corresponding_reads in chunk]}
+    request_arguments.setdefault('headers', {})['First-Ordinal'] = str(ordinal)
+    generation: int = 0 if chunk_sizes is None else chunk_sizes.generation
+
+    while True:
+        try:
+            #print(f'Sending chunk of length {len(chunk)}')
+            sending_time: float = monotonic()
+            response = client.post(f'/context/{context}/{"fastq" if fastq else "reads"}', **request_arguments)
+        except httpx.TransportError as e:
+            # We may have lost the response of an admitted chunk, resending it is safe
+            rejections = statistics.count(rejected=True)
+            if retries != -1 and rejections > retries: #Only handle if retries is set
+                progress_bar.write(f'Too many retries ({rejections}). {e}')
+                return False
+            progress_bar.write(f'We had a failure, now at {rejections}. {e}')
+            sleep(1)
+            continue
+
+        try:
+            response_json = response.json()
+        except JSONDecodeError:
+            progress_bar.write(
+                f"The server did not return a proper json (Code: {response.status_code}). We can't really handle this."
+            )
+            return False
+
+        if response.status_code == httpx.codes.NOT_FOUND:
+            progress_bar.write(f'The server return 404 for the context {context}.')
+            return False
+
+        elif response.status_code == httpx.codes.BAD_REQUEST:
+            progress_bar.write(f'We did something wrong.\n'
+                               f'{response_json["message"]}')
+            return False
+        elif response.status_code == httpx.codes.REQUEST_ENTITY_TOO_LARGE:
+            progress_bar.write(
+                f"The chunk size specified was larger than the server-sided buffer, this does not work!")
+            return False
+        #Orderly timeout
+        elif response.status_code == httpx.codes.UNPROCESSABLE_ENTITY:
+            rejections = statistics.count(rejected=True)
+            if chunk_sizes is not None:
+                chunk_sizes.reject(generation)
+            if retries != -1 and rejections > retries: #Only handle if retries is set
+                progress_bar.write(f'Too many retries ({rejections}).')
+                return False
+            if 'Retry-After' not in response.headers:
+                progress_bar.write(f"We received an orderly timeout without Retry-After headers, this should not happen!")
+                return False
+            if verbose:
+                progress_bar.write(f"Received timeout: Server wants retry after {float(response.headers['Retry-After'])} s")
+                update_progress_bar(progress_bar, int(response_json['processed reads']))
+            sleep(float(response.headers['Retry-After']))
+            continue
+        elif response.is_error:
+            progress_bar.write(f"We received an error ({response.status_code}), let's treat it as a simple failure.")
+            return False
+        else:
+            statistics.count(rejected=False)
+            if chunk_sizes is not None:
+                chunk_sizes.accept(generation, monotonic() - sending_time)
+            update_progress_bar(progress_bar, int(response_json['processed reads']))
+            return True
 
 
 def submit_chunks(client: httpx.Client, context: UUID, reads: List[Tuple[Read]],
-                  chunk_size: int, buffer_size : int, retries: int, verbose: bool, progress_bar: tqdm) -> bool:
+                  chunk_size: int, buffer_size : int, retries: int, verbose: bool, progress_bar: tqdm,
+                  fastq: bool = False, compress: bool = False, window: int = 1,
+                  target_latency: Optional[float] = None) -> bool:
     """
     Work on a chunk of reads.
-    Split a chunk of reads into smaller chunks, and send them sequentially. We do this with our own http client class
-    instance.
+    Split a chunk of reads into smaller chunks, and send them. Up to window chunks are in flight at a time over our
+    (HTTP/2 multiplexed) http client, as long as they fit into the server-sided buffer together. Responses may arrive
+    out of order.
     :param progress_bar: The progress bar to use to print the status.
     :param retries: How many retries to do if one chunk failed.
     :param client: The httpx-Client to use.
     :param context: The context we should submit it to.
     :param reads: The reads to submit. 1-tuples for single file submission, 2-tuples for paired-end.
     :param size_hint: The maximum read sequence length.
+    :param fastq: Submit plain FASTQ instead of json.
+    :param compress: Gzip the FASTQ data (only with fastq).
+    :param window: The maximum number of chunks in flight.
+    :param target_latency: If given, the chunk size starts at chunk_size and adapts to the server, see
+        AdaptiveChunkSize.
     :return False if cancelled, else True
     """
 
-    def update_progress_bar(progress_bar: tqdm, reads: int):
-        progress_bar.n = reads
-        progress_bar.last_n = reads
-        progress_bar.update()
-
-    transmissions : int = 0
-    rejections: int = 0
-    chunks_to_send: Generator[List[Tuple[Read]], None, None] = split_n_bp_worth_of_reads(reads, chunk_size, buffer_size, progress_bar)
+    statistics = TransmissionStatistics()
+    chunk_sizes: Optional[AdaptiveChunkSize] = None
+    if target_latency is not None:
+        chunk_sizes = AdaptiveChunkSize(chunk_size, buffer_size, target_latency, window)
+    chunks_to_send: Generator[List[Tuple[Read]], None, None] = split_n_bp_worth_of_reads(
+        reads, chunk_size if chunk_sizes is None else chunk_sizes, buffer_size, progress_bar)
+    # The ordinal of the first read (pair) of the next chunk
+    ordinal: int = 0
+    # The chunks in flight and their size in bases
+    in_flight: Dict[Future, int] = {}
+    succeeded: bool = True
 
     # progress_bar.write(f'Hi! This is a worker. I will take care of {len(reads)} reads. To make the server happy, '
     #                    f'I split them into {len(chunks_to_send)} transmissions.')
 
-    for chunk in chunks_to_send:
-        chunk_transmitted = False
-        while not chunk_transmitted:
-            if retries != -1 and rejections > retries: #Only handle if retries is set
-                progress_bar.write(f'Too many retries ({rejections}).')
-                return False
-
-            try:
-                #print(f'Sending chunk of length {len(chunk)}')
-                response = client.post(f'/context/{context}/reads',
-                                       json=[[list(read) for read in corresponding_reads]
-                                             for corresponding_reads in chunk])
-                transmissions += 1
-            except Exception as e:
-                progress_bar.write(f'We had a failure, now at {rejections}. {e}')
-                return False
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        for chunk in chunks_to_send:
+            chunk_bases: int = sum(read.bp_count() for corresponding_reads in chunk for read in corresponding_reads)
+            # Sending more than the buffer holds would only provoke rejections
+            while succeeded and len(in_flight) > 0 and \
+                    (len(in_flight) >= window or sum(in_flight.values()) + chunk_bases > buffer_size):
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del in_flight[future]
+                    succeeded = succeeded and future.result()
+            if not succeeded:
+                break
 
-            try:
-                response_json = response.json()
-            except JSONDecodeError:
-                progress_bar.write(
-                    f"The server did not return a proper json (Code: {response.status_code}). We can't really handle this."
-                )
-                return False
+            in_flight[executor.submit(submit_chunk, client, context, chunk, ordinal, retries, verbose, progress_bar,
+                                      statistics, fastq, compress, chunk_sizes)] = chunk_bases
+            ordinal += len(chunk)
 
-            if response.status_code == httpx.codes.NOT_FOUND:
-                progress_bar.write(f'The server return 404 for the context {context}.')
-                return False
+        succeeded = all(future.result() for future in as_completed(in_flight)) and succeeded
 
-            elif response.status_code == httpx.codes.BAD_REQUEST:
-                progress_bar.write(f'We did something wrong.\n'
-                                   f'{response.json()["message"]}')
-                return False
-            elif response.status_code == httpx.codes.REQUEST_ENTITY_TOO_LARGE:
-                progress_bar.write(
-                    f"The chunk size specified was larger than the server-sided buffer, this does not work!")
-                return False
-            #Orderly timeout
-            elif response.status_code == httpx.codes.UNPROCESSABLE_ENTITY:
-                rejections += 1
-                if verbose:
-                    progress_bar.write(f"Received timeout: Server wants retry after {float(response.headers['Retry-After'])} s")
-                    update_progress_bar(progress_bar, int(response.json()['processed reads']))
-                if 'Retry-After' not in response.headers:
-                    progress_bar.write(f"We received an orderly timeout without Retry-After headers, this should not happen!")
-                    return False
-                sleep(float(response.headers['Retry-After']))
-                continue
-            elif response.is_error:
-                progress_bar.write(f"We received an error ({response.status_code}), let's treat it as a simple failure.")
-                return False
-            else:
-                update_progress_bar(progress_bar, int(response.json()['processed reads']))
-                chunk_transmitted = True
+    if not succeeded:
+        return False
 
-    progress_bar.write(f'Transmission had a total of {transmissions} transmissions of which {rejections} were retries due to exceeding the server buffer')
+    progress_bar.write(f'Transmission had a total of {statistics.transmissions} transmissions of which {statistics.rejections} were retries due to exceeding the server buffer')
+    if chunk_sizes is not None:
+        progress_bar.write(f'The chunk size settled at {chunk_sizes.size} basepairs')
 
     return True
 
@@ -275,6 +443,18 @@ def get_argument_parser() -> ArgumentParser:
     parser.add_argument('files', type=str, help='The fastq files to submit.', nargs='+')
     parser.add_argument('--outfolder', type=str, help='The folder to save the filtered reads in')
     parser.add_argument('--verbose', action='store_true', help='Output detailed information about the transaction')
+    parser.add_argument('--fastq', action='store_true',
+                        help='Submit the reads as plain FASTQ instead of json, which is cheaper for client and server.')
+    parser.add_argument('--gzip', action='store_true', help='Gzip the submitted FASTQ (only with --fastq).')
+    parser.add_argument('--window', type=int, default=4,
+                        help='How many chunks may be in flight at a time. They are also limited by the server-sided '
+                             'buffer size. 1 sends one chunk after another.')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Adapt the chunk size during the upload, starting at --count: it grows while the server '
+                             'accepts chunks within --target-latency and halves when its buffer is full.')
+    parser.add_argument('--target-latency', type=float, default=2.0,
+                        help='Only with --adaptive: Chunks answered slower than this (seconds) do not grow the chunk '
+                             'size.')
     return parser
 
 
@@ -318,18 +498,21 @@ def main() -> None:
                             unit=' reads' if len(filenames) == 1 else ' read pairs',
                             total=0, position = 0)
 
-        all_reads = read_reads_from_files(arguments.files)
-        submit_chunks(client, context, all_reads, arguments.count, mpb, arguments.retries, arguments.verbose, progress_bar_tm)
+        # The reconstruction copies the kept reads by their offsets, which are recorded while uploading
+        indexes: Optional[List[FastqIndex]] = [FastqIndex() for _ in filenames] if arguments.outfolder else None
+        all_reads = read_reads_from_files(arguments.files, indexes)
+        submit_chunks(client, context, all_reads, arguments.count, mpb, arguments.retries, arguments.verbose, progress_bar_tm,
+                      arguments.fastq, arguments.gzip, arguments.window,
+                      arguments.target_latency if arguments.adaptive else None)
         statistics = close_context(client, context, arguments.verbose, progress_bar_tm)
         if statistics is not None:
-            progress_bar_tm.write(f'The server saved {len(statistics[0])} of {statistics[1]}. ({long_reads_counter} implicitly filtered due to size)')
+            progress_bar_tm.write(f'The server saved {statistics[0].count} of {statistics[1]}. ({long_reads_counter} implicitly filtered due to size)')
             progress_bar_tm.close()
             #Post Processing: If an output folder is given save the reads there
             if arguments.outfolder:
                 print(f'Reconstructing the filtered read files in {arguments.outfolder}')
                 os.makedirs(arguments.outfolder, exist_ok=True)
 
-                filehandles = {}
                 for fileidx, filename in enumerate(filenames):
                     print(f'Reconstructing the filtered read files for file: {filename}')
                     guessed_mimetype: Tuple[str, str] = mimetypes.guess_type(filename)
@@ -337,36 +520,8 @@ def main() -> None:
                     split_components = os.path.basename(filename).split('.')
                     new_filename = '.'.join([split_components[0]] + ['filtered']+split_components[1:])
                     outfile = os.path.join(arguments.outfolder, new_filename)
-                    filehandles[fileidx] = gzip.open(outfile, 'wt') if guessed_mimetype[1] == 'gzip' else open(outfile, 'w')
-
-                readids_to_keep: set[str] = set(statistics[0])
-                in_file_stream = []
-                for in_file in arguments.files:
-                    guessed_mimetype: Tuple[str, str] = mimetypes.guess_type(in_file)
-                    in_file_stream.append(gzip.open(in_file, 'rt') if guessed_mimetype[1] == 'gzip' else open(in_file, 'r'))
-
-                still_reconstructing = True
-                while still_reconstructing:
-                    readids_from_streams = list(map(lambda x: x.readline()[:-1], in_file_stream))
-                    two = list(map(lambda x: x.readline(), in_file_stream))
-                    three = list(map(lambda x: x.readline(), in_file_stream))
-                    four = list(map(lambda x: x.readline(), in_file_stream))
-                    keep = False
-                    for readid in readids_from_streams:
-                        if readid == '':
-                            still_reconstructing = False
-                            break
-                        if readid in readids_to_keep:
-                            keep = True
-                            break
-                    if keep:
-                        for fileidx, handleid in enumerate(filehandles):
-                            filehandles[handleid].writelines([readids_from_streams[fileidx]+'\n', two[fileidx], three[fileidx], four[fileidx]])
-
-                for s in in_file_stream:
-                    s.close()
-                for s in filehandles:
-                    filehandles[s].close()
+                    with gzip.open(outfile, 'wb') if guessed_mimetype[1] == 'gzip' else open(outfile, 'wb') as output:
+                        copy_records(filename, indexes[fileidx], statistics[0].ordinals(filenames[0]), output)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,267 @@
+import zlib
+from array import array
+from bisect import bisect_right
+from itertools import accumulate, islice
+from mmap import mmap, ACCESS_READ
+from queue import Queue
+from threading import Thread
+from typing import BinaryIO, Generator, Iterable, List, Optional, Tuple
+
+GZIP_MAGIC: bytes = b'\x1f\x8b'
+# How much (decompressed) data is parsed at a time
+BLOCK_SIZE: int = 1 << 20
+# How many decompressed blocks the background thread may hold ready
+PREFETCHED_BLOCKS: int = 4
+# How much compressed data is decompressed at a time
+INFLATE_INPUT_SIZE: int = 1 << 18
+# The distance (in decompressed bytes) between the checkpoints of the index of a gzip file
+CHECKPOINT_SPACING: int = 32 << 20
+
+
+class Read:
+    """
+    A single FASTQ record. The lines are kept as bytes without their line breaks and are only decoded when the read
+    is submitted as json.
+    """
+    __slots__ = ('barcode', 'sequence', 'plus', 'quality')
+
+    def __init__(self, barcode: bytes, sequence: bytes, plus: bytes, quality: bytes) -> None:
+        self.barcode: bytes = barcode
+        self.sequence: bytes = sequence
+        self.plus: bytes = plus
+        self.quality: bytes = quality
+
+    def __iter__(self) -> Generator[str, None, None]:
+        yield self.barcode.decode()
+        yield self.sequence.decode()
+        yield self.plus.decode()
+        yield self.quality.decode()
+
+    def bp_count(self) -> int:
+        return len(self.sequence)
+
+    def __bytes__(self) -> bytes:
+        return b'%s\n%s\n%s\n%s\n' % (self.barcode, self.sequence, self.plus, self.quality)
+
+    def __str__(self) -> str:
+        return bytes(self).decode()
+
+
+class FastqIndex:
+    """
+    Where the records of a file are, recorded while it is parsed for the upload. This lets the filtered file be
+    reconstructed by copying the kept records instead of parsing the whole file again.
+    """
+    def __init__(self) -> None:
+        # The (decompressed) offset of every record
+        self.offsets: array = array('Q')
+        # The end of the last recorded record
+        self.size: int = 0
+        # Only for gzip files: (compressed offset, decompressed offset, decompressor state or None at the start of a
+        # gzip member) every CHECKPOINT_SPACING decompressed bytes, so decompression can start close to a record
+        self.checkpoints: List[Tuple[int, int, Optional[object]]] = [(0, 0, None)]
+
+    def record_range(self, first: int, last: int) -> Tuple[int, int]:
+        """
+        :return: The offsets of the start of record first and the end of record last.
+        """
+        return self.offsets[first], self.offsets[last + 1] if last + 1 < len(self.offsets) else self.size
+
+
+class _Inflater:
+    """
+    Decompresses (multi-member) gzip data from a file and keeps track of the offsets.
+    """
+    def __init__(self, file: BinaryIO) -> None:
+        self.file: BinaryIO = file
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        # The decompressed offset of the next output
+        self.position: int = 0
+
+    def restore(self, checkpoint: Tuple[int, int, Optional[object]]) -> None:
+        input_offset, self.position, decompressor = checkpoint
+        self.file.seek(input_offset)
+        # Copy, the checkpoint may be needed again
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if decompressor is None else decompressor.copy()
+
+    def checkpoint(self) -> Tuple[int, int, Optional[object]]:
+        """
+        Only valid right after inflate, all input read so far has been consumed then (except at the end of a member).
+        """
+        if self.decompressor.eof:
+            return self.file.tell() - len(self.decompressor.unused_data), self.position, None
+        return self.file.tell(), self.position, self.decompressor.copy()
+
+    def inflate(self) -> bytes:
+        """
+        :return: The next piece of decompressed data, empty at the end of the file.
+        """
+        while True:
+            data: bytes = b''
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if not data:
+                data = self.file.read(INFLATE_INPUT_SIZE)
+            if not data:
+                return b''
+            output: bytes = self.decompressor.decompress(data)
+            if output:
+                self.position += len(output)
+                return output
+
+
+def _plain_blocks(filepath: str) -> Generator[bytes, None, None]:
+    with open(filepath, 'rb') as file:
+        while block := file.read(BLOCK_SIZE):
+            yield block
+
+
+def _gzip_blocks(filepath: str, index: Optional[FastqIndex]) -> Generator[bytes, None, None]:
+    """
+    Decompress in a background thread, zlib releases the GIL so this runs in parallel to the parsing.
+    """
+    blocks: Queue = Queue(maxsize=PREFETCHED_BLOCKS)
+
+    def decompress() -> None:
+        try:
+            with open(filepath, 'rb') as file:
+                inflater = _Inflater(file)
+                while block := inflater.inflate():
+                    if index is not None and inflater.position - index.checkpoints[-1][1] >= CHECKPOINT_SPACING:
+                        index.checkpoints.append(inflater.checkpoint())
+                    blocks.put(block)
+        except Exception as e:
+            blocks.put(e)
+        blocks.put(None)
+
+    Thread(target=decompress, daemon=True, name=f'gunzip {filepath}').start()
+    while (block := blocks.get()) is not None:
+        if isinstance(block, Exception):
+            raise block
+        yield block
+
+
+def _parse_records(lines: List[bytes], first_record: int, filepath: str, index: Optional[FastqIndex]) -> List[Read]:
+    """
+    Build the records from complete groups of 4 lines. The structure is checked on whole columns of lines instead of
+    record by record.
+    """
+    if index is not None:
+        lengths: List[int] = list(map(len, lines))
+        record_lengths: List[int] = [header + sequence + plus + quality + 4 for header, sequence, plus, quality
+                                     in zip(lengths[0::4], lengths[1::4], lengths[2::4], lengths[3::4])]
+        index.offsets.extend(islice(accumulate(record_lengths, initial=index.size), len(record_lengths)))
+        index.size += sum(record_lengths)
+    if any(line.endswith(b'\r') for line in lines[0::4]):
+        lines = [line[:-1] if line.endswith(b'\r') else line for line in lines]
+
+    headers, sequences, pluses, qualities = lines[0::4], lines[1::4], lines[2::4], lines[3::4]
+    if not all(header.startswith(b'@') for header in headers) or \
+            not all(plus.startswith(b'+') for plus in pluses) or \
+            list(map(len, sequences)) != list(map(len, qualities)):
+        for record, (header, sequence, plus, quality) in enumerate(zip(headers, sequences, pluses, qualities)):
+            if not header.startswith(b'@') or not plus.startswith(b'+') or len(sequence) != len(quality):
+                raise ValueError(f'{filepath}: Record {first_record + record + 1} is not a valid FASTQ record.')
+    return list(map(Read, headers, sequences, pluses, qualities))
+
+
+def is_gzip(filepath: str) -> bool:
+    with open(filepath, 'rb') as file:
+        return file.read(2) == GZIP_MAGIC
+
+
+def read_fastq_batches(filepath: str, index: Optional[FastqIndex] = None) -> Generator[List[Read], None, None]:
+    """
+    Parse a (possibly gzip compressed) FASTQ file block by block.
+    :param index: If given, the offsets of the records are recorded in it.
+    :return: Batches of the records of the file, in order.
+    :raises ValueError: If the file is not well-formed FASTQ.
+    """
+    blocks: Generator[bytes, None, None] = _gzip_blocks(filepath, index) if is_gzip(filepath) \
+        else _plain_blocks(filepath)
+
+    rest: bytes = b''
+    records: int = 0
+    for block in blocks:
+        data: bytes = rest + block if rest else block
+        lines: List[bytes] = data.split(b'\n')
+        # The last line may be incomplete, and so may be the last record
+        complete: int = (len(lines) - 1) // 4 * 4
+        rest = b'\n'.join(lines[complete:])
+        if complete > 0:
+            yield _parse_records(lines[:complete], records, filepath, index)
+            records += complete // 4
+
+    lines = rest.split(b'\n')
+    # A trailing newline is optional
+    if len(lines[-1]) == 0:
+        lines.pop()
+    if len(lines) % 4 != 0:
+        raise ValueError(f'{filepath}: The last record is truncated.')
+    if len(lines) > 0:
+        size: int = 0 if index is None else index.size
+        yield _parse_records(lines, records, filepath, index)
+        if index is not None:
+            # The last line may lack its line break
+            index.size = size + len(rest)
+
+
+def _ranges(ordinals: Iterable[int]) -> Generator[Tuple[int, int], None, None]:
+    """
+    Merge ascending ordinals into ranges of consecutive ordinals (first, last).
+    """
+    first: Optional[int] = None
+    last: int = -1
+    for ordinal in ordinals:
+        if first is not None and ordinal == last + 1:
+            last = ordinal
+            continue
+        if first is not None:
+            yield first, last
+        first = last = ordinal
+    if first is not None:
+        yield first, last
+
+
+def copy_records(filepath: str, index: FastqIndex, ordinals: Iterable[int], output: BinaryIO) -> None:
+    """
+    Copy records of a file that was parsed with an index, as they are.
+    :param ordinals: The ordinals of the records to copy, ascending.
+    """
+    with open(filepath, 'rb') as file:
+        if not is_gzip(filepath):
+            if index.size == 0:
+                return
+            with mmap(file.fileno(), 0, access=ACCESS_READ) as mapped:
+                for first, last in _ranges(ordinals):
+                    start, end = index.record_range(first, last)
+                    output.write(mapped[start:end])
+            return
+
+        # Decompress forward from record to record, but restart from the closest checkpoint when it saves work
+        checkpoint_offsets: List[int] = [checkpoint[1] for checkpoint in index.checkpoints]
+        inflater = _Inflater(file)
+        pending: bytes = b''
+        for first, last in _ranges(ordinals):
+            start, end = index.record_range(first, last)
+            checkpoint = index.checkpoints[bisect_right(checkpoint_offsets, start) - 1]
+            if checkpoint[1] > inflater.position:
+                inflater.restore(checkpoint)
+                pending = b''
+            # pending holds the decompressed data just before inflater.position
+            while inflater.position < start:
+                pending = inflater.inflate()
+                if not pending:
+                    raise ValueError(f'{filepath} is shorter than when it was uploaded.')
+            pending = pending[len(pending) - (inflater.position - start):]
+            while len(pending) < end - start:
+                data = inflater.inflate()
+                if not data:
+                    raise ValueError(f'{filepath} is shorter than when it was uploaded.')
+                output.write(pending)
+                start += len(pending)
+                pending = data
+            output.write(pending[:end - start])
+            pending = pending[end - start:]
+            # The decompressed data before inflater.position is kept in pending for the next range